@@ -1,9 +1,23 @@
-import krpc
 # from krpc import VesselSituation
 import time
+from approach import RunwayApproach
+from controls import ControlBuffer
+from derivatives import DerivativeBuffer
+from estimator import StateEstimator
+from metrics import TrackingMetrics
+from scheduler import AdaptiveRate, TickScheduler
+from telemetry import Telemetry
 
-connection = krpc.connect()
-
+# Guidance parameters every Vessel starts with; any of them may be changed on a vessel (see sweep.py), and
+# batch.BatchVessel takes its defaults from here as well. The approach altitude starts at the cruise altitude
+GUIDANCE_DEFAULTS = {
+    "altitude_offset": 0, "max_target_speed": 100, "max_take_off_vertical_speed": 15, "lift_off_speed": 40,
+    "runway_center": -0.0493255, "runway_end": -74.5, "runway_heading": 270, "correction_angle": 40,
+    "max_correction_roll": 15, "min_correction_roll": 5, "max_latitude_difference": 0.15, "correction_roll_gain": 200,
+    "half_turn_di": 0.25,
+    # Pitch and roll sensitivities the approach starts with; later stages of the landing reduce them
+    "approach_pitch_sensitivity": 3.0, "approach_roll_sensitivity": 2.0,
+    "approach_speed": 80, "approach_offset": 1, "landing_altitude": 100, "landing_offset": .25, "landing_pitch": 5}
 
 # vessel = connection.space_center.active_vessel
 # while True:
@@ -24,89 +38,198 @@ connection = krpc.connect()
 
 class Vessel:
     def __init__(self, conn, cruise_altitude=100, cruise_speed=100, cruise_acceleration=10, time_step=0.01,
-                 control_step=0.01):
-        self.vessel = conn.space_center.active_vessel
-        self.ref_frame = conn.space_center.ReferenceFrame.create_hybrid(
-            position=self.vessel.orbit.body.reference_frame,
-            rotation=self.vessel.surface_reference_frame)
+                 control_step=0.01, derivative_smoothing=None, metrics_interval=5.0, recorder=None, ref_frame=None,
+                 estimator_theta=None, min_time_step=None, max_time_step=None, command_latency=None):
+        self.bind(conn, ref_frame)
         self.cruise_altitude = cruise_altitude
         self.cruise_speed = cruise_speed
         self.cruise_acceleration = cruise_acceleration
         self.t = time_step
+        # Every maneuver loop is paced by one scheduler. Offline backends advance game time through their own clock
+        # and sleep, see simulator.SimulatedConnection
+        self.scheduler = TickScheduler(time_step, getattr(conn, "clock", time.monotonic),
+                                       getattr(conn, "sleep", time.sleep))
+        self.dt = time_step
+        self.max_step_scale = 4
+        # With a 'max_time_step' the period of every tick is chosen between the bounds by how much the flight demands
+        # a fine control rate, see control_demand(). 'time_step' stays the tick that control changes are sized for
+        self.adaptive_rate = None
+        if max_time_step is not None:
+            self.adaptive_rate = AdaptiveRate(min_time_step if min_time_step is not None else time_step,
+                                              max_time_step)
+        # Errors from the setpoints of this tick that ask for the finest rate, see control_demand()
+        self.demand_scales = {"mean_altitude": 10.0, "surface_altitude": 10.0, "roll": 5.0, "speed": 10.0}
+        self.demand_roll_rate = 10.0
+        # Maneuvers whose rate adapts; take-off and the whole approach down to the rollout are flown at the finest rate
+        self.adaptive_maneuvers = ("cruise", "turn")
+        self.tracking_errors = {}
+        # Commanded controls are kept locally; changes made during a tick are written together at the end of it
+        self.controls = ControlBuffer(self.vessel.control, clock=self.scheduler.clock)
+        self.drift_check_ticks = 200
+        # Tracking errors of every controlled quantity, summarised every 'metrics_interval' seconds
+        self.metrics = TrackingMetrics(metrics_interval)
+        # Optional per-tick flight data recorder, see recorder.FlightRecorder
+        self.recorder = recorder
+        self.maneuver = None
+        self.phase = None
+        self.targets = {}
         self.control_step = control_step
-        self.altitude_offset = 0
-        self.max_target_speed = 100
-        self.max_take_off_vertical_speed = 15
-        self.lift_off_speed = 40
-        self.runway_center = -0.0493255
-        self.runway_end = -74.5
-        self.runway_heading = 270
-        self.correction_angle = 40
-        self.max_correction_roll = 15
-        self.min_correction_roll = 5
-        self.max_latitude_difference = 0.15
+        for name, value in GUIDANCE_DEFAULTS.items():
+            setattr(self, name, value)
         self.approach_altitude = self.cruise_altitude
-        self.approach_speed = 80
-        self.approach_offset = 1
-        self.landing_altitude = 100
-        self.landing_offset = .25
-        self.landing_pitch = 5
+        # Phase engine of runway_alignment_correction; holds the approach's state between its S-turns
+        self.approach = RunwayApproach(self)
+        # Derivatives of these quantities are updated every tick, so they stay warm from one maneuver to the next.
+        # With an 'estimator_theta' they are filtered estimates predicted to when the tick's commands take effect,
+        # see estimator.StateEstimator, rather than divided differences of the raw samples. Experimental: the control
+        # gains are tuned for the divided differences
+        self.derivative_smoothing = derivative_smoothing
+        self.estimator_theta = estimator_theta
+        # The lead is the time a control write takes, measured on the scheduler's clock, unless a fixed
+        # 'command_latency' is given
+        self.measure_latency = command_latency is None
+        self.command_latency = command_latency if command_latency is not None else 0.0
+        self.latency_smoothing = 0.1
+        self.derivatives = {quantity_name: self.new_derivative_buffer()
+                            for quantity_name in ("mean_altitude", "surface_altitude", "roll", "speed")}
+        self.engine_started = False
+        # Every snapshot the vessel reads is handed to the recorder, including those taken outside a tick
+        self.snapshot_recorded = True
+        self.update_telemetry()
+
+    def bind(self, conn, ref_frame=None):
+        """ Takes the active vessel, the reference frame (a hybrid of the body's position and the vessel's surface
+            rotation unless given, i.e. by session.Session) and the telemetry streams from 'conn'"""
+        self.vessel = conn.space_center.active_vessel
+        if ref_frame is None:
+            ref_frame = conn.space_center.ReferenceFrame.create_hybrid(
+                position=self.vessel.orbit.body.reference_frame,
+                rotation=self.vessel.surface_reference_frame)
+        self.ref_frame = ref_frame
+        self.telemetry = Telemetry(conn, self.vessel, self.ref_frame)
+
+    def reconnect(self, conn, ref_frame=None):
+        """ Moves the vessel onto a new connection after the old one was lost. Derivatives, metrics, the recorder and
+            the approach state carry on; the controls are read back from the game."""
+        self.bind(conn, ref_frame)
+        self.scheduler.clock = getattr(conn, "clock", time.monotonic)
+        self.scheduler.sleep = getattr(conn, "sleep", time.sleep)
+        self.controls.control = self.vessel.control
+        self.controls.clock = self.scheduler.clock
+        self.controls.sync()
+        return self.update_telemetry()
+
+    @property
+    def flight(self):
+        # Telemetry snapshot of the current tick. Reading it makes no RPCs; it is refreshed by update_telemetry()
+        return self.telemetry.snapshot
+
+    @property
+    def step_scale(self):
+        # Control changes are sized for a tick of 'self.t'; a longer tick applies proportionally more, and a late tick
+        # counts for at most 'max_step_scale' scheduled periods
+        return min(self.dt, self.max_step_scale * self.scheduler.period) / self.t
+
+    def next_tick(self):
+        """ Records the tick, writes its control changes, waits for the scheduler's next deadline, keeps the measured
+            time step and takes the next tick's telemetry"""
+        self.record()
+        self.targets.clear()
+        if self.adaptive_rate is not None:
+            self.scheduler.set_period(self.adaptive_rate.update(self.control_demand()))
+        self.tracking_errors.clear()
+        if self.estimator_theta is not None and self.measure_latency and self.controls.changes():
+            start = self.scheduler.clock()
+            self.flush_controls()
+            self.update_command_latency(self.scheduler.clock() - start)
+        else:
+            self.flush_controls()
+        self.dt = self.scheduler.wait()
+        if self.scheduler.ticks % self.drift_check_ticks == 0:
+            self.controls.check_drift()
+        self.metrics.report(self.scheduler.last_tick)
+        return self.update_telemetry()
+
+    def begin_maneuver(self, maneuver):
+        """ Re-reads the vessel's controls, anchors the scheduler and takes a fresh snapshot. Called at the start of
+            every maneuver"""
+        self.maneuver = maneuver
+        self.phase = None
+        self.controls.sync()
+        self.scheduler.start()
+        return self.update_telemetry()
+
+    def record(self):
+        """ Hands the current snapshot and the controls commanded on it to the recorder, if any"""
+        if self.recorder is not None:
+            self.recorder.record(self)
+        self.snapshot_recorded = True
+
+    def update_telemetry(self):
+        """ Takes the telemetry snapshot for this tick and adds it to every derivative buffer. A snapshot that no tick
+            recorded, i.e. one read by begin_maneuver() or by a mission's end condition, is recorded first"""
+        if not self.snapshot_recorded:
+            self.record()
+        snapshot = self.telemetry.update()
+        self.snapshot_recorded = False
+        for quantity_name, buffer in self.derivatives.items():
+            buffer.update(snapshot.ut, getattr(snapshot, quantity_name))
+        return snapshot
 
     """ 
     Maneuver methods
     ----------------
-    Each maneuver method includes a while-loop which iterates until the maneuver's end condition (i.e. altitude > target). 
-    The while-loop serves as a numeric simulation, containing helper methods which calculate time derivatives over the 
-    time step 'self.t' and make their respective changes to the vessel's controls (i.e. pitch-up or pitch-down)
+    Each maneuver method includes a while-loop which iterates until the maneuver's end condition (i.e. altitude >
+    target). The while-loop serves as a numeric simulation, containing helper methods which calculate time derivatives
+    over the time step 'self.t' and make their respective changes to the vessel's controls (i.e. pitch-up or pitch-down)
     """
     def start_engine(self):
-        # Brings vessel up to take-off speed on the runway
-        self.vessel.control.activate_next_stage()
-        self.vessel.control.brakes = False
-        initial_speed = self.vessel.flight(self.ref_frame).speed
-        while self.vessel.flight(self.ref_frame).speed < self.lift_off_speed:
-            initial_speed = self.control_quantity("speed", initial_speed, self.cruise_speed, self.cruise_acceleration,
-                                                  "throttle")
-            time.sleep(self.t)
+        # Brings vessel up to take-off speed on the runway. The engine is staged once, so a take-off flown again
+        # after a reconnect carries on from where it was
+        if not self.engine_started:
+            self.vessel.control.activate_next_stage()
+            self.engine_started = True
+        self.begin_maneuver("start_engine")
+        self.set_control("brakes", False)
+        self.warm_up("speed")
+        while self.flight.speed < self.lift_off_speed:
+            self.control_quantity("speed", self.cruise_speed, self.cruise_acceleration, "throttle")
+            self.next_tick()
 
     def take_off(self, altitude_quantity="mean_altitude"):
         # Guides vessel pitch until reaching cruise altitude
         self.start_engine()
-        initial_speed = self.vessel.flight(self.ref_frame).speed
-        altitude_derivatives = self.get_initial_derivatives(altitude_quantity, 4)
-        while getattr(self.vessel.flight(self.ref_frame), altitude_quantity) < self.cruise_altitude:
-            initial_speed = self.control_quantity("speed", initial_speed, self.cruise_speed, self.cruise_acceleration,
-                                                  "throttle")
+        self.begin_maneuver("take_off")
+        self.warm_up(altitude_quantity)
+        while getattr(self.flight, altitude_quantity) < self.cruise_altitude:
+            self.control_quantity("speed", self.cruise_speed, self.cruise_acceleration, "throttle")
             target_climb_speed = self.max_take_off_vertical_speed
-            altitude_derivatives = self.angular_control_from_position(
-                altitude_quantity, altitude_derivatives, target_climb_speed, "pitch",
-                self.control_step, sensitivity=1)
-            time.sleep(self.t)
+            self.angular_control_from_position(altitude_quantity, target_climb_speed, "pitch", self.control_step,
+                                               sensitivity=1)
+            self.next_tick()
         print("Take-off Complete")
 
     def cruise(self, altitude_quantity="mean_altitude", longitude_bound=-74.3, direction=1):
         # Guides vessel with constant speed, altitude, and roll angle of zero (straight, level flight)
-        self.vessel.control.gear = False
-        initial_speed = self.vessel.flight(self.ref_frame).speed
-        altitude_derivatives = self.get_initial_derivatives(altitude_quantity, 4)
-        roll_derivatives = self.get_initial_derivatives("roll", 4)
-        error = []
-        while self.vessel.flight(self.ref_frame).longitude < longitude_bound:
-            initial_speed = self.control_quantity("speed", initial_speed, self.cruise_speed, self.cruise_acceleration,
-                                                  "throttle")
+        self.begin_maneuver("cruise")
+        self.set_control("gear", False)
+        self.warm_up(altitude_quantity, "roll")
+        while self.flight.longitude < longitude_bound:
+            self.control_quantity("speed", self.cruise_speed, self.cruise_acceleration, "throttle")
             target_climb_speed = self.get_quadratic_target_quantity_velocity(altitude_quantity, self.cruise_altitude,
                                                                              self.max_target_speed)
             target_roll_speed = self.get_symmetric_quadratic_target_quantity_velocity("roll", 0,
                                                                                       self.max_target_speed / 4,
                                                                                       anti_sensitivity=0.1)
-            # print(self.vessel.flight(self.ref_frame).longitude)
-            altitude_derivatives = self.angular_control_from_position(
-                altitude_quantity, altitude_derivatives, target_climb_speed, "pitch", self.control_step, sensitivity=2)
-            error.append(abs(altitude_derivatives[1] - self.vessel.flight(self.ref_frame).velocity[0]))
-            print(sum(error) / len(error))
-            roll_derivatives = self.angular_control_from_position(
-                'roll', roll_derivatives, target_roll_speed, "roll", self.control_step / 10, sensitivity=0.5)
-            time.sleep(self.t)
+            # print(self.flight.longitude)
+            self.angular_control_from_position(altitude_quantity, target_climb_speed, "pitch", self.control_step,
+                                               sensitivity=2)
+            # Numeric vertical speed against the vessel's own
+            self.metrics.record("altitude_rate_estimate",
+                                self.get_time_derivatives(altitude_quantity)[1] - self.flight.velocity[0])
+            self.angular_control_from_position('roll', target_roll_speed, "roll", self.control_step / 10,
+                                               sensitivity=0.5)
+            self.next_tick()
 
     def runway_alignment_correction(self, altitude_quantity="mean_altitude", direction=1):
         """
@@ -114,209 +237,70 @@ class Vessel:
         top of it by making an S-shaped maneuver, then goes for the landing. The aggressiveness by which it corrects
         its heading, roll, altitude, and speed is proportionate to how close it is the runway in the direction of the
         landing, however there may be more appropriate quantities to make these corrections proportionate to.
-        The S-shaped maneuver is repeated until the landing is complete.
+        The S-shaped maneuver is repeated until the landing is complete. Its phases and the stages of the landing are
+        tables in approach.py, evaluated by self.approach once per tick.
         """
-        self.vessel.control.gear = False
-        initial_speed = self.vessel.flight(self.ref_frame).speed
-        altitude_derivatives = self.get_initial_derivatives(altitude_quantity, 4)
-        roll_derivatives = self.get_initial_derivatives("roll", 4)
-        initial_latitude = self.vessel.flight(self.ref_frame).latitude
-        correction_roll = 200 * abs(self.runway_center - initial_latitude)
-        if self.vessel.flight(self.ref_frame).latitude < self.runway_end:
-            self.min_correction_roll = 1.5
-        if correction_roll > self.max_correction_roll:
-            correction_roll = self.max_correction_roll
-        elif correction_roll < self.min_correction_roll:
-            correction_roll = self.min_correction_roll
-        half_turn_di = 0.25
-        speed = self.cruise_speed
-        altitude = self.cruise_altitude
-        a_s = 3.0
-        s = 2.0
-        print(f"Correction Roll: {correction_roll}")
-        if self.vessel.flight(self.ref_frame).latitude > self.runway_center:
-            while self.vessel.flight(self.ref_frame).latitude > self.runway_center:
-                if self.vessel.flight(self.ref_frame).longitude < self.runway_end + self.approach_offset:
-                    speed = self.approach_speed
-                    altitude = self.approach_altitude
-                    self.correction_angle = 10
-                if self.vessel.flight(self.ref_frame).longitude < self.runway_end + self.landing_offset:
-                    altitude = self.landing_altitude
-                    self.approach_speed = 40
-                    s = 0.75
-                if self.vessel.flight(self.ref_frame).longitude < self.runway_end and \
-                        self.vessel.flight(self.ref_frame).speed > self.approach_speed:
-                    altitude_quantity = "surface_altitude"
-                    altitude = 35
-                    speed = 20
-                    a_s = 1.5
-                    s = 0.5
-                    self.vessel.control.gear = True
-                if self.vessel.flight(self.ref_frame).longitude < self.runway_end and \
-                        self.vessel.flight(self.ref_frame).speed < self.approach_speed:
-                    print("LANDING")
-                    a_s = 1
-                    self.vessel.control.gear = True
-                    speed = 27
-                    s = 0.15
-                    altitude = 25
-                if self.vessel.flight(self.ref_frame).surface_altitude < 2:
-                    altitude = 1
-                    self.vessel.control.brakes = True
-                    speed = 0
-
-                target_climb_speed = self.get_quadratic_target_quantity_velocity(altitude_quantity, altitude,
-                                                                                 self.max_target_speed)
-                altitude_derivatives = self.angular_control_from_position(
-                    altitude_quantity, altitude_derivatives, target_climb_speed, "pitch", self.control_step,
-                    sensitivity=a_s)
-                initial_speed = self.control_quantity("speed", initial_speed, speed, self.cruise_acceleration,
-                                                      "throttle")
-
-                if self.vessel.flight(self.ref_frame).latitude > initial_latitude:
-                    initial_latitude = self.vessel.flight(self.ref_frame).latitude
-                di = (self.runway_center - self.vessel.flight(self.ref_frame).latitude) / \
-                     (self.runway_center - initial_latitude)
-                if self.vessel.flight(self.ref_frame).heading > self.runway_heading - self.correction_angle / 2 and \
-                        di > 0.75:
-                    target_roll_speed = self.get_symmetric_quadratic_target_quantity_velocity("roll", -correction_roll,
-                                                                                              self.max_target_speed / 4,
-                                                                                              anti_sensitivity=0.1)
-                    print("M1 pre", di)
-                    half_turn_di = 1.0 - di
-                elif self.vessel.flight(self.ref_frame).heading < self.runway_heading - self.correction_angle / 2 and \
-                        di > 0.75:
-                    target_roll_speed = self.get_symmetric_quadratic_target_quantity_velocity("roll", 0,
-                                                                                              self.max_target_speed / 4,
-                                                                                              anti_sensitivity=0.1)
-                    print("M1 post", di)
-                elif di > 8 * half_turn_di:
-                    target_roll_speed = self.get_symmetric_quadratic_target_quantity_velocity("roll", 0,
-                                                                                              self.max_target_speed / 4,
-                                                                                              anti_sensitivity=0.1)
-                    print("Z1", di)
-                elif 8 * half_turn_di > di and \
-                        self.vessel.flight(self.ref_frame).heading < self.runway_heading - self.correction_angle / 2:
-                    target_roll_speed = self.get_symmetric_quadratic_target_quantity_velocity("roll", correction_roll,
-                                                                                              self.max_target_speed / 4,
-                                                                                              anti_sensitivity=0.1)
-                    print("Z2", di)
-                elif 8 * half_turn_di > di and \
-                        self.vessel.flight(self.ref_frame).heading > self.runway_heading - self.correction_angle / 2:
-                    target_roll_speed = self.get_symmetric_quadratic_target_quantity_velocity("roll", 0,
-                                                                                              self.max_target_speed / 4,
-                                                                                              anti_sensitivity=0.1)
-                    if self.vessel.flight(self.ref_frame).roll < 1:
-                        break
-                    print("M2", di)
-                else:
-                    target_roll_speed = 0
-                roll_derivatives = self.angular_control_from_position(
-                    'roll', roll_derivatives, target_roll_speed, "roll", self.control_step / 8, sensitivity=s)
-        else:
-            while self.vessel.flight(self.ref_frame).latitude < self.runway_center:
-                if self.vessel.flight(self.ref_frame).longitude < self.runway_end + self.approach_offset:
-                    speed = self.approach_speed
-                    altitude = self.approach_altitude
-                    self.correction_angle = 10
-                if self.vessel.flight(self.ref_frame).longitude < self.runway_end + self.landing_offset:
-                    altitude = self.landing_altitude
-                    self.approach_speed = 40
-                    s = 0.75
-                if self.vessel.flight(self.ref_frame).longitude < self.runway_end and \
-                        self.vessel.flight(self.ref_frame).speed > self.approach_speed:
-                    altitude_quantity = "surface_altitude"
-                    altitude = 35
-                    speed = 40
-                    a_s = 1.5
-                    s = 0.5
-                    self.vessel.control.gear = True
-                if self.vessel.flight(self.ref_frame).longitude < self.runway_end and \
-                        self.vessel.flight(self.ref_frame).speed < self.approach_speed:
-                    print("LANDING")
-                    self.vessel.control.gear = True
-                    speed = 27
-                    s = 0.15
-                    a_s = 1.0
-                    altitude = 25
-                if self.vessel.flight(self.ref_frame).surface_altitude < 2:
-                    altitude = 1
-                    self.vessel.control.brakes = True
-                    speed = 0
-                target_climb_speed = self.get_quadratic_target_quantity_velocity(altitude_quantity, altitude,
-                                                                                 self.max_target_speed)
-                altitude_derivatives = self.angular_control_from_position(
-                    altitude_quantity, altitude_derivatives, target_climb_speed, "pitch", self.control_step,
-                    sensitivity=a_s)
-                initial_speed = self.control_quantity("speed", initial_speed, speed, self.cruise_acceleration,
-                                                      "throttle")
-                if self.vessel.flight(self.ref_frame).latitude < initial_latitude:
-                    initial_latitude = self.vessel.flight(self.ref_frame).latitude
-                di = (self.runway_center - self.vessel.flight(self.ref_frame).latitude) / \
-                     (self.runway_center - initial_latitude)
-                if self.vessel.flight(self.ref_frame).heading < self.runway_heading + self.correction_angle / 2 and \
-                        di > 0.75:
-                    target_roll_speed = self.get_symmetric_quadratic_target_quantity_velocity("roll", correction_roll,
-                                                                                              self.max_target_speed / 4,
-                                                                                              anti_sensitivity=0.1)
-                    print("M1 pre", di)
-                    half_turn_di = 1.0 - di
-                elif self.vessel.flight(self.ref_frame).heading > self.runway_heading + self.correction_angle / 2 and \
-                        di > 0.75:
-                    target_roll_speed = self.get_symmetric_quadratic_target_quantity_velocity("roll", 0,
-                                                                                              self.max_target_speed / 4,
-                                                                                              anti_sensitivity=0.1)
-                    print("M1 post", di)
-                elif di > 8 * half_turn_di:
-                    target_roll_speed = self.get_symmetric_quadratic_target_quantity_velocity("roll", 0,
-                                                                                              self.max_target_speed / 4,
-                                                                                              anti_sensitivity=0.1)
-                    print("Z1", di)
-                elif 8 * half_turn_di > di and \
-                        self.vessel.flight(self.ref_frame).heading > self.runway_heading + self.correction_angle / 2:
-                    target_roll_speed = self.get_symmetric_quadratic_target_quantity_velocity("roll", -correction_roll,
-                                                                                              self.max_target_speed / 4,
-                                                                                              anti_sensitivity=0.1)
-                    print("Z2", di)
-                elif 8 * half_turn_di > di and \
-                        self.vessel.flight(self.ref_frame).heading < self.runway_heading + self.correction_angle / 2:
-                    target_roll_speed = self.get_symmetric_quadratic_target_quantity_velocity("roll", 0,
-                                                                                              self.max_target_speed / 4,
-                                                                                              anti_sensitivity=0.1)
-                    if self.vessel.flight(self.ref_frame).roll < 1:
-                        break
-                    print("M2", di)
-                else:
-                    target_roll_speed = 0
-                roll_derivatives = self.angular_control_from_position(
-                    'roll', roll_derivatives, target_roll_speed, "roll", self.control_step / 8, sensitivity=s)
+        if self.maneuver != "runway_alignment_correction":
+            self.approach.reset()
+        self.begin_maneuver("runway_alignment_correction")
+        self.set_control("gear", False)
+        self.warm_up(altitude_quantity, "roll")
+        approach = self.approach
+        approach.start(self.flight, altitude_quantity)
+        print(f"Correction Roll: {approach.correction_roll}")
+        while True:
+            running = approach.update(self.flight)
+            self.phase = approach.phase
+            for control_name in ("gear", "brakes"):
+                if getattr(approach, control_name) is not None:
+                    self.set_control(control_name, getattr(approach, control_name))
+            if not running:
+                # Crossed the centre line, or stopped on the runway and the caller's speed check ends the approach
+                break
+            target_climb_speed = self.get_quadratic_target_quantity_velocity(approach.altitude_quantity,
+                                                                             approach.target_altitude,
+                                                                             self.max_target_speed)
+            self.angular_control_from_position(approach.altitude_quantity, target_climb_speed, "pitch",
+                                               self.control_step, sensitivity=approach.pitch_sensitivity)
+            self.control_quantity("speed", approach.target_speed, self.cruise_acceleration, "throttle")
+            if approach.lined_up:
+                break
+            if approach.target_roll is None:
+                target_roll_speed = 0
+            else:
+                target_roll_speed = self.get_symmetric_quadratic_target_quantity_velocity("roll", approach.target_roll,
+                                                                                          self.max_target_speed / 4,
+                                                                                          anti_sensitivity=0.1)
+            self.angular_control_from_position('roll', target_roll_speed, "roll", self.control_step / 8,
+                                               sensitivity=approach.roll_sensitivity)
+            self.next_tick()
+        # Changes made on the tick that ended the maneuver
+        self.flush_controls()
 
     def turn(self, altitude_quantity="mean_altitude", heading_limit=260, turning_speed=65, roll_angle=30, offset=10):
         # Guides vessel through banked turn with a constant speed. Roll angle based on progress to desired heading
-        self.vessel.control.gear = False
-        initial_speed = self.vessel.flight(self.ref_frame).speed
-        altitude_derivatives = self.get_initial_derivatives(altitude_quantity, 4)
-        roll_derivatives = self.get_initial_derivatives("roll", 4)
-        initial_heading = self.vessel.flight(self.ref_frame).heading
-        while self.vessel.flight(self.ref_frame).heading < heading_limit:
-            initial_speed = self.control_quantity("speed", initial_speed, turning_speed, self.cruise_acceleration,
-                                                  "throttle")
+        self.begin_maneuver("turn")
+        self.set_control("gear", False)
+        self.warm_up(altitude_quantity, "roll")
+        initial_heading = self.flight.heading
+        while self.flight.heading < heading_limit:
+            self.control_quantity("speed", turning_speed, self.cruise_acceleration, "throttle")
             target_climb_speed = self.get_quadratic_target_quantity_velocity(altitude_quantity, self.cruise_altitude,
                                                                              self.max_target_speed)
             roll = self.get_roll_angle_from_heading(initial_heading, heading_limit, roll_angle, offset)
             target_roll_speed = self.get_symmetric_quadratic_target_quantity_velocity("roll", roll,
                                                                                       self.max_target_speed / 4,
                                                                                       anti_sensitivity=0.1)
-            altitude_derivatives = self.angular_control_from_position(
-                altitude_quantity, altitude_derivatives, target_climb_speed, "pitch", self.control_step, sensitivity=2.5)
-            roll_derivatives = self.angular_control_from_position(
-                'roll', roll_derivatives, target_roll_speed, "roll", self.control_step / 10, sensitivity=0.5)
-            time.sleep(self.t)
+            self.angular_control_from_position(altitude_quantity, target_climb_speed, "pitch", self.control_step,
+                                               sensitivity=2.5)
+            self.angular_control_from_position('roll', target_roll_speed, "roll", self.control_step / 10,
+                                               sensitivity=0.5)
+            self.next_tick()
 
     """
     Helper Methods - Calculate Target Quantity
     ----------------
-    These methods return target quantities (i.e. altitude velocity) to help Control Methods make changes to the vessel's 
+    These methods return target quantities (i.e. altitude velocity) to help Control Methods make changes to the vessel's
     controls (i.e. pitch-up) proportionate the difference of target quantity and actual. For example the further the 
     vessel's target altitude is from its actual, the greater the target altitude velocity will be. This relation is 
     non-linear, quadratic by default. Continuing with this example, once the target altitude velocity is given 
@@ -325,16 +309,18 @@ class Vessel:
     """
 
     def get_roll_angle_from_heading(self, initial_heading, final_heading, max_roll, offset=10):
-        current_heading = self.vessel.flight(self.ref_frame).heading
+        current_heading = self.flight.heading
         if current_heading < initial_heading:
             return max_roll
-        return (-max_roll / (final_heading - initial_heading)**3) * (current_heading - initial_heading - offset)**3 + max_roll
+        return (-max_roll / (final_heading - initial_heading)**3) * \
+            (current_heading - initial_heading - offset)**3 + max_roll
 
     def get_symmetric_quadratic_target_quantity_velocity(self, quantity_name, quantity_midpoint, velocity_bound,
                                                          multiplicity=2, anti_sensitivity=0.1):
-        target_velocity = (getattr(self.vessel.flight(self.ref_frame), quantity_name) -
+        self.tracking_errors[quantity_name] = getattr(self.flight, quantity_name) - quantity_midpoint
+        target_velocity = (getattr(self.flight, quantity_name) -
                            quantity_midpoint) ** multiplicity * velocity_bound / anti_sensitivity
-        if getattr(self.vessel.flight(self.ref_frame), quantity_name) > quantity_midpoint:
+        if getattr(self.flight, quantity_name) > quantity_midpoint:
             target_velocity = -1 * target_velocity
         if target_velocity < -velocity_bound:
             target_velocity = -velocity_bound
@@ -344,10 +330,11 @@ class Vessel:
 
     def get_quadratic_target_quantity_velocity(self, quantity_name, quantity_midpoint, velocity_bound, multiplicity=2,
                                                sensitivity=2.0):
-        target_velocity = (getattr(self.vessel.flight(self.ref_frame), quantity_name) -
+        self.tracking_errors[quantity_name] = getattr(self.flight, quantity_name) - quantity_midpoint
+        target_velocity = (getattr(self.flight, quantity_name) -
                            quantity_midpoint) ** multiplicity * velocity_bound / quantity_midpoint / \
                           (quantity_midpoint / sensitivity)
-        if getattr(self.vessel.flight(self.ref_frame), quantity_name) > quantity_midpoint:
+        if getattr(self.flight, quantity_name) > quantity_midpoint:
             target_velocity = -1 * target_velocity
         if target_velocity < -sensitivity * velocity_bound:
             target_velocity = -sensitivity * velocity_bound
@@ -367,46 +354,45 @@ class Vessel:
     """
     Helper Methods - Calculate Numeric Derivatives
     ----------------
-    These methods calculate numeric time derivatives of various quantities (i.e. altitude, roll) over the time step 
-    'self.t'. Time derivatives are calculated for control method's PID algorithm, allowing vessel control changes to 
-    result in vessel's smooth flight.
+    These methods return numeric time derivatives of various quantities (i.e. altitude, roll). Each quantity has a
+    DerivativeBuffer that is fed every telemetry snapshot together with the snapshot's game time, so derivatives are
+    taken over the actual interval between samples rather than assuming it equals 'self.t'. Time derivatives are used
+    by control method's PID algorithm, allowing vessel control changes to result in vessel's smooth flight.
     """
 
-    def get_initial_derivatives(self, quantity_name, n):
-        """ Returns list of initial derivatives of a given quantity (i.e. altitude) from 0th to nth.
-            Used at the beginning of maneuver methods to begin numeric simulation"""
-        derivatives_matrix = []
-        zeroth_derivatives = []
+    def warm_up(self, *quantity_names):
+        """ Makes sure all derivatives of the given quantities are available, tracking any quantity not tracked yet.
+            Tracked quantities are updated every tick, so this only waits the first time a quantity is used."""
+        for quantity_name in quantity_names:
+            if quantity_name not in self.derivatives:
+                self.derivatives[quantity_name] = self.new_derivative_buffer()
+        while not all(self.derivatives[quantity_name].warm for quantity_name in quantity_names):
+            self.next_tick()
 
-        for i in range(n + 1):
-            zeroth_derivatives.append(getattr(self.vessel.flight(self.ref_frame), quantity_name))
-            time.sleep(self.t)
-        derivatives_matrix.append(zeroth_derivatives)
+    def new_derivative_buffer(self):
+        if self.estimator_theta is None:
+            return DerivativeBuffer(5, self.derivative_smoothing)
+        return StateEstimator(5, self.estimator_theta, lead=self.command_latency)
 
-        for derivatives in derivatives_matrix:
-            if len(derivatives) == 1:
-                break
-            next_derivatives = []
-            for i, derivative in enumerate(derivatives):
-                if i < len(derivatives) - 1:
-                    next_derivatives.append((derivatives[i + 1] - derivatives[i]) / self.t)
-            derivatives_matrix.append(next_derivatives)
+    def update_command_latency(self, seconds):
+        # Averaged time a control write takes to reach the vessel; the estimators predict this far ahead. The
+        # telemetry is about half a round trip old and the write arrives half a round trip later
+        self.set_command_latency(self.command_latency + self.latency_smoothing * (seconds - self.command_latency))
 
-        initial_derivatives = [sum(derivatives) / len(derivatives) for derivatives in derivatives_matrix]
-        return initial_derivatives
+    def set_command_latency(self, seconds):
+        # Every estimator predicts 'seconds' ahead from its next sample on, i.e. a replay sets the recorded lead
+        self.command_latency = seconds
+        for buffer in self.derivatives.values():
+            buffer.lead = seconds
 
-    def get_time_derivative(self, quantity_name, quantity_before_step):
+    def get_time_derivative(self, quantity_name):
         # Helper method of control method
-        quantity_current = getattr(self.vessel.flight(self.ref_frame), quantity_name)
-        instantaneous_time_derivative = (quantity_current - quantity_before_step) / self.t
-        return instantaneous_time_derivative, quantity_current
+        derivatives = self.derivatives[quantity_name].derivatives
+        return derivatives[1], derivatives[0]
 
-    def get_time_derivatives(self, quantity_name, initial_derivatives):
+    def get_time_derivatives(self, quantity_name):
         # Helper method of control method
-        final_derivatives = [getattr(self.vessel.flight(self.ref_frame), quantity_name)]
-        for initial_derivative in initial_derivatives:
-            final_derivatives.append((final_derivatives[-1] - initial_derivative) / self.t)
-        return final_derivatives
+        return self.derivatives[quantity_name].derivatives
 
     """
     Helper Methods - Control Methods
@@ -415,42 +401,69 @@ class Vessel:
     changes to vessel controls.
     """
 
-    def control_quantity(self, quantity_name, quantity_before_step, quantity_bound, time_derivative_bound,
-                         control_name):
-        time_derivative, quantity_current = self.get_time_derivative(quantity_name, quantity_before_step)
+    def control_demand(self):
+        """ How much this tick calls for the finest control rate, from 0 to 1: the largest of the errors from this
+            tick's setpoints (altitude, roll, speed) relative to 'demand_scales' and the roll rate relative to
+            'demand_roll_rate'. Outside 'adaptive_maneuvers' it is 1"""
+        if self.maneuver not in self.adaptive_maneuvers:
+            return 1.0
+        demand = abs(self.derivatives["roll"].derivatives[1]) / self.demand_roll_rate
+        for quantity_name, error in self.tracking_errors.items():
+            scale = self.demand_scales.get(quantity_name)
+            if scale is not None:
+                demand = max(demand, abs(error) / scale)
+        return demand
+
+    def get_control(self, control_name):
+        # Commanded value of the control, without a round trip
+        return self.controls[control_name]
+
+    def set_control(self, control_name, value):
+        self.controls[control_name] = value
+
+    def flush_controls(self):
+        self.controls.flush()
+
+    def control_quantity(self, quantity_name, quantity_bound, time_derivative_bound, control_name):
+        time_derivative, quantity_current = self.get_time_derivative(quantity_name)
+        self.tracking_errors[quantity_name] = quantity_current - quantity_bound
+        control = self.control_step * self.step_scale
         if quantity_current < quantity_bound and time_derivative < time_derivative_bound:
-            setattr(self.vessel.control, control_name, getattr(self.vessel.control, control_name) + self.control_step)
+            self.set_control(control_name, self.get_control(control_name) + control)
         else:
-            setattr(self.vessel.control, control_name, getattr(self.vessel.control, control_name) - self.control_step)
-        return quantity_current
+            self.set_control(control_name, self.get_control(control_name) - control)
 
-    def angular_control_from_position(self, quantity_name, derivatives, speed_bound, control_name, control_magnitude,
-                                      sensitivity):
-        derivatives = self.get_time_derivatives(quantity_name, derivatives)
+    def angular_control_from_position(self, quantity_name, speed_bound, control_name, control_magnitude, sensitivity):
+        derivatives = self.get_time_derivatives(quantity_name)
+        self.metrics.record(quantity_name + "_rate", derivatives[1] - speed_bound)
+        self.targets[quantity_name] = speed_bound
         if derivatives[1] > speed_bound and derivatives[2] > 0 > derivatives[3] and derivatives[4] < 0 and \
                 derivatives[5] < 0:
             control = self.get_quadratic_target_angular_control(derivatives[1], speed_bound, control_magnitude,
-                                                                sensitivity=sensitivity)
-            setattr(self.vessel.control, control_name, getattr(self.vessel.control, control_name) - control)
+                                                                sensitivity=sensitivity) * self.step_scale
+            self.set_control(control_name, self.get_control(control_name) - control)
         elif derivatives[1] < speed_bound and derivatives[2] < 0 < derivatives[3] and derivatives[4] > 0 and \
                 derivatives[5] > 0:
             control = self.get_quadratic_target_angular_control(derivatives[1], speed_bound, control_magnitude,
-                                                                sensitivity=sensitivity)
-            setattr(self.vessel.control, control_name, getattr(self.vessel.control, control_name) + control)
-        return derivatives[:-1]
-
-
-vessel = Vessel(connection, cruise_altitude=100, cruise_speed=80, time_step=0.005, cruise_acceleration=150,
-                control_step=0.02)
-altitude_name = "mean_altitude"
-print("Initiating Take Off")
-vessel.take_off(altitude_name)
-print("Take Off Complete")
-vessel.cruise(longitude_bound=-73.2, altitude_quantity=altitude_name, direction=-1)
-# print("Initiating Turn")
-# vessel.turn(altitude_quantity=altitude_name, heading_limit=270, turning_speed=100, roll_angle=45, offset=15)
-# print("===== Turn Complete =====")
-# print("==== Runway Approach ====")
-# while vessel.vessel.flight(vessel.ref_frame).speed > 1.0:
-#     vessel.runway_alignment_correction()
-# print("===== Landing Complete =====")
+                                                                sensitivity=sensitivity) * self.step_scale
+            self.set_control(control_name, self.get_control(control_name) + control)
+
+
+if __name__ == "__main__":
+    import krpc
+
+    connection = krpc.connect()
+    vessel = Vessel(connection, cruise_altitude=100, cruise_speed=80, time_step=0.005, cruise_acceleration=150,
+                    control_step=0.02)
+    altitude_name = "mean_altitude"
+    print("Initiating Take Off")
+    vessel.take_off(altitude_name)
+    print("Take Off Complete")
+    vessel.cruise(longitude_bound=-73.2, altitude_quantity=altitude_name, direction=-1)
+    # print("Initiating Turn")
+    # vessel.turn(altitude_quantity=altitude_name, heading_limit=270, turning_speed=100, roll_angle=45, offset=15)
+    # print("===== Turn Complete =====")
+    # print("==== Runway Approach ====")
+    # while vessel.update_telemetry().speed > 1.0:
+    #     vessel.runway_alignment_correction()
+    # print("===== Landing Complete =====")
@@ -0,0 +1,148 @@
+"""
+Runway approach
+---------------
+The logic of Vessel.runway_alignment_correction as two tables of phases, run by RunwayApproach from one telemetry
+snapshot per tick.
+
+LANDING_STAGES set the altitude and speed the vessel holds, by distance along the runway. Every stage whose entry
+condition holds is applied in table order, so later stages override earlier ones, and what a stage sets holds until
+another stage changes it.
+
+ALIGNMENT_PHASES are the S-turn from a course parallel to the runway onto its centre line: roll into the turn (M1 pre),
+level out (M1 post, Z1), roll back towards the runway heading (Z2) and level out once lined up (M2). The first phase
+whose entry condition holds is the current one. The table is written for an aircraft north of the runway, flying
+towards the south; south of it roll and heading are mirrored by the sign of 'side'.
+
+Entry conditions are functions of the snapshot and of the RunwayApproach, and combine comparisons with '&' so the same
+table can be evaluated on arrays of aircraft (see batch.BatchVessel).
+"""
+
+
+class Phase:
+    """
+    A row of a phase table. 'entry' tells whether the phase applies on a tick, 'exit' whether it ends the S-turn.
+    'roll' is the roll angle to aim for as a multiple of the correction roll, None to hold the roll rate at zero.
+    Keyword arguments are set on the RunwayApproach while the phase applies; a value may be a function of it.
+    """
+    def __init__(self, name, entry, roll=None, exit=None, **setpoints):
+        self.name = name
+        self.entry = entry
+        self.roll = roll
+        self.exit = exit
+        self.setpoints = setpoints
+
+    def apply(self, approach):
+        for name, value in self.setpoints.items():
+            setattr(approach, name, value(approach) if callable(value) else value)
+
+
+LANDING_STAGES = (
+    Phase("approach", lambda t, a: t.longitude < a.runway_end + a.approach_offset,
+          target_speed=lambda a: a.approach_speed, target_altitude=lambda a: a.approach_altitude,
+          correction_angle=10),
+    Phase("landing", lambda t, a: t.longitude < a.runway_end + a.landing_offset,
+          target_altitude=lambda a: a.landing_altitude, approach_speed=40, roll_sensitivity=0.75),
+    # Over the runway: slow down below the approach speed close to the ground, then hold it lower until touchdown. Both
+    # hold the height above the runway; an aircraft that reaches it slow enough flares without decelerating first
+    Phase("deceleration", lambda t, a: (t.longitude < a.runway_end) & (t.speed > a.approach_speed),
+          altitude_quantity="surface_altitude", target_altitude=35, target_speed=20, pitch_sensitivity=1.5,
+          roll_sensitivity=0.5, gear=True),
+    Phase("flare", lambda t, a: (t.longitude < a.runway_end) & (t.speed < a.approach_speed),
+          altitude_quantity="surface_altitude", target_altitude=25, target_speed=27, pitch_sensitivity=1,
+          roll_sensitivity=0.15, gear=True),
+    Phase("rollout", lambda t, a: t.surface_altitude < 2, exit=lambda t, a: t.speed < 1.0,
+          target_altitude=1, target_speed=0, brakes=True),
+)
+
+ALIGNMENT_PHASES = (
+    Phase("M1 pre", lambda t, a: (a.di > 0.75) & (a.heading_offset > 0), roll=-1, half_turn=lambda a: 1.0 - a.di),
+    Phase("M1 post", lambda t, a: (a.di > 0.75) & (a.heading_offset < 0), roll=0),
+    Phase("Z1", lambda t, a: a.di > 8 * a.half_turn, roll=0),
+    Phase("Z2", lambda t, a: (8 * a.half_turn > a.di) & (a.heading_offset < 0), roll=1),
+    Phase("M2", lambda t, a: (8 * a.half_turn > a.di) & (a.heading_offset > 0), roll=0,
+          exit=lambda t, a: a.side * t.roll < 1),
+)
+
+
+class RunwayApproach:
+    """
+    State of one approach, kept from one S-turn to the next rather than on the Vessel: the approach speed, correction
+    angle and minimum correction roll the landing stages change start from the vessel's settings at reset(). Every
+    other attribute is a setpoint of the current S-turn and starts over at start(). The runway and the approach and
+    landing settings are copied from the vessel at reset() as well; any other name the tables use is read from it.
+    """
+    SETTINGS = ("runway_center", "runway_end", "runway_heading", "approach_altitude", "approach_offset",
+                "landing_altitude", "landing_offset")
+
+    def __init__(self, vessel, stages=LANDING_STAGES, phases=ALIGNMENT_PHASES):
+        self.vessel = vessel
+        self.stages = stages
+        self.phases = phases
+        self.reset()
+
+    def __getattr__(self, name):
+        return getattr(self.vessel, name)
+
+    def reset(self):
+        """ Starts a new approach"""
+        for name in self.SETTINGS:
+            setattr(self, name, getattr(self.vessel, name))
+        self.approach_speed = self.vessel.approach_speed
+        self.correction_angle = self.vessel.correction_angle
+        self.min_correction_roll = self.vessel.min_correction_roll
+
+    def start(self, telemetry, altitude_quantity="mean_altitude"):
+        """ Starts an S-turn towards the centre line from the aircraft's side of the runway"""
+        vessel = self.vessel
+        self.side = 1 if telemetry.latitude > vessel.runway_center else -1
+        self.initial_latitude = telemetry.latitude
+        correction_roll = vessel.correction_roll_gain * abs(vessel.runway_center - telemetry.latitude)
+        if telemetry.latitude < vessel.runway_end:
+            self.min_correction_roll = 1.5
+        self.correction_roll = min(max(correction_roll, self.min_correction_roll), vessel.max_correction_roll)
+        self.half_turn = vessel.half_turn_di
+        self.altitude_quantity = altitude_quantity
+        self.target_speed = vessel.cruise_speed
+        self.target_altitude = vessel.cruise_altitude
+        self.pitch_sensitivity = vessel.approach_pitch_sensitivity
+        self.roll_sensitivity = vessel.approach_roll_sensitivity
+        # None leaves the control as it is
+        self.gear = False
+        self.brakes = None
+        self.stage = None
+        self.phase = None
+        self.target_roll = None
+        self.lined_up = False
+
+    def update(self, telemetry):
+        """
+        Evaluates both tables for this tick's snapshot. Returns False once the S-turn is over before the vessel is
+        controlled: it crossed the centre line or came to a stop on the runway. 'lined_up' is set once the vessel is
+        level on the runway heading, after which only pitch and throttle are controlled on this tick.
+        """
+        side = self.side
+        # A tick that matches no alignment phase is in none
+        self.phase = None
+        if side * (telemetry.latitude - self.runway_center) <= 0:
+            return False
+        for stage in self.stages:
+            if stage.entry(telemetry, self):
+                stage.apply(self)
+                self.stage = stage.name
+                if stage.exit is not None and stage.exit(telemetry, self):
+                    return False
+        if side * (telemetry.latitude - self.initial_latitude) > 0:
+            self.initial_latitude = telemetry.latitude
+        self.di = (self.runway_center - telemetry.latitude) / (self.runway_center - self.initial_latitude)
+        # Positive until the aircraft has turned half the correction angle towards the centre line
+        self.heading_offset = side * (telemetry.heading - (self.runway_heading - side * self.correction_angle / 2))
+        self.target_roll = None
+        for phase in self.phases:
+            if phase.entry(telemetry, self):
+                phase.apply(self)
+                self.target_roll = phase.roll * side * self.correction_roll
+                self.lined_up = phase.exit is not None and phase.exit(telemetry, self)
+                if not self.lined_up:
+                    self.phase = phase.name
+                break
+        return True
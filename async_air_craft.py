@@ -0,0 +1,105 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from air_craft import Vessel
+
+
+class AsyncVessel(Vessel):
+    """
+    Asyncio version of the Vessel maneuver API: take_off, cruise, turn and runway_alignment_correction are coroutines
+    with the same arguments and the same guidance as their Vessel counterparts.
+
+    Only the control writes are concurrent. The guidance of a maneuver runs unchanged, as one sequential loop over
+    every axis, on a worker thread; there is no controller per axis. At the end of each tick the control changes of
+    that tick are handed to the event loop and issued concurrently, so the tick waits for the slowest write instead of
+    the sum of all of them. Telemetry is already read from streams without RPCs.
+
+    A kRPC connection sends one request at a time. Axes given a connection of their own, i.e.
+    axis_connections={"pitch": krpc.connect(), "roll": krpc.connect()}, are written over it in parallel with the
+    others; the remaining changes go out through 'conn' as one batch. A lost server takes the axis connections down
+    with 'conn': after reconnect() they are opened again by 'axis_connect', a function of the axis name returning a new
+    connection, or without one the axes are written through the new 'conn'.
+    """
+    def __init__(self, conn, *args, axis_connections=None, axis_connect=None, **kwargs):
+        super().__init__(conn, *args, **kwargs)
+        self.axis_connections = dict(axis_connections or {})
+        self.axis_connect = axis_connect
+        self.axis_controls = {}
+        self.bind_axes()
+        self.write_executor = ThreadPoolExecutor(max_workers=5, thread_name_prefix="control")
+        self.maneuver_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="maneuver")
+        self.loop = None
+
+    def bind_axes(self):
+        """ Takes the control of the active vessel from each axis connection"""
+        self.axis_controls = {control_name: axis_conn.space_center.active_vessel.control
+                              for control_name, axis_conn in self.axis_connections.items()}
+
+    def reconnect(self, conn, ref_frame=None):
+        """ Moves the vessel onto a new connection, as Vessel.reconnect(), and the axes onto new connections of their
+            own or onto 'conn'"""
+        snapshot = super().reconnect(conn, ref_frame)
+        if self.axis_connect is not None:
+            self.axis_connections = {control_name: self.axis_connect(control_name)
+                                     for control_name in self.axis_connections}
+        else:
+            self.axis_connections = {}
+        self.bind_axes()
+        return snapshot
+
+    async def _fly(self, maneuver, *args, **kwargs):
+        self.loop = asyncio.get_running_loop()
+        try:
+            return await self.loop.run_in_executor(self.maneuver_executor, functools.partial(maneuver, *args, **kwargs))
+        finally:
+            self.loop = None
+
+    async def take_off(self, altitude_quantity="mean_altitude"):
+        return await self._fly(super().take_off, altitude_quantity)
+
+    async def cruise(self, altitude_quantity="mean_altitude", longitude_bound=-74.3, direction=1):
+        return await self._fly(super().cruise, altitude_quantity, longitude_bound, direction)
+
+    async def runway_alignment_correction(self, altitude_quantity="mean_altitude", direction=1):
+        return await self._fly(super().runway_alignment_correction, altitude_quantity, direction)
+
+    async def turn(self, altitude_quantity="mean_altitude", heading_limit=260, turning_speed=65, roll_angle=30,
+                   offset=10):
+        return await self._fly(super().turn, altitude_quantity, heading_limit, turning_speed, roll_angle, offset)
+
+    def flush_controls(self):
+        # Called on the maneuver thread; blocks it until every write of the tick has completed
+        if self.loop is None:
+            return super().flush_controls()
+        asyncio.run_coroutine_threadsafe(self.flush_controls_async(), self.loop).result()
+
+    async def flush_controls_async(self):
+        changes = self.controls.changes()
+        shared = {name: value for name, value in changes.items() if name not in self.axis_controls}
+        writes = [self.loop.run_in_executor(self.write_executor, setattr, self.axis_controls[name], name, value)
+                  for name, value in changes.items() if name not in shared]
+        if shared:
+            writes.append(self.loop.run_in_executor(self.write_executor, self.controls.write, shared))
+        await asyncio.gather(*writes)
+        self.controls.mark_sent(changes)
+
+    def close(self):
+        self.telemetry.close()
+        self.write_executor.shutdown()
+        self.maneuver_executor.shutdown()
+
+
+if __name__ == "__main__":
+    import krpc
+
+    async def main():
+        connection = krpc.connect()
+        vessel = AsyncVessel(connection, cruise_altitude=100, cruise_speed=80, time_step=0.005,
+                             cruise_acceleration=150, control_step=0.02,
+                             axis_connections={"pitch": krpc.connect(), "roll": krpc.connect()},
+                             axis_connect=lambda control_name: krpc.connect(name=control_name))
+        await vessel.take_off()
+        await vessel.cruise(longitude_bound=-73.2, direction=-1)
+
+    asyncio.run(main())
@@ -0,0 +1,589 @@
+"""
+Batch simulation
+----------------
+Flies N simulated aircraft at once for Monte-Carlo studies (i.e. spread of initial latitude or heading). Aircraft
+state, telemetry, derivatives and commanded controls are NumPy arrays with one entry per aircraft, and each tick
+evaluates the guidance of every aircraft with array operations instead of one Vessel per aircraft.
+
+The guidance is that of Vessel flying simulator.fly_mission: start_engine, take_off, cruise, turn and
+runway_alignment_correction until stopped. Every aircraft has its own maneuver and phase, and each maneuver's step is
+applied only to the aircraft in it. The module level control laws mirror the Vessel helpers of the same name and
+accept arrays:
+
+    batch = BatchVessel(BatchAircraft(1000, latitude=np.random.normal(-0.0486, 0.001, 1000)))
+    batch.run(time_limit=900)
+    batch.results()["touchdown_latitude"]
+
+Guidance parameters default to those of Vessel and may be given per aircraft, i.e. control_step=np.linspace(...).
+Given the telemetry a Vessel read, one aircraft of a batch commands the same controls on every tick (python
+regression.py batch); flown on its own physics it drifts from the scalar path once turning, as NumPy's trigonometry
+rounds differently from the math module's.
+"""
+
+import inspect
+import math
+
+import numpy as np
+
+from air_craft import GUIDANCE_DEFAULTS, Vessel
+from approach import ALIGNMENT_PHASES, LANDING_STAGES
+from simulator import KERBIN_GRAVITY, KERBIN_RADIUS, RUNWAY_ALTITUDE, Aircraft
+
+MANEUVERS = ("start_engine", "take_off", "cruise", "turn", "runway_alignment_correction", "done")
+START_ENGINE, TAKE_OFF, CRUISE, TURN, APPROACH, DONE = range(len(MANEUVERS))
+PHASES = (None, "M1 pre", "M1 post", "Z1", "Z2", "M2")
+QUANTITIES = ("mean_altitude", "surface_altitude", "roll", "speed")
+VESSEL_ARGUMENTS = ("cruise_altitude", "cruise_speed", "cruise_acceleration", "control_step")
+GUIDANCE_PARAMETERS = VESSEL_ARGUMENTS + (
+    "max_target_speed", "max_take_off_vertical_speed", "lift_off_speed", "runway_center", "runway_end",
+    "runway_heading", "correction_angle", "max_correction_roll", "min_correction_roll", "correction_roll_gain",
+    "half_turn_di", "approach_pitch_sensitivity", "approach_roll_sensitivity", "approach_altitude", "approach_speed",
+    "approach_offset", "landing_altitude", "landing_offset")
+# Arguments simulator.fly_mission passes to the maneuvers
+MISSION_PARAMETERS = {"cruise_longitude_bound": -73.2, "turn_heading_limit": 270, "turning_speed": 80,
+                      "turn_roll_angle": 30, "turn_offset": 15}
+
+
+def quadratic_target_quantity_velocity(value, midpoint, velocity_bound, multiplicity=2, sensitivity=2.0):
+    target_velocity = (value - midpoint) ** multiplicity * velocity_bound / midpoint / (midpoint / sensitivity)
+    target_velocity = np.where(value > midpoint, -target_velocity, target_velocity)
+    return np.clip(target_velocity, -sensitivity * velocity_bound, sensitivity * velocity_bound)
+
+
+def symmetric_quadratic_target_quantity_velocity(value, midpoint, velocity_bound, multiplicity=2,
+                                                 anti_sensitivity=0.1):
+    target_velocity = (value - midpoint) ** multiplicity * velocity_bound / anti_sensitivity
+    target_velocity = np.where(value > midpoint, -target_velocity, target_velocity)
+    return np.clip(target_velocity, -velocity_bound, velocity_bound)
+
+
+def roll_angle_from_heading(heading, initial_heading, final_heading, max_roll, offset=10):
+    roll = (-max_roll / (final_heading - initial_heading) ** 3) * (heading - initial_heading - offset) ** 3 + max_roll
+    return np.where(heading < initial_heading, max_roll, roll)
+
+
+def quadratic_target_angular_control(velocity, velocity_bound, control_magnitude, multiplicity=2, sensitivity=2):
+    control = np.abs((velocity - velocity_bound) ** multiplicity * control_magnitude / velocity_bound /
+                     (velocity_bound / sensitivity))
+    return np.minimum(control, sensitivity * control_magnitude)
+
+
+def angular_control_from_position(derivatives, speed_bound, control, control_magnitude, sensitivity, step_scale=1.0):
+    """ Vessel.angular_control_from_position for arrays: 'derivatives' has one row per order and 'control' holds the
+        current control values. Returns the new, unclamped control values."""
+    decrease = (derivatives[1] > speed_bound) & (derivatives[2] > 0) & (derivatives[3] < 0) & \
+               (derivatives[4] < 0) & (derivatives[5] < 0)
+    increase = (derivatives[1] < speed_bound) & (derivatives[2] < 0) & (derivatives[3] > 0) & \
+               (derivatives[4] > 0) & (derivatives[5] > 0)
+    # Only the aircraft that adjust use the change; the others may divide by a zero speed bound
+    with np.errstate(divide="ignore", invalid="ignore"):
+        change = quadratic_target_angular_control(derivatives[1], speed_bound, control_magnitude,
+                                                  sensitivity=sensitivity) * step_scale
+    return np.where(decrease, control - change, np.where(increase, control + change, control))
+
+
+def control_quantity(derivatives, quantity_bound, time_derivative_bound, control, control_step):
+    """ Vessel.control_quantity for arrays. Returns the new, unclamped control values."""
+    increase = (derivatives[0] < quantity_bound) & (derivatives[1] < time_derivative_bound)
+    return np.where(increase, control + control_step, control - control_step)
+
+
+class BatchDerivativeBuffer:
+    """ DerivativeBuffer of one quantity of every aircraft. Every aircraft is sampled on every update, each at its own
+        time."""
+    def __init__(self, size, order=5, smoothing=None):
+        self.order = order
+        self.smoothing = smoothing
+        self.times = np.zeros((order + 1, size))
+        self.differences = np.zeros((order + 1, size))
+        self.derivatives = np.zeros((order + 1, size))
+        self.count = 0
+        self.index = -1
+
+    @property
+    def warm(self):
+        return self.count > self.order
+
+    def update(self, timestamp, values):
+        if self.count and np.all(timestamp <= self.times[self.index]):
+            return self.derivatives
+        size = self.order + 1
+        self.index = (self.index + 1) % size
+        self.times[self.index] = timestamp
+
+        known = min(self.count, self.order)
+        difference = values
+        factorial = 1
+        raw = [values]
+        # Aircraft whose clock has stopped (i.e. done) get no usable derivatives
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for k in range(1, known + 1):
+                next_difference = (difference - self.differences[k - 1]) / \
+                                  (timestamp - self.times[(self.index - k) % size])
+                self.differences[k - 1] = difference
+                difference = next_difference
+                factorial *= k
+                raw.append(factorial * difference)
+        self.differences[known] = difference
+        self.count += 1
+
+        self.derivatives[0] = values
+        for k in range(1, known + 1):
+            if self.smoothing is None or k > self.count - 2:
+                self.derivatives[k] = raw[k]
+            else:
+                self.derivatives[k] += self.smoothing * (raw[k] - self.derivatives[k])
+        return self.derivatives
+
+
+class BatchAircraft:
+    """ The point-mass model of simulator.Aircraft for N aircraft. Coefficients are those of Aircraft. step() takes
+        one time step per aircraft; an aircraft with a time step of zero is left as it is."""
+    STATE = ("latitude", "longitude", "altitude", "speed", "flight_path_angle", "heading", "roll", "roll_rate",
+             "angle_of_attack", "on_ground")
+    COEFFICIENTS = ("max_thrust", "lift_slope", "zero_lift_drag", "induced_drag", "gear_drag", "incidence",
+                    "max_angle_of_attack", "angle_of_attack_lag", "max_roll_rate", "roll_rate_lag",
+                    "rolling_friction", "brake_deceleration")
+
+    def __init__(self, size, latitude=-0.0486, longitude=-74.72, heading=90.0, terrain_altitude=RUNWAY_ALTITUDE):
+        reference = Aircraft()
+        for name in self.COEFFICIENTS:
+            setattr(self, name, getattr(reference, name))
+        self.size = size
+        self.latitude = np.full(size, latitude, dtype=float)
+        self.longitude = np.full(size, longitude, dtype=float)
+        self.terrain_altitude = np.full(size, terrain_altitude, dtype=float)
+        self.altitude = self.terrain_altitude.copy()
+        self.speed = np.zeros(size)
+        self.flight_path_angle = np.zeros(size)
+        self.heading = np.radians(np.full(size, heading, dtype=float))
+        self.roll = np.zeros(size)
+        self.roll_rate = np.zeros(size)
+        self.angle_of_attack = np.zeros(size)
+        self.on_ground = np.ones(size, dtype=bool)
+        self.touchdown_time = np.full(size, np.nan)
+        self.touchdown_latitude = np.full(size, np.nan)
+        self.touchdown_longitude = np.full(size, np.nan)
+        self.touchdown_vertical_speed = np.full(size, np.nan)
+
+    def set_airborne(self, altitude, speed):
+        """ Puts every aircraft in level flight at 'altitude' above the terrain, i.e. to start at the approach"""
+        self.altitude = self.terrain_altitude + altitude
+        self.speed = np.full(self.size, speed, dtype=float)
+        self.on_ground[:] = False
+
+    @property
+    def surface_altitude(self):
+        return self.altitude - self.terrain_altitude
+
+    @property
+    def velocity(self):
+        horizontal = self.speed * np.cos(self.flight_path_angle)
+        return (self.speed * np.sin(self.flight_path_angle), horizontal * np.cos(self.heading),
+                horizontal * np.sin(self.heading))
+
+    def step(self, dt, throttle, pitch, roll, gear, brakes, engine_active, ut):
+        idle = dt <= 0
+        if idle.any():
+            previous = {name: getattr(self, name).copy() for name in self.STATE}
+        target_angle_of_attack = self.incidence + pitch * self.max_angle_of_attack
+        self.angle_of_attack += (target_angle_of_attack - self.angle_of_attack) * \
+            np.minimum(dt / self.angle_of_attack_lag, 1)
+
+        lift = self.lift_slope * self.speed ** 2 * self.angle_of_attack
+        drag = self.speed ** 2 * (self.zero_lift_drag + self.induced_drag * self.angle_of_attack ** 2 +
+                                  np.where(gear, self.gear_drag, 0))
+        thrust = np.where(engine_active, self.max_thrust * throttle, 0)
+        acceleration = thrust - drag - KERBIN_GRAVITY * np.sin(self.flight_path_angle)
+
+        self.on_ground &= ~(lift > KERBIN_GRAVITY)
+        ground = self.on_ground
+        ground_acceleration = acceleration - (self.rolling_friction + np.where(brakes, self.brake_deceleration, 0))
+        ground_acceleration = np.where((self.speed <= 0) & (ground_acceleration < 0), 0, ground_acceleration)
+        acceleration = np.where(ground, ground_acceleration, acceleration)
+
+        target_roll_rate = roll * self.max_roll_rate
+        roll_rate = self.roll_rate + (target_roll_rate - self.roll_rate) * np.minimum(dt / self.roll_rate_lag, 1)
+        self.roll = np.where(ground, 0.0, (self.roll + roll_rate * dt + math.pi) % (2 * math.pi) - math.pi)
+        self.roll_rate = np.where(ground, 0.0, roll_rate)
+        flying = ~ground & (self.speed > 1)
+        cos_path = np.cos(self.flight_path_angle)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            flight_path_angle = self.flight_path_angle + \
+                (lift * np.cos(self.roll) - KERBIN_GRAVITY * cos_path) / self.speed * dt
+            heading = (self.heading + lift * np.sin(self.roll) / (self.speed * np.maximum(cos_path, 0.1)) * dt) % \
+                (2 * math.pi)
+        self.flight_path_angle = np.where(flying, flight_path_angle, self.flight_path_angle)
+        self.heading = np.where(flying, heading, self.heading)
+
+        self.speed = np.maximum(self.speed + acceleration * dt, 0.0)
+        up, north, east = self.velocity
+        self.altitude += up * dt
+        self.latitude += np.degrees(north * dt / KERBIN_RADIUS)
+        self.longitude += np.degrees(east * dt / (KERBIN_RADIUS * np.cos(np.radians(self.latitude))))
+
+        if idle.any():
+            for name, values in previous.items():
+                setattr(self, name, np.where(idle, values, getattr(self, name)))
+        landing = ~self.on_ground & (self.altitude <= self.terrain_altitude)
+        first = landing & np.isnan(self.touchdown_time)
+        self.touchdown_time[first] = ut[first]
+        self.touchdown_latitude[first] = self.latitude[first]
+        self.touchdown_longitude[first] = self.longitude[first]
+        self.touchdown_vertical_speed[first] = up[first]
+        self.altitude = np.where(landing, self.terrain_altitude, self.altitude)
+        self.flight_path_angle = np.where(landing, 0.0, self.flight_path_angle)
+        self.on_ground |= landing
+
+
+class BatchVessel:
+    """
+    The guidance of Vessel over a BatchAircraft. Each tick, step() runs one guidance step for every aircraft in the
+    maneuver it is in, then advances the physics. Like Vessel, an aircraft whose maneuver ends moves on to the next
+    maneuver within the same tick, and each aircraft keeps the deadlines of its own TickScheduler (re-anchored at the
+    start of every maneuver) and the step scale that follows from them. An aircraft therefore sees the same time steps
+    as it would flying alone.
+
+    Sensor noise is drawn from a seeded generator, or from 'noise', a function returning an array of 3 rows (mean
+    altitude, surface altitude and roll) of one value per aircraft.
+    """
+    def __init__(self, aircraft, time_step=0.005, physics_step=0.02, sensor_noise=0.0001, seed=0, noise=None,
+                 start="take_off", derivative_smoothing=None, max_passes=8, **parameters):
+        self.aircraft = aircraft
+        size = self.size = aircraft.size
+        self.t = time_step
+        self.physics_step = physics_step
+        self.sensor_noise = sensor_noise
+        self.random = np.random.default_rng(seed)
+        self.noise = noise if noise is not None else self._noise
+        self.max_passes = max_passes
+        self.max_step_scale = 4
+        unknown = set(parameters) - set(GUIDANCE_PARAMETERS) - set(MISSION_PARAMETERS)
+        if unknown:
+            raise TypeError(f"Unknown guidance parameters: {', '.join(sorted(unknown))}")
+        # Defaults are those of Vessel: its constructor's and air_craft.GUIDANCE_DEFAULTS
+        defaults = dict(GUIDANCE_DEFAULTS)
+        constructor = inspect.signature(Vessel).parameters
+        defaults.update((name, constructor[name].default) for name in VESSEL_ARGUMENTS)
+        defaults["approach_altitude"] = parameters.get("cruise_altitude", defaults["cruise_altitude"])
+        for name in GUIDANCE_PARAMETERS:
+            setattr(self, name, np.full(size, parameters.get(name, defaults[name]), dtype=float))
+        for name, value in MISSION_PARAMETERS.items():
+            setattr(self, name, np.full(size, parameters.get(name, value), dtype=float))
+
+        # Game time and scheduler state of every aircraft
+        self.ut = np.zeros(size)
+        self.last_tick = np.zeros(size)
+        self.deadline = self.ut + time_step
+        self.dt = np.full(size, time_step)
+        self.ticks = 0
+        self.time_limit = None
+        self.timed_out = np.zeros(size, dtype=bool)
+        # take_off starts with start_engine; the other maneuvers start in flight with the engine running
+        self.maneuver = np.full(size, START_ENGINE if start == "take_off" else MANEUVERS.index(start))
+        self.begun = np.zeros(size, dtype=bool)
+        self.started = np.zeros(size, dtype=bool)
+        self.phase = np.zeros(size, dtype=np.int8)
+        self.throttle = np.zeros(size)
+        self.pitch = np.zeros(size)
+        self.roll = np.zeros(size)
+        self.gear = np.ones(size, dtype=bool)
+        self.brakes = np.ones(size, dtype=bool)
+        self.engine_active = np.full(size, start != "take_off")
+        self.peak_roll = np.zeros(size)
+        # Local state of the maneuvers
+        self.initial_heading = np.zeros(size)
+        self.side = np.ones(size)
+        self.initial_latitude = np.zeros(size)
+        self.correction_roll = np.zeros(size)
+        self.half_turn = np.zeros(size)
+        self.target_speed = np.zeros(size)
+        self.target_altitude = np.zeros(size)
+        self.pitch_sensitivity = np.zeros(size)
+        self.roll_sensitivity = np.zeros(size)
+        self.use_surface_altitude = np.zeros(size, dtype=bool)
+
+        self.derivatives = {quantity_name: BatchDerivativeBuffer(size, 5, derivative_smoothing)
+                            for quantity_name in QUANTITIES}
+        self.update_telemetry()
+
+    def _noise(self):
+        if not self.sensor_noise:
+            return np.zeros((3, self.size))
+        return self.random.normal(0.0, self.sensor_noise, (3, self.size))
+
+    @property
+    def step_scale(self):
+        return np.minimum(self.dt / self.t, self.max_step_scale)
+
+    @property
+    def warm(self):
+        return all(buffer.warm for buffer in self.derivatives.values())
+
+    def update_telemetry(self):
+        aircraft = self.aircraft
+        noise = self.noise()
+        self.flight = {"speed": aircraft.speed.copy(), "mean_altitude": aircraft.altitude + noise[0],
+                       "surface_altitude": aircraft.surface_altitude + noise[1], "latitude": aircraft.latitude.copy(),
+                       "longitude": aircraft.longitude.copy(), "heading": np.degrees(aircraft.heading),
+                       "roll": np.degrees(aircraft.roll) + noise[2]}
+        for quantity_name, buffer in self.derivatives.items():
+            buffer.update(self.ut, self.flight[quantity_name])
+        np.maximum(self.peak_roll, np.abs(self.flight["roll"]), out=self.peak_roll)
+
+    def step(self):
+        """ One tick: the guidance step of every aircraft still flying, then the physics up to each one's deadline"""
+        ticked = (self.maneuver == DONE) | self.timed_out
+        flying = ~ticked
+        self._begin(np.flatnonzero(flying & ~self.begun))
+        if self.warm:
+            steps = ((START_ENGINE, self._start_engine), (TAKE_OFF, self._take_off), (CRUISE, self._cruise),
+                     (TURN, self._turn), (APPROACH, self._runway_alignment_correction))
+            for _ in range(self.max_passes):
+                if ticked.all():
+                    break
+                for maneuver, maneuver_step in steps:
+                    i = np.flatnonzero(~ticked & (self.maneuver == maneuver))
+                    if len(i):
+                        maneuver_step(i, ticked)
+        # Otherwise every maneuver's warm_up() ticks without adjusting the controls
+        flying &= self.maneuver != DONE
+
+        # The TickScheduler of each aircraft sleeps to its deadline; game time advances in physics steps meanwhile
+        seconds = np.where(flying, self.deadline - self.ut, 0.0)
+        while (seconds > 0).any():
+            dt = np.where(seconds > 0, np.minimum(seconds, self.physics_step), 0.0)
+            self.ut += dt
+            self.aircraft.step(dt, self.throttle, self.pitch, self.roll, self.gear, self.brakes, self.engine_active,
+                               self.ut)
+            seconds -= dt
+        self.deadline[flying] += self.t
+        self.dt[flying] = self.ut[flying] - self.last_tick[flying]
+        self.last_tick[flying] = self.ut[flying]
+        if self.time_limit is not None:
+            self.timed_out |= flying & (self.ut > self.time_limit)
+        self.ticks += 1
+        self.update_telemetry()
+
+    def run(self, time_limit=900):
+        """ Ticks until every aircraft is done or past 'time_limit' seconds of game time"""
+        self.time_limit = time_limit
+        while not ((self.maneuver == DONE) | self.timed_out).all():
+            self.step()
+
+    def results(self):
+        aircraft = self.aircraft
+        return {"maneuver": np.array(MANEUVERS)[self.maneuver], "timed_out": self.timed_out,
+                "touchdown_time": aircraft.touchdown_time, "touchdown_latitude": aircraft.touchdown_latitude,
+                "touchdown_longitude": aircraft.touchdown_longitude,
+                "touchdown_vertical_speed": aircraft.touchdown_vertical_speed,
+                "touchdown_error": np.radians(np.abs(aircraft.touchdown_latitude - self.runway_center)) * KERBIN_RADIUS,
+                "peak_roll": self.peak_roll, "ut": self.ut, "ticks": self.ticks}
+
+    # Control helpers over the aircraft 'i'
+    def _control_speed(self, i, speed):
+        self.throttle[i] = control_quantity(self.derivatives["speed"].derivatives[:, i], speed,
+                                            self.cruise_acceleration[i], self.throttle[i],
+                                            self.control_step[i] * self.step_scale[i]).clip(0.0, 1.0)
+
+    def _control_pitch(self, i, derivatives, target_climb_speed, sensitivity):
+        self.pitch[i] = angular_control_from_position(derivatives, target_climb_speed, self.pitch[i],
+                                                      self.control_step[i], sensitivity,
+                                                      self.step_scale[i]).clip(-1.0, 1.0)
+
+    def _control_roll(self, i, target_roll_speed, control_magnitude, sensitivity):
+        self.roll[i] = angular_control_from_position(self.derivatives["roll"].derivatives[:, i], target_roll_speed,
+                                                     self.roll[i], control_magnitude, sensitivity,
+                                                     self.step_scale[i]).clip(-1.0, 1.0)
+
+    def _begin(self, i):
+        # Vessel.begin_maneuver() and the control changes each maneuver makes before warming up
+        self.last_tick[i] = self.ut[i]
+        self.deadline[i] = self.ut[i] + self.t
+        self.engine_active[i[self.maneuver[i] == START_ENGINE]] = True
+        self.brakes[i[self.maneuver[i] == START_ENGINE]] = False
+        self.gear[i[self.maneuver[i] >= CRUISE]] = False
+        self.begun[i] = True
+
+    def _end(self, i, next_maneuver):
+        self.maneuver[i] = next_maneuver
+        self.begun[i] = False
+        self.started[i] = False
+        self.phase[i] = 0
+
+    def _start_engine(self, i, ticked):
+        self._begin(i[~self.begun[i]])
+        running = self.flight["speed"][i] < self.lift_off_speed[i]
+        self._end(i[~running], TAKE_OFF)
+        i = i[running]
+        self._control_speed(i, self.cruise_speed[i])
+        ticked[i] = True
+
+    def _take_off(self, i, ticked):
+        self._begin(i[~self.begun[i]])
+        running = self.flight["mean_altitude"][i] < self.cruise_altitude[i]
+        self._end(i[~running], CRUISE)
+        i = i[running]
+        self._control_speed(i, self.cruise_speed[i])
+        self._control_pitch(i, self.derivatives["mean_altitude"].derivatives[:, i],
+                            self.max_take_off_vertical_speed[i], 1)
+        ticked[i] = True
+
+    def _cruise(self, i, ticked):
+        self._begin(i[~self.begun[i]])
+        running = self.flight["longitude"][i] < self.cruise_longitude_bound[i]
+        self._end(i[~running], TURN)
+        i = i[running]
+        self._control_speed(i, self.cruise_speed[i])
+        target_climb_speed = quadratic_target_quantity_velocity(self.flight["mean_altitude"][i],
+                                                                self.cruise_altitude[i], self.max_target_speed[i])
+        target_roll_speed = symmetric_quadratic_target_quantity_velocity(self.flight["roll"][i], 0,
+                                                                         self.max_target_speed[i] / 4,
+                                                                         anti_sensitivity=0.1)
+        self._control_pitch(i, self.derivatives["mean_altitude"].derivatives[:, i], target_climb_speed, 2)
+        self._control_roll(i, target_roll_speed, self.control_step[i] / 10, 0.5)
+        ticked[i] = True
+
+    def _turn(self, i, ticked):
+        self._begin(i[~self.begun[i]])
+        start = i[~self.started[i]]
+        self.initial_heading[start] = self.flight["heading"][start]
+        self.started[start] = True
+        running = self.flight["heading"][i] < self.turn_heading_limit[i]
+        self._end_approach_or_finish(i[~running])
+        i = i[running]
+        self._control_speed(i, self.turning_speed[i])
+        target_climb_speed = quadratic_target_quantity_velocity(self.flight["mean_altitude"][i],
+                                                                self.cruise_altitude[i], self.max_target_speed[i])
+        roll = roll_angle_from_heading(self.flight["heading"][i], self.initial_heading[i], self.turn_heading_limit[i],
+                                       self.turn_roll_angle[i], self.turn_offset[i])
+        target_roll_speed = symmetric_quadratic_target_quantity_velocity(self.flight["roll"][i], roll,
+                                                                         self.max_target_speed[i] / 4,
+                                                                         anti_sensitivity=0.1)
+        self._control_pitch(i, self.derivatives["mean_altitude"].derivatives[:, i], target_climb_speed, 2.5)
+        self._control_roll(i, target_roll_speed, self.control_step[i] / 10, 0.5)
+        ticked[i] = True
+
+    def _end_approach_or_finish(self, i):
+        # fly_mission repeats runway_alignment_correction until the aircraft has stopped
+        moving = self.flight["speed"][i] > 1.0
+        self._end(i[moving], APPROACH)
+        self._end(i[~moving], DONE)
+
+    def _start_runway_alignment_correction(self, i):
+        flight = self.flight
+        latitude = flight["latitude"][i]
+        self.initial_latitude[i] = latitude
+        correction_roll = self.correction_roll_gain[i] * np.abs(self.runway_center[i] - latitude)
+        self.min_correction_roll[i] = np.where(latitude < self.runway_end[i], 1.5, self.min_correction_roll[i])
+        correction_roll = np.where(correction_roll > self.max_correction_roll[i], self.max_correction_roll[i],
+                                   np.where(correction_roll < self.min_correction_roll[i],
+                                            self.min_correction_roll[i], correction_roll))
+        self.correction_roll[i] = correction_roll
+        self.half_turn[i] = self.half_turn_di[i]
+        self.target_speed[i] = self.cruise_speed[i]
+        self.target_altitude[i] = self.cruise_altitude[i]
+        self.pitch_sensitivity[i] = self.approach_pitch_sensitivity[i]
+        self.roll_sensitivity[i] = self.approach_roll_sensitivity[i]
+        self.use_surface_altitude[i] = False
+        # The S-turn is flown towards the runway's centre line from whichever side the aircraft is on
+        self.side[i] = np.where(latitude > self.runway_center[i], 1.0, -1.0)
+        self.started[i] = True
+
+    def _runway_alignment_correction(self, i, ticked):
+        # The phase tables of approach.py, evaluated with a mask per phase
+        flight = self.flight
+        self._begin(i[~self.begun[i]])
+        self._start_runway_alignment_correction(i[~self.started[i]])
+        # A tick that matches no alignment phase is in none
+        self.phase[i] = 0
+        side = self.side[i]
+        running = side * (flight["latitude"][i] - self.runway_center[i]) > 0
+        self._end_approach_or_finish(i[~running])
+        i = i[running]
+
+        telemetry = _Selection(flight.__getitem__, i)
+        state = _Selection(self._array, i)
+        stopped = np.zeros(len(i), dtype=bool)
+        for stage in LANDING_STAGES:
+            entered = stage.entry(telemetry, state)
+            if entered.any():
+                self._apply(stage, state.select(entered))
+                if stage.exit is not None:
+                    stopped |= entered & stage.exit(telemetry, state)
+        self._end(i[stopped], DONE)
+        i = i[~stopped]
+
+        surface = self.use_surface_altitude[i]
+        altitude = np.where(surface, flight["surface_altitude"][i], flight["mean_altitude"][i])
+        derivatives = np.where(surface, self.derivatives["surface_altitude"].derivatives[:, i],
+                               self.derivatives["mean_altitude"].derivatives[:, i])
+        target_climb_speed = quadratic_target_quantity_velocity(altitude, self.target_altitude[i],
+                                                                self.max_target_speed[i])
+        self._control_pitch(i, derivatives, target_climb_speed, self.pitch_sensitivity[i])
+        self._control_speed(i, self.target_speed[i])
+
+        side = self.side[i]
+        latitude = flight["latitude"][i]
+        initial_latitude = np.where(side * (latitude - self.initial_latitude[i]) > 0, latitude,
+                                    self.initial_latitude[i])
+        self.initial_latitude[i] = initial_latitude
+        telemetry = _Selection(flight.__getitem__, i)
+        state = _Selection(self._array, i)
+        state.di = (self.runway_center[i] - latitude) / (self.runway_center[i] - initial_latitude)
+        state.heading_offset = side * (flight["heading"][i] - (self.runway_heading[i] - side *
+                                                               self.correction_angle[i] / 2))
+        roll_midpoint = np.zeros(len(i))
+        matched = np.zeros(len(i), dtype=bool)
+        lined_up = np.zeros(len(i), dtype=bool)
+        for phase in ALIGNMENT_PHASES:
+            entered = phase.entry(telemetry, state) & ~matched
+            if not entered.any():
+                continue
+            matched |= entered
+            roll_midpoint[entered] = phase.roll * side[entered] * self.correction_roll[i[entered]]
+            self._apply(phase, state.select(entered))
+            if phase.exit is not None:
+                exits = entered & phase.exit(telemetry, state)
+                lined_up |= exits
+                entered &= ~exits
+            self.phase[i[entered]] = PHASES.index(phase.name)
+        target_roll_speed = np.where(matched, symmetric_quadratic_target_quantity_velocity(
+            flight["roll"][i], roll_midpoint, self.max_target_speed[i] / 4, anti_sensitivity=0.1), 0.0)
+        # Level once lined up: the S-turn is over and runway_alignment_correction starts again
+        self._end_approach_or_finish(i[lined_up])
+        keep = ~lined_up
+        i = i[keep]
+        self._control_roll(i, target_roll_speed[keep], self.control_step[i] / 8, self.roll_sensitivity[i])
+        ticked[i] = True
+
+    def _array(self, name):
+        return getattr(self, name)
+
+    def _apply(self, phase, state):
+        """ Phase.apply for the aircraft of 'state'"""
+        for name, value in phase.setpoints.items():
+            if callable(value):
+                value = value(state)
+            if name == "altitude_quantity":
+                self.use_surface_altitude[state.index] = value == "surface_altitude"
+            else:
+                getattr(self, name)[state.index] = value
+
+
+class _Selection:
+    """ Attribute access to the entries 'index' of named per-aircraft arrays, as the phase tables expect. Values
+        computed for these entries alone are set as attributes."""
+    def __init__(self, lookup, index):
+        self.lookup = lookup
+        self.index = index
+
+    def __getattr__(self, name):
+        return self.lookup(name)[self.index]
+
+    def select(self, mask):
+        selection = _Selection(self.lookup, self.index[mask])
+        for name, value in vars(self).items():
+            if name not in ("lookup", "index"):
+                setattr(selection, name, value[mask])
+        return selection
@@ -0,0 +1,308 @@
+"""
+Benchmarks
+----------
+Throughput and latency of the control loop against the in-process simulator, with a configurable latency injected
+into every remote call the vessel makes. Each maneuver method is flown for a fixed number of ticks from a suitable
+starting state, and each helper method is called repeatedly on a warmed-up vessel. Reported per benchmark:
+
+    rate              ticks (maneuvers) or calls (helpers) per second of wall time
+    p50, p99          seconds per tick or call
+    rpcs_per_tick     remote calls per tick or call, counted by profiler.Profiler
+    blocks_per_tick   memory blocks still allocated afterwards per tick or call (growth of sys.getallocatedblocks();
+                      CPython has no cheap count of every allocation, so this catches retained garbage, i.e. a list
+                      growing every tick, rather than churn)
+
+A tick includes the simulator's physics, which stand in for the sleep. Results are saved as JSON; compare checks them
+against the baseline kept in the repository and exits with status 1 if any benchmark makes more remote calls or
+retains more blocks per tick. These counts are the same on every run and every machine. Wall-time figures can differ
+twofold between runs on a shared machine, so rate, p50 and p99 are only checked with --timing, against a baseline
+taken on the same machine and with a threshold above that spread:
+
+    python benchmark.py run --output results.json
+    python benchmark.py compare results.json
+    python benchmark.py compare results.json --timing --threshold 1.5
+    python benchmark.py run --output benchmark_baseline.json
+"""
+
+import argparse
+import array
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+
+from air_craft import Vessel
+from mission import land
+from profiler import Profiler
+from simulator import Aircraft, SimulatedConnection
+
+BASELINE_PATH = "benchmark_baseline.json"
+VESSEL_SETTINGS = {"cruise_altitude": 100, "cruise_speed": 80, "time_step": 0.005, "cruise_acceleration": 150,
+                   "control_step": 0.02}
+# Lower is better for these; rate is the only figure where higher is better
+LATENCY_FIELDS = ("p50", "p99")
+COUNT_FIELDS = ("rpcs_per_tick", "blocks_per_tick")
+
+
+class BenchmarkFinished(Exception):
+    """Raised by TickTimer once the benchmark has taken its ticks"""
+
+
+class LatencyControl:
+    """ The control object as seen over a slow link: every attribute read or write waits 'latency' seconds first"""
+    def __init__(self, control, latency):
+        object.__setattr__(self, "_control", control)
+        object.__setattr__(self, "_latency", latency)
+
+    def __getattr__(self, name):
+        if not name.startswith("_"):
+            time.sleep(self._latency)
+        return getattr(self._control, name)
+
+    def __setattr__(self, name, value):
+        time.sleep(self._latency)
+        setattr(self._control, name, value)
+
+
+class TickTimer:
+    """ Takes the time of every tick, in place of a FlightRecorder, and ends the benchmark after 'ticks' of them. The
+        times go into a preallocated array, so timing allocates nothing."""
+    def __init__(self, ticks):
+        self.ticks = ticks
+        self.times = array.array("d", bytes(8 * (ticks + 1)))
+        self.count = 0
+
+    def record(self, vessel):
+        if self.count > self.ticks:
+            raise BenchmarkFinished
+        self.times[self.count] = time.perf_counter()
+        self.count += 1
+
+    def close(self):
+        pass
+
+    def durations(self):
+        times = self.times[:self.count]
+        return [end - start for start, end in zip(times, times[1:])]
+
+
+def airborne(latitude=-0.0486, longitude=-74.72, heading=90.0, altitude=100, speed=80):
+    aircraft = Aircraft(latitude=latitude, longitude=longitude, heading=heading)
+    aircraft.on_ground = False
+    aircraft.altitude += altitude
+    aircraft.speed = speed
+    return aircraft
+
+
+# Benchmarked maneuvers: starting state of the aircraft and how the maneuver is flown
+MANEUVERS = {
+    "start_engine": (Aircraft, Vessel.start_engine),
+    "take_off": (Aircraft, Vessel.take_off),
+    "cruise": (airborne, lambda vessel: vessel.cruise(longitude_bound=-60)),
+    "turn": (airborne, lambda vessel: vessel.turn(heading_limit=270, turning_speed=100, roll_angle=45, offset=15)),
+    "runway_alignment_correction": (lambda: airborne(latitude=-0.046, longitude=-73.3, heading=270), land),
+}
+# Benchmarked helpers, called on a vessel in cruise
+HELPERS = {
+    "get_time_derivatives": lambda vessel: vessel.get_time_derivatives("mean_altitude"),
+    "angular_control_from_position": lambda vessel: vessel.angular_control_from_position("roll", 1.0, "roll", 0.002,
+                                                                                         sensitivity=0.5),
+    "control_quantity": lambda vessel: vessel.control_quantity("speed", 80, 150, "throttle"),
+    "get_quadratic_target_quantity_velocity":
+        lambda vessel: vessel.get_quadratic_target_quantity_velocity("mean_altitude", 100, 100),
+    "get_symmetric_quadratic_target_quantity_velocity":
+        lambda vessel: vessel.get_symmetric_quadratic_target_quantity_velocity("roll", 0, 25),
+    "get_quadratic_target_angular_control": lambda vessel: vessel.get_quadratic_target_angular_control(5.0, 10.0, 0.02),
+    "get_roll_angle_from_heading": lambda vessel: vessel.get_roll_angle_from_heading(90, 270, 45),
+}
+
+
+def make_vessel(aircraft, latency, ticks, backend="simulator"):
+    """ A profiled vessel flying 'aircraft', and a function that shuts its backend down. On the loopback backend the
+        latency is added by the server to every message it sends, see loopback.LinkProfile."""
+    conn = SimulatedConnection(aircraft=aircraft)
+    shutdown = conn.close
+    if not aircraft.on_ground:
+        conn.space_center.active_vessel.control.engine_active = True
+    if backend == "loopback":
+        import krpc
+
+        from loopback import LinkProfile, LoopbackServer
+
+        server = LoopbackServer(conn, rpc_port=0, stream_port=0, link=LinkProfile(latency)).start()
+        conn = krpc.connect(name="benchmark", rpc_port=server.rpc_port, stream_port=server.stream_port)
+
+        def shutdown():
+            conn.close()
+            server.close()
+    timer = TickTimer(ticks)
+    vessel = Vessel(conn, metrics_interval=None, recorder=timer, **VESSEL_SETTINGS)
+    vessel.engine_started = not aircraft.on_ground
+    if latency and backend == "simulator":
+        vessel.controls.control = LatencyControl(vessel.controls.control, latency)
+    profiler = Profiler().attach(vessel, conn)
+    return vessel, timer, profiler, shutdown
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def result(name, kind, backend, latency, durations, seconds, calls, blocks):
+    """ 'durations' are seconds per tick or call, 'seconds' the time all of them took"""
+    count = len(durations)
+    return {"name": name, "kind": kind, "backend": backend, "latency": latency, "count": count,
+            "rate": count / seconds if seconds else 0.0, "p50": percentile(durations, 0.5),
+            "p99": percentile(durations, 0.99), "rpcs_per_tick": calls / count if count else 0.0,
+            "blocks_per_tick": blocks / count if count else 0.0}
+
+
+def run_maneuver(name, latency=0.0, ticks=2000, backend="simulator"):
+    make_aircraft, fly = MANEUVERS[name]
+    vessel, timer, profiler, shutdown = make_vessel(make_aircraft(), latency, ticks, backend)
+    blocks = sys.getallocatedblocks()
+    # The maneuvers print their progress
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            fly(vessel)
+        except BenchmarkFinished:
+            pass
+    blocks = sys.getallocatedblocks() - blocks
+    profiler.detach()
+    shutdown()
+    durations = timer.durations()
+    return result(name, "maneuver", backend, latency, durations, sum(durations),
+                  profiler.summary()["totals"]["calls"], blocks)
+
+
+def run_helper(name, calls=20000, batch=100):
+    """ Times 'calls' calls in batches of 'batch', so the timer's own cost is spread over the batch. Percentiles are
+        those of the batch means."""
+    vessel, timer, profiler, shutdown = make_vessel(airborne(), 0.0, 1000)
+    with contextlib.redirect_stdout(io.StringIO()):
+        vessel.begin_maneuver("cruise")
+        vessel.warm_up("mean_altitude", "roll", "speed")
+    helper = HELPERS[name]
+    batches = array.array("d", bytes(8 * (calls // batch)))
+    blocks = sys.getallocatedblocks()
+    for i in range(len(batches)):
+        start = time.perf_counter()
+        for _ in range(batch):
+            helper(vessel)
+        batches[i] = (time.perf_counter() - start) / batch
+    blocks = sys.getallocatedblocks() - blocks
+    profiler.detach()
+    shutdown()
+    durations = [duration for duration in batches for _ in range(batch)]
+    return result(name, "helper", "simulator", 0.0, durations, sum(batches) * batch,
+                  profiler.summary()["totals"]["calls"], blocks)
+
+
+def fastest(benchmark, repeat, *args):
+    """ The run of 'benchmark' with the highest rate out of 'repeat', as timeit does: slower runs measure whatever
+        else the machine was doing"""
+    return max((benchmark(*args) for _ in range(repeat)), key=lambda entry: entry["rate"])
+
+
+def run(latencies=(0.0, 0.001), ticks=2000, calls=20000, names=None, repeat=3, backend="simulator"):
+    """ Maneuvers on 'backend', "simulator" or "loopback"; the helpers make no remote calls and run only on the
+        simulator"""
+    results = []
+    for name in MANEUVERS:
+        if names is None or name in names:
+            for latency in latencies:
+                results.append(fastest(run_maneuver, repeat, name, latency, ticks, backend))
+    for name in HELPERS:
+        if backend == "simulator" and (names is None or name in names):
+            results.append(fastest(run_helper, repeat, name, calls))
+    return {"machine": {"python": platform.python_version(), "platform": platform.platform(),
+                        "processor": platform.processor()}, "results": results}
+
+
+def _key(entry):
+    return entry["name"], entry.get("backend", "simulator"), entry["latency"]
+
+
+def compare(results, baseline, threshold=0.15, timing=False):
+    """
+    Regressions of 'results' against 'baseline': more remote calls or retained blocks per tick and, with 'timing', a
+    rate more than 'threshold' lower or a p50 or p99 more than 'threshold' higher. Benchmarks missing from either are
+    skipped.
+    """
+    expected = {_key(entry): entry for entry in baseline["results"]}
+    regressions = []
+    for entry in results["results"]:
+        base = expected.get(_key(entry))
+        if base is None:
+            continue
+        if timing:
+            if entry["rate"] < base["rate"] * (1 - threshold):
+                regressions.append((entry, "rate", base["rate"]))
+            for field in LATENCY_FIELDS:
+                if entry[field] > base[field] * (1 + threshold):
+                    regressions.append((entry, field, base[field]))
+        for field in COUNT_FIELDS:
+            # Counts are deterministic; allow a little for the interpreter's own allocations
+            if entry[field] > base[field] + (0.01 if field == "rpcs_per_tick" else 0.1):
+                regressions.append((entry, field, base[field]))
+    return regressions
+
+
+def format_results(results):
+    lines = [f"{'benchmark':<50}{'backend':>10}{'latency':>9}{'rate/s':>11}{'p50 us':>10}{'p99 us':>10}"
+             f"{'rpc/tick':>10}{'blocks/tick':>13}"]
+    for entry in results["results"]:
+        lines.append(f"{entry['name']:<50}{entry.get('backend', 'simulator'):>10}"
+                     f"{entry['latency'] * 1000:>7.2f}ms{entry['rate']:>11.0f}"
+                     f"{entry['p50'] * 1e6:>10.1f}{entry['p99'] * 1e6:>10.1f}{entry['rpcs_per_tick']:>10.2f}"
+                     f"{entry['blocks_per_tick']:>13.3f}")
+    return "\n".join(lines)
+
+
+def format_regressions(regressions):
+    if not regressions:
+        return "No regressions"
+    return "\n".join(f"REGRESSION {entry['name']} ({entry.get('backend', 'simulator')}, latency "
+                     f"{entry['latency'] * 1000:.2f} ms): {field} "
+                     f"{entry[field]:.6g}, baseline {expected:.6g}" for entry, field, expected in regressions)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the control loop against the simulator")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--latency", type=float, nargs="+", default=[0.0, 0.001],
+                            help="seconds injected into every remote call")
+    run_parser.add_argument("--ticks", type=int, default=2000, help="ticks per maneuver benchmark")
+    run_parser.add_argument("--calls", type=int, default=20000, help="calls per helper benchmark")
+    run_parser.add_argument("--only", nargs="+", help="names of the benchmarks to run")
+    run_parser.add_argument("--backend", choices=("simulator", "loopback"), default="simulator",
+                            help="fly the maneuvers in-process or over TCP through loopback.LoopbackServer")
+    run_parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the fastest is kept")
+    run_parser.add_argument("--output", help="save the results to this JSON file")
+    compare_parser = commands.add_parser("compare", help="compare saved results against the baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--baseline", default=BASELINE_PATH)
+    compare_parser.add_argument("--threshold", type=float, default=0.15, help="allowed relative slowdown")
+    compare_parser.add_argument("--timing", action="store_true",
+                                help="also check rate, p50 and p99 against a baseline from this machine")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        benchmark_results = run(args.latency, args.ticks, args.calls, args.only, args.repeat,
+                                args.backend)
+        print(format_results(benchmark_results))
+        if args.output:
+            with open(args.output, "w") as output_file:
+                json.dump(benchmark_results, output_file, indent=2)
+    else:
+        with open(args.results) as results_file, open(args.baseline) as baseline_file:
+            found = compare(json.load(results_file), json.load(baseline_file), args.threshold,
+                            args.timing)
+        print(format_regressions(found))
+        sys.exit(1 if found else 0)
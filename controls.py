@@ -0,0 +1,142 @@
+import time
+from collections import deque
+
+# kRPC releases whose client internals _write_batch and profiler.Profiler build on. With another release, or a client
+# missing any of them, every changed control is written with a call of its own
+KRPC_INTERNALS_VERSIONS = ((0, 6),)
+KRPC_INTERNALS = ("_types", "_build_call", "_build_error", "_rpc_connection", "_rpc_connection_lock")
+
+
+def has_krpc_internals(client):
+    """ Whether 'client' is a kRPC client of a known release, with the internals used to batch and time requests"""
+    if client is None or not all(hasattr(client, name) for name in KRPC_INTERNALS):
+        return False
+    import krpc
+
+    try:
+        version = tuple(int(part) for part in krpc.__version__.split(".")[:2])
+    except (AttributeError, ValueError):
+        return False
+    return version in KRPC_INTERNALS_VERSIONS
+
+
+class ControlBuffer:
+    """
+    Local copy of the vessel's commanded control inputs (throttle, pitch, roll, gear, brakes).
+
+    Control methods read and change the local values, which are clamped to the range the game accepts. flush() then
+    writes only the values that changed since the last flush. A kRPC client sends all of them as one request, so the
+    whole tick costs at most one round trip. Other connections, and kRPC releases other than those in
+    KRPC_INTERNALS_VERSIONS, get one write per changed value.
+
+    The local values are the source of truth between sync() calls. A kRPC control getter returns the input applied on
+    the last physics tick, so reading back a value just written returns the old one. check_drift() compares each of the
+    vessel's controls against the value sent at least 'settle_time' seconds of 'clock' ago and every value sent since,
+    which may not have been applied yet, and resyncs when it is further than 'drift_tolerance' from all of them (i.e.
+    the player took the stick).
+    """
+    NAMES = ("throttle", "pitch", "roll", "gear", "brakes")
+    RANGES = {"throttle": (0.0, 1.0), "pitch": (-1.0, 1.0), "roll": (-1.0, 1.0), "yaw": (-1.0, 1.0)}
+
+    def __init__(self, control, names=NAMES, drift_tolerance=0.05, clock=time.monotonic, settle_time=0.1):
+        self.control = control
+        self.names = names
+        self.drift_tolerance = drift_tolerance
+        self.clock = clock
+        self.settle_time = settle_time
+        self.values = {}
+        self.sent = {}
+        self.history = {}
+        self.sync()
+
+    def sync(self):
+        """ Reads every control from the vessel, discarding changes not yet flushed."""
+        self.values = {name: getattr(self.control, name) for name in self.names}
+        self.sent = dict(self.values)
+        now = self.clock()
+        self.history = {name: deque([(now, value)]) for name, value in self.values.items()}
+        # The control may be a new connection's, see Vessel.reconnect
+        self.batch_writes = has_krpc_internals(getattr(self.control, "_client", None))
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def __setitem__(self, name, value):
+        if name in self.RANGES:
+            low, high = self.RANGES[name]
+            value = min(max(value, low), high)
+        self.values[name] = value
+
+    def changes(self):
+        return {name: value for name, value in self.values.items() if self.sent.get(name) != value}
+
+    def write(self, changes):
+        if changes and self.batch_writes:
+            _write_batch(self.control, changes)
+        else:
+            for name, value in changes.items():
+                setattr(self.control, name, value)
+
+    def mark_sent(self, changes):
+        self.sent.update(changes)
+        if changes:
+            now = self.clock()
+            for name, value in changes.items():
+                history = self.history.setdefault(name, deque())
+                history.append((now, value))
+                self._settle(history, now)
+
+    def _settle(self, history, now):
+        # Keeps the last value sent at least 'settle_time' ago and the values sent after it
+        while len(history) > 1 and history[1][0] <= now - self.settle_time:
+            history.popleft()
+
+    def flush(self):
+        """ Writes changed controls to the vessel. Returns the changes that were written."""
+        changes = self.changes()
+        self.write(changes)
+        self.mark_sent(changes)
+        return changes
+
+    def check_drift(self):
+        """ Reads the controls back and resyncs if any differs from every value that may have been applied. Returns the
+            drifted names."""
+        drifted = []
+        now = self.clock()
+        for name in self.names:
+            history = self.history[name]
+            self._settle(history, now)
+            actual = getattr(self.control, name)
+            values = [value for _, value in history]
+            if isinstance(self.sent[name], bool):
+                if actual not in values:
+                    drifted.append(name)
+            elif not min(values) - self.drift_tolerance <= actual <= max(values) + self.drift_tolerance:
+                drifted.append(name)
+        if drifted:
+            self.sync()
+        return drifted
+
+
+def _write_batch(control, changes):
+    # Sends every setter call in a single kRPC request, i.e. one round trip for the whole tick. Builds the calls the
+    # same way the generated SpaceCenter.Control setters do
+    import krpc.schema.KRPC_pb2 as KRPC
+
+    client = control._client
+    types = client._types
+    control_type = types.class_type("SpaceCenter", "Control")
+    request = KRPC.Request()
+    for name, value in changes.items():
+        value_type = types.bool_type if isinstance(value, bool) else types.float_type
+        procedure = "Control_set_" + name.capitalize()
+        request.calls.extend([client._build_call("SpaceCenter", procedure, [control, value], ["self", "value"],
+                                                 [control_type, value_type], None)])
+    with client._rpc_connection_lock:
+        client._rpc_connection.send_message(request)
+        response = client._rpc_connection.receive_message(KRPC.Response)
+    if response.HasField("error"):
+        raise client._build_error(response.error)
+    for result in response.results:
+        if result.HasField("error"):
+            raise client._build_error(result.error)
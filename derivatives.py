@@ -0,0 +1,61 @@
+class DerivativeBuffer:
+    """
+    Ring buffer of the last 'order' + 1 timestamped samples of one quantity (i.e. altitude) and its time derivatives
+    from 0th to 'order'th.
+
+    Samples may be unevenly spaced, so derivatives are taken from Newton divided differences over the actual sample
+    times rather than over a fixed time step. Only the newest diagonal of the divided difference table is kept, which
+    makes each update cost 'order' subtractions and divisions however long the buffer has been running. The k-th
+    derivative is k! times the k-th divided difference, which reduces to the usual backward difference over 't^k'
+    when samples are evenly spaced.
+
+    'smoothing' optionally applies an exponential moving average with that weight (0 < smoothing <= 1) to the 1st and
+    higher derivatives. Timestamps may be game UT or a monotonic clock, as long as one buffer sticks to one of them.
+    """
+    def __init__(self, order=5, smoothing=None):
+        self.order = order
+        self.smoothing = smoothing
+        self.times = [0.0] * (order + 1)
+        self.differences = [0.0] * (order + 1)
+        self.derivatives = [0.0] * (order + 1)
+        self.count = 0
+        self.index = -1
+
+    @property
+    def warm(self):
+        # True once every derivative has been computed from real samples
+        return self.count > self.order
+
+    @property
+    def latest_time(self):
+        return self.times[self.index] if self.count else None
+
+    def update(self, timestamp, value):
+        """ Adds a sample and returns the derivatives list. A sample no newer than the last one carries no new
+            information (i.e. a telemetry stream that has not updated since the previous tick) and is ignored."""
+        if self.count and timestamp <= self.times[self.index]:
+            return self.derivatives
+        size = self.order + 1
+        self.index = (self.index + 1) % size
+        self.times[self.index] = timestamp
+
+        known = min(self.count, self.order)
+        difference = value
+        factorial = 1
+        raw = [value]
+        for k in range(1, known + 1):
+            previous = self.differences[k - 1]
+            self.differences[k - 1] = difference
+            difference = (difference - previous) / (timestamp - self.times[(self.index - k) % size])
+            factorial *= k
+            raw.append(factorial * difference)
+        self.differences[known] = difference
+        self.count += 1
+
+        self.derivatives[0] = value
+        for k in range(1, known + 1):
+            if self.smoothing is None or k > self.count - 2:
+                self.derivatives[k] = raw[k]
+            else:
+                self.derivatives[k] += self.smoothing * (raw[k] - self.derivatives[k])
+        return self.derivatives
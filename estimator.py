@@ -0,0 +1,135 @@
+"""
+State estimator
+---------------
+StateEstimator is a drop-in alternative to derivatives.DerivativeBuffer. Instead of divided differences of the last
+few raw samples, whose 2nd to 5th derivatives amplify the sensor noise by 1 / dt^k, it keeps a filtered estimate of
+the quantity and its derivatives up to 'order': a polynomial (alpha-beta-gamma) filter generalised to any order. Each
+sample the state is predicted forward over the time since the last sample by its Taylor series and corrected by a
+fixed fraction of the residual per derivative.
+
+The gains are those of the critically damped fading memory filter: every pole of the filter sits at 'theta'
+(0 < theta < 1), so one number trades smoothing (theta near 1) against lag (theta near 0). For order 2 they are the
+classic g = 1 - theta^3, h = 1.5 (1 - theta)^2 (1 + theta), k = 0.5 (1 - theta)^3.
+
+The derivatives handed to the controllers are predicted 'lead' seconds past the last sample, i.e. by the measured
+command latency, to the moment a control change made on this tick takes effect (see Vessel.update_command_latency).
+"""
+
+import math
+
+from derivatives import DerivativeBuffer
+
+
+def _multiply(a, b):
+    # Product of two polynomials given as coefficient lists, lowest power first
+    product = [0.0] * (len(a) + len(b) - 1)
+    for i, x in enumerate(a):
+        for j, y in enumerate(b):
+            product[i + j] += x * y
+    return product
+
+
+def _power(polynomial, exponent):
+    result = [1.0]
+    for _ in range(exponent):
+        result = _multiply(result, polynomial)
+    return result
+
+
+def _eulerian(n):
+    # Coefficients of the Eulerian polynomial A_n, with sum(s^n w^s, s >= 1) = w A_n(w) / (1 - w)^(n + 1)
+    row = [1]
+    for k in range(2, n + 1):
+        row = [(m + 1) * (row[m] if m < len(row) else 0) + (k - m) * (row[m - 1] if m else 0) for m in range(k)]
+    return [float(x) for x in row]
+
+
+def critically_damped_gains(order, theta):
+    """
+    Gains of the polynomial filter of 'order' with every pole at 'theta', for the state scaled to x_k * dt^k / k!.
+    The characteristic polynomial of the filter is affine in the gains, (z - 1)^(n + 1) + g_0 (z - 1)^n +
+    sum(g_k z A_k(z) (z - 1)^(n - k)), and is matched to (z - theta)^(n + 1).
+    """
+    n = order
+    target = _power([-theta, 1.0], n + 1)
+    base = _power([-1.0, 1.0], n + 1)
+    columns = [_power([-1.0, 1.0], n)]
+    for k in range(1, n + 1):
+        columns.append(_multiply(_multiply([0.0, 1.0], _eulerian(k)), _power([-1.0, 1.0], n - k)))
+    # Coefficients of z^0 .. z^n; the leading ones already agree
+    rows = [[column[i] for column in columns] + [target[i] - base[i]] for i in range(n + 1)]
+    for i in range(n + 1):
+        pivot = max(range(i, n + 1), key=lambda r: abs(rows[r][i]))
+        rows[i], rows[pivot] = rows[pivot], rows[i]
+        for r in range(n + 1):
+            if r != i:
+                factor = rows[r][i] / rows[i][i]
+                rows[r] = [x - factor * y for x, y in zip(rows[r], rows[i])]
+    return [rows[i][n + 1] / rows[i][i] for i in range(n + 1)]
+
+
+class StateEstimator:
+    """
+    Filtered value and time derivatives from 0th to 'order'th of one quantity, with the interface of DerivativeBuffer.
+    The first 'order' + 1 samples are differenced as by a DerivativeBuffer; the filter then starts from the latest
+    value and rate with the higher derivatives at zero, and counts as warm once it has had 'settle' samples more.
+    """
+    def __init__(self, order=5, theta=0.8, lead=0.0, settle=None):
+        self.order = order
+        self.theta = theta
+        self.lead = lead
+        self.settle = settle if settle is not None else order + 1
+        self.gains = critically_damped_gains(order, theta)
+        self.factorials = [math.factorial(k) for k in range(order + 1)]
+        self.start = DerivativeBuffer(order)
+        self.state = None
+        self.time = None
+        self.derivatives = [0.0] * (order + 1)
+        self.count = 0
+
+    @property
+    def warm(self):
+        return self.count > self.order + self.settle
+
+    @property
+    def latest_time(self):
+        return self.time
+
+    def update(self, timestamp, value):
+        """ Adds a sample and returns the derivatives, predicted 'lead' seconds ahead. A sample no newer than the last
+            one is ignored, as by DerivativeBuffer."""
+        if self.time is not None and timestamp <= self.time:
+            return self.derivatives
+        if self.state is None:
+            raw = self.start.update(timestamp, value)
+            if self.start.warm:
+                self.state = [raw[0], raw[1]] + [0.0] * (self.order - 1)
+        else:
+            self._correct(timestamp - self.time, value)
+        self.time = timestamp
+        self.count += 1
+        self._predict(self.state if self.state is not None else self.start.derivatives)
+        return self.derivatives
+
+    def _correct(self, dt, value):
+        state = self._extrapolate(self.state, dt)
+        residual = value - state[0]
+        scale = 1.0
+        for k in range(self.order + 1):
+            state[k] += self.gains[k] * residual * self.factorials[k] / scale
+            scale *= dt
+        self.state = state
+
+    def _extrapolate(self, state, dt):
+        # Taylor series of every derivative 'dt' seconds on
+        order = self.order
+        extrapolated = list(state)
+        for k in range(order):
+            term = 1.0
+            for j in range(k + 1, order + 1):
+                term *= dt / (j - k)
+                extrapolated[k] += state[j] * term
+        return extrapolated
+
+    def _predict(self, state):
+        self.derivatives[:] = self._extrapolate(state, self.lead) if self.lead else state
@@ -0,0 +1,473 @@
+"""
+Loopback kRPC server
+--------------------
+A small server that speaks the kRPC RPC and stream protocols over TCP, for the procedures the Vessel class calls, so
+the unmodified krpc client can fly against it with no game running. It exercises what the in-process simulator cannot:
+connection setup, protobuf encoding and decoding of every call, stream updates pushed over their own socket and
+head-of-line blocking behind slow messages.
+
+The server is backed by a vessel model shaped like simulator.SimulatedConnection (space_center.active_vessel with its
+control, flight(), orbit and reference frames, space_center.ut, and sleep() to advance it), which a physics thread
+steps in real time, as the game would. Every message the server sends goes out through a LinkProfile, which adds a
+latency, uniform jitter and occasional delay spikes. Messages on one socket are delivered in order, so a delayed
+message holds back every message behind it:
+
+    with LoopbackServer(link=LinkProfile(latency=0.002, jitter=0.001)) as server:
+        conn = krpc.connect(rpc_port=server.rpc_port, stream_port=server.stream_port)
+        vessel = Vessel(conn)
+
+Or serve on the default kRPC ports and run air_craft.py against it:
+
+    python loopback.py --profile wifi
+"""
+
+import argparse
+import random
+import socket
+import socketserver
+import threading
+import time
+import uuid
+
+import krpc.schema.KRPC_pb2 as KRPC
+from krpc.decoder import Decoder
+from krpc.encoder import Encoder
+from krpc.types import Types
+
+from simulator import SimulatedConnection
+
+TYPES = Types()
+DOUBLE = TYPES.double_type
+FLOAT = TYPES.float_type
+BOOL = TYPES.bool_type
+UINT64 = TYPES.uint64_type
+# Remote objects are sent as their uint64 id
+OBJECT = "object"
+OBJECTS = "objects"
+VECTOR = TYPES.tuple_type(DOUBLE, DOUBLE, DOUBLE)
+
+# Named link profiles for the command line: keyword arguments of LinkProfile
+PROFILES = {
+    "local": {},
+    "lan": {"latency": 0.0005, "jitter": 0.0002},
+    "wifi": {"latency": 0.002, "jitter": 0.003, "spike_probability": 0.01, "spike": 0.05},
+    "wan": {"latency": 0.02, "jitter": 0.005, "spike_probability": 0.005, "spike": 0.2},
+}
+
+FLIGHT_PROPERTIES = (("speed", DOUBLE), ("mean_altitude", DOUBLE), ("surface_altitude", DOUBLE), ("latitude", DOUBLE),
+                     ("longitude", DOUBLE), ("heading", FLOAT), ("pitch", FLOAT), ("roll", FLOAT),
+                     ("velocity", VECTOR))
+CONTROL_PROPERTIES = (("throttle", FLOAT), ("pitch", FLOAT), ("roll", FLOAT), ("gear", BOOL), ("brakes", BOOL))
+
+
+def _camel_case(name):
+    return "".join(word.capitalize() for word in name.split("_"))
+
+
+# SpaceCenter procedures: parameter types, return type (None for none) and the function of the model and the decoded
+# arguments that implements it
+PROCEDURES = {
+    "get_ActiveVessel": ((), OBJECT, lambda model: model.space_center.active_vessel),
+    "get_UT": ((), DOUBLE, lambda model: model.space_center.ut),
+    "ReferenceFrame_static_CreateHybrid": (
+        (OBJECT, OBJECT, OBJECT, OBJECT), OBJECT,
+        lambda model, position, rotation=None, velocity=None, angular_velocity=None:
+            model.space_center.ReferenceFrame.create_hybrid(position, rotation, velocity, angular_velocity)),
+    "Vessel_get_Orbit": ((OBJECT,), OBJECT, lambda model, vessel: vessel.orbit),
+    "Vessel_get_SurfaceReferenceFrame": ((OBJECT,), OBJECT, lambda model, vessel: vessel.surface_reference_frame),
+    "Vessel_get_Control": ((OBJECT,), OBJECT, lambda model, vessel: vessel.control),
+    "Vessel_Flight": ((OBJECT, OBJECT), OBJECT, lambda model, vessel, reference_frame=None:
+                      vessel.flight(reference_frame)),
+    "Orbit_get_Body": ((OBJECT,), OBJECT, lambda model, orbit: orbit.body),
+    "CelestialBody_get_ReferenceFrame": ((OBJECT,), OBJECT, lambda model, body: body.reference_frame),
+    "Control_ActivateNextStage": ((OBJECT,), OBJECTS, lambda model, control: control.activate_next_stage()),
+}
+for _name, _type in FLIGHT_PROPERTIES:
+    PROCEDURES["Flight_get_" + _camel_case(_name)] = ((OBJECT,), _type,
+                                                      lambda model, flight, name=_name: getattr(flight, name))
+for _name, _type in CONTROL_PROPERTIES:
+    PROCEDURES["Control_get_" + _camel_case(_name)] = ((OBJECT,), _type,
+                                                       lambda model, control, name=_name: getattr(control, name))
+    PROCEDURES["Control_set_" + _camel_case(_name)] = ((OBJECT, _type), None,
+                                                       lambda model, control, value, name=_name:
+                                                       setattr(control, name, value))
+
+
+class ProcedureError(Exception):
+    """Raised for a call the server cannot make; sent back to the client as an RPC error"""
+
+
+class LinkProfile:
+    """
+    Delay of every message sent over a link: 'latency' seconds, plus up to 'jitter' more drawn uniformly, plus 'spike'
+    more with probability 'spike_probability' (i.e. a retransmitted packet). An RPC round trip takes one delay plus the
+    server's own time; a stream value arrives one delay after it was taken.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, spike_probability=0.0, spike=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.spike_probability = spike_probability
+        self.spike = spike
+        self.random = random.Random(seed)
+
+    def delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(0.0, self.jitter)
+        if self.spike_probability and self.random.random() < self.spike_probability:
+            delay += self.spike
+        return delay
+
+
+class _Link:
+    """
+    Sends size-prefixed messages on a socket, each after the profile's delay. Messages are delivered in order, like
+    bytes on a TCP connection: one is never sent before those queued ahead of it, however short its own delay.
+    """
+    def __init__(self, sock, profile):
+        self.socket = sock
+        self.profile = profile
+        self.queue = []
+        self.last_delivery = 0.0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._deliver, daemon=True)
+        self.thread.start()
+
+    def send(self, message):
+        data = Encoder.encode_message_with_size(message)
+        with self.condition:
+            self.last_delivery = max(time.monotonic() + self.profile.delay(), self.last_delivery)
+            self.queue.append((self.last_delivery, data))
+            self.condition.notify()
+
+    def _deliver(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                delivery, data = self.queue.pop(0)
+            delay = delivery - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.socket.sendall(data)
+            except OSError:
+                self.close()
+                return
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+def _receive_message(file, message_type):
+    # A message is its size as a protobuf varint followed by the message. Returns None at end of file
+    data = b""
+    while True:
+        byte = file.read(1)
+        if not byte:
+            return None
+        data += byte
+        if not byte[0] & 0x80:
+            break
+    size = Decoder.decode_message_size(data)
+    message = file.read(size)
+    if len(message) < size:
+        return None
+    return Decoder.decode_message(message, message_type)
+
+
+class _Client:
+    """ A connected client: its streams and the links of its RPC and stream sockets"""
+    def __init__(self, identifier, name, rpc_link):
+        self.identifier = identifier
+        self.name = name
+        self.rpc_link = rpc_link
+        self.stream_link = None
+        # Stream id -> [call, started, rate, last value sent, time last sent]
+        self.streams = {}
+
+
+class _RPCHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server.loopback
+        request = _receive_message(self.rfile, KRPC.ConnectionRequest)
+        if request is None:
+            return
+        response = KRPC.ConnectionResponse()
+        if request.type != KRPC.ConnectionRequest.RPC:
+            response.status = KRPC.ConnectionResponse.WRONG_TYPE
+            response.message = "Expected an RPC connection request"
+            self.wfile.write(Encoder.encode_message_with_size(response))
+            return
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = server.add_client(request.client_name, _Link(self.request, server.link))
+        response.status = KRPC.ConnectionResponse.OK
+        response.client_identifier = client.identifier
+        self.wfile.write(Encoder.encode_message_with_size(response))
+        try:
+            while True:
+                request = _receive_message(self.rfile, KRPC.Request)
+                if request is None:
+                    break
+                client.rpc_link.send(server.execute(client, request))
+        except OSError:
+            pass
+        finally:
+            server.remove_client(client)
+
+
+class _StreamHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server.loopback
+        request = _receive_message(self.rfile, KRPC.ConnectionRequest)
+        if request is None:
+            return
+        response = KRPC.ConnectionResponse()
+        client = server.clients.get(request.client_identifier)
+        if request.type != KRPC.ConnectionRequest.STREAM or client is None:
+            response.status = KRPC.ConnectionResponse.WRONG_TYPE
+            response.message = "Expected a stream connection request from a connected client"
+            self.wfile.write(Encoder.encode_message_with_size(response))
+            return
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        response.status = KRPC.ConnectionResponse.OK
+        self.wfile.write(Encoder.encode_message_with_size(response))
+        client.stream_link = _Link(self.request, server.link)
+        # The client never sends on this socket; hold it open until the client closes it
+        while self.rfile.read(1):
+            pass
+        client.stream_link.close()
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class LoopbackServer:
+    """
+    Serves 'model' (a simulator.SimulatedConnection unless given) on 'rpc_port' and 'stream_port' of 'address'; port 0
+    picks a free port, see rpc_port and stream_port once started. The physics thread advances the model by
+    'time_scale' times the wall time elapsed every 'physics_step' seconds and then sends stream updates, so streams
+    update once per physics step, like once per game frame. Every message sent goes through 'link'.
+    """
+    def __init__(self, model=None, address="127.0.0.1", rpc_port=50000, stream_port=50001, link=None,
+                 physics_step=0.02, time_scale=1.0):
+        self.model = model if model is not None else SimulatedConnection()
+        self.address = address
+        self.requested_ports = (rpc_port, stream_port)
+        self.link = link if link is not None else LinkProfile()
+        self.physics_step = physics_step
+        self.time_scale = time_scale
+        # Held for every access to the model, by the RPC handlers and the physics thread
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.objects = {0: None}
+        self.object_ids = {}
+        self.stream_ids = {}
+        self.calls = 0
+        self.servers = []
+        self.threads = []
+        self.running = threading.Event()
+
+    @property
+    def rpc_port(self):
+        return self.servers[0].server_address[1]
+
+    @property
+    def stream_port(self):
+        return self.servers[1].server_address[1]
+
+    def start(self):
+        for port, handler in zip(self.requested_ports, (_RPCHandler, _StreamHandler)):
+            server = _TCPServer((self.address, port), handler)
+            server.loopback = self
+            self.servers.append(server)
+            self.threads.append(threading.Thread(target=server.serve_forever, daemon=True))
+        self.running.set()
+        self.threads.append(threading.Thread(target=self._physics, daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def close(self):
+        self.running.clear()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        for client in list(self.clients.values()):
+            self.remove_client(client)
+        for thread in self.threads:
+            thread.join()
+        self.servers = []
+        self.threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_client(self, name, rpc_link):
+        client = _Client(uuid.uuid4().bytes, name, rpc_link)
+        self.clients[client.identifier] = client
+        return client
+
+    def remove_client(self, client):
+        if self.clients.pop(client.identifier, None) is not None:
+            client.rpc_link.close()
+            if client.stream_link is not None:
+                client.stream_link.close()
+
+    # Objects are given ids in the order the clients first see them; the same object always has the same id
+
+    def object_id(self, obj):
+        if obj is None:
+            return 0
+        key = id(obj)
+        object_id = self.object_ids.get(key)
+        if object_id is None:
+            object_id = self.object_ids[key] = len(self.objects)
+            self.objects[object_id] = obj
+        return object_id
+
+    def encode(self, value, value_type):
+        if value_type is OBJECT:
+            return Encoder.encode(self.object_id(value), UINT64)
+        if value_type is OBJECTS:
+            return KRPC.List(items=[Encoder.encode(self.object_id(item), UINT64) for item in value]).SerializeToString()
+        return Encoder.encode(value, value_type)
+
+    def decode(self, data, value_type):
+        if value_type is OBJECT:
+            object_id = Decoder.decode(None, data, UINT64)
+            if object_id not in self.objects:
+                raise ProcedureError(f"No object with id {object_id}")
+            return self.objects[object_id]
+        return Decoder.decode(None, data, value_type)
+
+    def call(self, client, call):
+        """ Makes one procedure call, returning its encoded result"""
+        if call.service == "KRPC":
+            return self.krpc_call(client, call)
+        if call.service != "SpaceCenter" or call.procedure not in PROCEDURES:
+            raise ProcedureError(f"Procedure {call.service}.{call.procedure} is not served by the loopback server")
+        parameter_types, return_type, function = PROCEDURES[call.procedure]
+        arguments = [None] * len(parameter_types)
+        given = 0
+        for argument in call.arguments:
+            arguments[argument.position] = self.decode(argument.value, parameter_types[argument.position])
+            given = max(given, argument.position + 1)
+        result = function(self.model, *arguments[:given])
+        return b"" if return_type is None else self.encode(result, return_type)
+
+    def krpc_call(self, client, call):
+        arguments = {argument.position: argument.value for argument in call.arguments}
+        if call.procedure == "GetServices":
+            # Names only: the client uses its pre-generated stubs of these services
+            return KRPC.Services(services=[KRPC.Service(name="KRPC"), KRPC.Service(name="SpaceCenter")]) \
+                .SerializeToString()
+        if call.procedure == "GetClientID":
+            return Encoder.encode(client.identifier, TYPES.bytes_type)
+        if call.procedure == "AddStream":
+            stream_call = Decoder.decode_message(arguments[0], KRPC.ProcedureCall)
+            start = Decoder.decode(None, arguments[1], BOOL) if 1 in arguments else True
+            # Check the call can be made; identical calls share a stream, as on the kRPC server
+            self.call(client, stream_call)
+            key = stream_call.SerializeToString()
+            stream_id = self.stream_ids.setdefault(key, len(self.stream_ids) + 1)
+            stream = client.streams.setdefault(stream_id, [stream_call, False, 0.0, None, 0.0])
+            stream[1] = stream[1] or start
+            return KRPC.Stream(id=stream_id).SerializeToString()
+        stream_id = Decoder.decode(None, arguments.get(0, b"\x00"), UINT64)
+        if call.procedure in ("StartStream", "SetStreamRate", "RemoveStream") and stream_id not in client.streams:
+            raise ProcedureError(f"No stream with id {stream_id}")
+        if call.procedure == "StartStream":
+            client.streams[stream_id][1] = True
+        elif call.procedure == "SetStreamRate":
+            client.streams[stream_id][2] = Decoder.decode(None, arguments[1], FLOAT)
+        elif call.procedure == "RemoveStream":
+            del client.streams[stream_id]
+        else:
+            raise ProcedureError(f"Procedure KRPC.{call.procedure} is not served by the loopback server")
+        return b""
+
+    def execute(self, client, request):
+        """ The response to a request: every call in it is made in order, under the model lock"""
+        response = KRPC.Response()
+        with self.lock:
+            for call in request.calls:
+                result = response.results.add()
+                try:
+                    result.value = self.call(client, call)
+                except Exception as e:
+                    result.error.CopyFrom(KRPC.Error(description=f"{type(e).__name__}: {e}"))
+            self.calls += len(request.calls)
+        return response
+
+    def stream_update(self, client, now):
+        """ The update of every started stream whose value changed and is due by its rate, None if there is none"""
+        update = KRPC.StreamUpdate()
+        for stream_id, stream in client.streams.items():
+            stream_call, started, rate, last_value, last_sent = stream
+            if not started or rate and now - last_sent < 1.0 / rate:
+                continue
+            result = KRPC.ProcedureResult()
+            try:
+                result.value = self.call(client, stream_call)
+            except Exception as e:
+                result.error.CopyFrom(KRPC.Error(description=f"{type(e).__name__}: {e}"))
+            value = result.SerializeToString()
+            if value != last_value:
+                stream[3] = value
+                stream[4] = now
+                update.results.add(id=stream_id, result=result)
+        return update if update.results else None
+
+    def _physics(self):
+        last = time.monotonic()
+        while self.running.is_set():
+            time.sleep(self.physics_step)
+            now = time.monotonic()
+            with self.lock:
+                self.model.sleep((now - last) * self.time_scale)
+                updates = [(client.stream_link, self.stream_update(client, now))
+                           for client in list(self.clients.values()) if client.stream_link is not None]
+            last = now
+            for stream_link, update in updates:
+                if update is not None:
+                    stream_link.send(update)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the simulator over the kRPC protocol")
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--rpc-port", type=int, default=50000)
+    parser.add_argument("--stream-port", type=int, default=50001)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="local", help="named link profile")
+    parser.add_argument("--latency", type=float, help="seconds added to every message, overriding the profile")
+    parser.add_argument("--jitter", type=float, help="up to this many seconds more, overriding the profile")
+    parser.add_argument("--physics-step", type=float, default=0.02)
+    parser.add_argument("--time-scale", type=float, default=1.0, help="game seconds per wall second")
+    args = parser.parse_args()
+
+    link_settings = dict(PROFILES[args.profile])
+    if args.latency is not None:
+        link_settings["latency"] = args.latency
+    if args.jitter is not None:
+        link_settings["jitter"] = args.jitter
+    loopback = LoopbackServer(address=args.address, rpc_port=args.rpc_port, stream_port=args.stream_port,
+                              link=LinkProfile(**link_settings), physics_step=args.physics_step,
+                              time_scale=args.time_scale)
+    with loopback:
+        print(f"Serving on {args.address}, RPC port {loopback.rpc_port}, stream port {loopback.stream_port}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,124 @@
+import math
+
+
+class QuantileSketch:
+    """
+    Bounded-memory quantile estimate of non-negative values, after DDSketch. Values fall into logarithmic buckets
+    that are 'relative_accuracy' wide, so a quantile is returned within that relative error of the true one however
+    many values were added. When more than 'max_buckets' are in use the two smallest are merged, which only costs
+    accuracy at the low end. The lowest key is tracked as values are added, so adding a value takes O(1) time.
+    """
+    def __init__(self, relative_accuracy=0.01, max_buckets=1024, min_value=1e-9):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.min_value = min_value
+        self.buckets = {}
+        self.lowest = None
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= self.min_value:
+            self.zero_count += 1
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        if self.lowest is None or key < self.lowest:
+            if len(self.buckets) == self.max_buckets:
+                # A new lowest bucket would be merged straight into the current lowest one
+                key = self.lowest
+            else:
+                self.lowest = key
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        if len(self.buckets) > self.max_buckets:
+            # Once the sketch is full the lowest key only rises, so this search costs O(1) per value over a run
+            next_lowest = self.lowest + 1
+            while next_lowest not in self.buckets:
+                next_lowest += 1
+            self.buckets[next_lowest] += self.buckets.pop(self.lowest)
+            self.lowest = next_lowest
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+class RunningStats:
+    """ Mean (signed, i.e. bias), RMS and maximum magnitude of a stream of errors in O(1) time and memory per value,
+        with percentiles of the magnitude from a QuantileSketch."""
+    def __init__(self, relative_accuracy=0.01):
+        self.count = 0
+        self.mean = 0.0
+        self.sum_squares = 0.0
+        self.max = 0.0
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def add(self, error):
+        self.count += 1
+        self.mean += (error - self.mean) / self.count
+        self.sum_squares += error * error
+        magnitude = abs(error)
+        if magnitude > self.max:
+            self.max = magnitude
+        self.sketch.add(magnitude)
+
+    @property
+    def rms(self):
+        return math.sqrt(self.sum_squares / self.count) if self.count else 0.0
+
+    def percentile(self, q):
+        return self.sketch.quantile(q)
+
+    def summary(self):
+        return {"count": self.count, "mean": self.mean, "rms": self.rms, "max": self.max,
+                "p50": self.percentile(0.5), "p90": self.percentile(0.9), "p99": self.percentile(0.99)}
+
+
+class TrackingMetrics:
+    """
+    Streaming tracking-error metrics for the maneuver loops, one RunningStats per named error
+    (i.e. "roll_rate": measured roll rate minus target roll rate).
+
+    report() is called every tick and emits a summary at most once every 'report_interval' seconds of the given clock;
+    with no interval nothing is emitted and the metrics are only read through summary().
+    """
+    def __init__(self, report_interval=None, emit=print):
+        self.report_interval = report_interval
+        self.emit = emit
+        self.reset()
+
+    def reset(self):
+        self.stats = {}
+        self.last_report = None
+
+    def record(self, name, error):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = RunningStats()
+        stats.add(error)
+
+    def summary(self):
+        return {name: stats.summary() for name, stats in self.stats.items()}
+
+    def format(self):
+        return "; ".join(f"{name}: mean {stats.mean:.3f} rms {stats.rms:.3f} max {stats.max:.3f} "
+                         f"p99 {stats.percentile(0.99):.3f}" for name, stats in self.stats.items())
+
+    def report(self, now):
+        if self.report_interval is None or not self.stats:
+            return
+        if self.last_report is None:
+            self.last_report = now
+        elif now - self.last_report >= self.report_interval:
+            self.last_report = now
+            self.emit(self.format())
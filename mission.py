@@ -0,0 +1,136 @@
+"""
+Mission runner
+--------------
+Flies a sequence of maneuvers read from a JSON file through a session.Session:
+
+    {
+        "vessel": {"cruise_altitude": 100, "cruise_speed": 80, "time_step": 0.005, "cruise_acceleration": 150,
+                   "control_step": 0.02},
+        "parameters": {"approach_offset": 1.0},
+        "maneuvers": [
+            {"maneuver": "take_off"},
+            {"maneuver": "cruise", "longitude_bound": -73.2},
+            {"maneuver": "turn", "heading_limit": 270, "turning_speed": 80, "roll_angle": 30, "offset": 15},
+            {"maneuver": "land"}
+        ]
+    }
+
+"vessel" holds Vessel constructor arguments and "parameters" any guidance attribute to set on it (see sweep.py).
+Each maneuver names a Vessel maneuver method, or "land", which repeats runway_alignment_correction until the aircraft
+has stopped; the other keys are its arguments.
+
+    python mission.py mission.json
+    python mission.py mission.json --simulate
+"""
+
+import argparse
+import json
+import time
+
+from air_craft import Vessel
+from session import Session
+
+MANEUVERS = ("start_engine", "take_off", "cruise", "turn", "runway_alignment_correction", "land")
+
+
+def land(vessel, altitude_quantity="mean_altitude"):
+    """ Flies S-turns onto the runway until the aircraft has stopped on it"""
+    while vessel.update_telemetry().speed > 1.0:
+        vessel.runway_alignment_correction(altitude_quantity)
+
+
+def load_mission(path):
+    """ Reads and checks a mission file"""
+    with open(path) as file:
+        mission = json.load(file)
+    unknown = set(mission) - {"vessel", "parameters", "maneuvers"}
+    if unknown:
+        raise ValueError(f"Unknown mission keys: {', '.join(sorted(unknown))}")
+    for step in mission.get("maneuvers", []):
+        if step.get("maneuver") not in MANEUVERS:
+            raise ValueError(f"Unknown maneuver {step.get('maneuver')!r}, expected one of {', '.join(MANEUVERS)}")
+    return mission
+
+
+def maneuver_function(name):
+    if name == "land":
+        return land
+    return getattr(Vessel, name)
+
+
+def set_parameters(vessel, mission):
+    """ Sets the mission's "parameters" on the vessel"""
+    for name, value in mission.get("parameters", {}).items():
+        if not hasattr(vessel, name):
+            raise AttributeError(f"Vessel has no parameter {name!r}")
+        setattr(vessel, name, value)
+
+
+def maneuvers(mission):
+    """ The mission's maneuvers in order, as (name, function, arguments)"""
+    steps = []
+    for step in mission.get("maneuvers", []):
+        arguments = dict(step)
+        name = arguments.pop("maneuver")
+        steps.append((name, maneuver_function(name), arguments))
+    return steps
+
+
+def fly(session, mission, **vessel_kwargs):
+    """ Creates the mission's vessel on 'session' and flies every maneuver in order. Returns the vessel."""
+    vessel = session.vessel(**mission.get("vessel", {}), **vessel_kwargs)
+    set_parameters(vessel, mission)
+    for name, function, arguments in maneuvers(mission):
+        print(f"Maneuver: {name}")
+        session.run(function, **arguments)
+    return vessel
+
+
+def flight_plan(mission):
+    """ The mission as a function of an existing vessel, i.e. the 'mission' of replay.replay()"""
+    steps = maneuvers(mission)
+
+    def fly_plan(vessel):
+        set_parameters(vessel, mission)
+        for name, function, arguments in steps:
+            print(f"Maneuver: {name}")
+            function(vessel, **arguments)
+
+    return fly_plan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fly a mission file")
+    parser.add_argument("mission", help="JSON file of vessel settings and maneuvers")
+    parser.add_argument("--name", default="guidance", help="client name shown by the kRPC server")
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--rpc-port", type=int, default=50000)
+    parser.add_argument("--stream-port", type=int, default=50001)
+    parser.add_argument("--simulate", action="store_true", help="fly in simulator.SimulatedConnection instead")
+    parser.add_argument("--time-limit", type=float, default=1800, help="game seconds a simulated flight may take")
+    parser.add_argument("--record", help="record the flight to this path, see recorder.FlightRecorder")
+    args = parser.parse_args()
+
+    connect = None
+    if args.simulate:
+        from simulator import SimulatedConnection
+
+        simulated_connection = SimulatedConnection(time_limit=args.time_limit)
+
+        def connect():
+            # The simulator has no connection to lose; reconnecting returns to the same flight
+            return simulated_connection
+    recorder = None
+    if args.record:
+        from recorder import FlightRecorder
+
+        recorder = FlightRecorder(args.record)
+    flight_session = Session(args.name, args.address, args.rpc_port, args.stream_port, connect=connect)
+    start = time.perf_counter()
+    try:
+        fly(flight_session, load_mission(args.mission), recorder=recorder)
+    finally:
+        if recorder is not None:
+            recorder.close()
+        flight_session.close()
+    print(f"Mission complete in {time.perf_counter() - start:.1f} s")
@@ -0,0 +1,350 @@
+"""
+Tick profiler
+-------------
+Opt-in instrumentation of a Vessel's control loop. Profiler.attach() wraps the objects remote calls go through: the
+RPC connection of a kRPC client, or the control object of an offline backend (see simulator.SimulatedConnection) or of
+a kRPC release not in controls.KRPC_INTERNALS_VERSIONS. It also wraps the vessel's scheduler. Every remote call is
+counted and timed, and each one is attributed to the maneuver and phase the vessel was in when it was made. Each tick
+is split into RPC time, sleeping and compute (the rest), and these go into per-tick histograms:
+
+    profiler = Profiler()
+    profiler.attach(vessel, conn)
+    vessel.take_off()
+    profiler.write_json("profile.json")
+    profiler.write_prometheus("profile.prom")
+
+Nothing is wrapped until attach() is called, so a vessel that is not profiled pays nothing. detach() puts the original
+objects back. Calls made before attach(), i.e. the stream subscriptions of the vessel's constructor, are not counted.
+Stream updates are pushed by the server and are not remote calls.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import threading
+import time
+
+from controls import has_krpc_internals
+
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 32)
+# Per-tick histograms: name, bucket bounds and help text
+TICK_HISTOGRAMS = (("tick_seconds", TIME_BUCKETS, "Wall time of a control tick"),
+                   ("tick_rpc_seconds", TIME_BUCKETS, "Time spent waiting on remote calls in a tick"),
+                   ("tick_compute_seconds", TIME_BUCKETS, "Time spent neither in remote calls nor sleeping in a tick"),
+                   ("tick_sleep_seconds", TIME_BUCKETS, "Time spent waiting for the scheduler's deadline in a tick"),
+                   ("tick_rpc_calls", COUNT_BUCKETS, "Remote calls made in a tick"))
+
+
+class Histogram:
+    """ Counts of values at or below each bound, as a Prometheus histogram, with their sum"""
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def add(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            i = len(self.bounds)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """ (upper bound, count of values at or below it) pairs, ending with +Inf"""
+        total = 0
+        pairs = []
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def summary(self):
+        return {"count": self.count, "sum": self.sum, "mean": self.sum / self.count if self.count else 0.0,
+                "buckets": {_format_bound(bound): count for bound, count in self.cumulative()}}
+
+
+class PhaseProfile:
+    """ Remote calls and ticks of one (maneuver, phase)"""
+    def __init__(self):
+        self.ticks = 0
+        self.round_trips = 0
+        self.calls = 0
+        self.rpc_seconds = 0.0
+        self.compute_seconds = 0.0
+        self.sleep_seconds = 0.0
+        self.procedures = {}
+        self.histograms = {name: Histogram(bounds) for name, bounds, _ in TICK_HISTOGRAMS}
+
+    def summary(self):
+        return {"ticks": self.ticks, "round_trips": self.round_trips, "calls": self.calls,
+                "rpc_seconds": self.rpc_seconds, "compute_seconds": self.compute_seconds,
+                "sleep_seconds": self.sleep_seconds,
+                "procedures": {name: {"calls": calls, "seconds": seconds}
+                               for name, (calls, seconds) in sorted(self.procedures.items())},
+                "histograms": {name: histogram.summary() for name, histogram in self.histograms.items()}}
+
+
+class _ProfiledConnection:
+    """ Stands in for the RPC connection of a kRPC client. A request is timed from sending it to receiving its
+        response, which covers single calls and batched ones (see controls._write_batch) alike."""
+    def __init__(self, connection, profiler):
+        self._connection = connection
+        self._profiler = profiler
+        self._procedures = ()
+        self._sent = 0.0
+
+    def send_message(self, message):
+        self._procedures = [call.service + "." + call.procedure for call in getattr(message, "calls", ())]
+        self._sent = time.perf_counter()
+        return self._connection.send_message(message)
+
+    def receive_message(self, message_type):
+        try:
+            return self._connection.receive_message(message_type)
+        finally:
+            self._profiler.record_rpc(self._procedures, time.perf_counter() - self._sent)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class _ProfiledObject:
+    """ Stands in for a remote object of an offline backend: every attribute read or write is one remote call"""
+    def __init__(self, target, name, profiler):
+        object.__setattr__(self, "_target", target)
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_profiler", profiler)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            # Not part of the remote API, i.e. ControlBuffer checking for a kRPC client
+            return getattr(self._target, name)
+        start = time.perf_counter()
+        try:
+            return getattr(self._target, name)
+        finally:
+            self._profiler.record_rpc((f"{self._name}.{name}",), time.perf_counter() - start)
+
+    def __setattr__(self, name, value):
+        start = time.perf_counter()
+        try:
+            setattr(self._target, name, value)
+        finally:
+            self._profiler.record_rpc((f"{self._name}.set_{name}",), time.perf_counter() - start)
+
+
+class Profiler:
+    """ Remote calls and tick timings of one vessel, per (maneuver, phase). See the module docstring."""
+    def __init__(self):
+        self.phases = {}
+        self.vessel = None
+        self.restore = []
+        self.lock = threading.Lock()
+        self._reset_tick()
+        self.tick_start = None
+
+    def _reset_tick(self):
+        self.tick_calls = 0
+        self.tick_rpc_seconds = 0.0
+        self.tick_sleep_seconds = 0.0
+
+    def _profile(self):
+        vessel = self.vessel
+        key = (vessel.maneuver, vessel.phase)
+        profile = self.phases.get(key)
+        if profile is None:
+            profile = self.phases[key] = PhaseProfile()
+        return profile
+
+    def _replace(self, owner, name, value):
+        self.restore.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, value)
+
+    def attach(self, vessel, conn):
+        """ Starts profiling the remote calls and ticks of 'vessel', which was created on 'conn'"""
+        if self.vessel is not None:
+            raise RuntimeError("The profiler is already attached to a vessel")
+        self.vessel = vessel
+        if has_krpc_internals(conn):
+            self._replace(conn, "_rpc_connection", _ProfiledConnection(conn._rpc_connection, self))
+        else:
+            # Only the vessel's own use of the controls; the backend's physics reads the same object
+            self._replace(vessel.controls, "control", _ProfiledObject(vessel.controls.control, "Control", self))
+        # Axes written over connections of their own, see async_air_craft.AsyncVessel
+        axis_controls = getattr(vessel, "axis_controls", {})
+        for control_name, control in list(axis_controls.items()):
+            client = getattr(control, "_client", None)
+            if has_krpc_internals(client):
+                if not isinstance(client._rpc_connection, _ProfiledConnection):
+                    self._replace(client, "_rpc_connection", _ProfiledConnection(client._rpc_connection, self))
+            else:
+                axis_controls[control_name] = _ProfiledObject(control, "Control", self)
+                self.restore.append((axis_controls, control_name, control))
+        scheduler = vessel.scheduler
+        if hasattr(scheduler, "sleep"):
+            self._replace(scheduler, "sleep", self._timed_sleep(scheduler.sleep))
+        self._replace(scheduler, "wait", self._timed_wait(scheduler.wait))
+        self._reset_tick()
+        self.tick_start = time.perf_counter()
+        return self
+
+    def detach(self):
+        """ Puts back every object attach() wrapped. The profile collected so far is kept."""
+        for owner, name, original in reversed(self.restore):
+            if isinstance(owner, dict):
+                owner[name] = original
+            else:
+                setattr(owner, name, original)
+        self.restore = []
+        self.vessel = None
+
+    def record_rpc(self, procedures, seconds):
+        # Calls made concurrently (see AsyncVessel) each count their own time
+        with self.lock:
+            profile = self._profile()
+            profile.round_trips += 1
+            profile.calls += len(procedures)
+            profile.rpc_seconds += seconds
+            for procedure in procedures:
+                entry = profile.procedures.get(procedure)
+                profile.procedures[procedure] = (1, seconds) if entry is None else (entry[0] + 1, entry[1] + seconds)
+            self.tick_calls += len(procedures)
+            self.tick_rpc_seconds += seconds
+
+    def _timed_sleep(self, sleep):
+        def timed_sleep(seconds):
+            start = time.perf_counter()
+            try:
+                return sleep(seconds)
+            finally:
+                self.tick_sleep_seconds += time.perf_counter() - start
+        return timed_sleep
+
+    def _timed_wait(self, wait):
+        def timed_wait():
+            # The tick is attributed to the maneuver and phase it ends in
+            profile = self._profile()
+            result = wait()
+            now = time.perf_counter()
+            with self.lock:
+                tick_seconds = now - self.tick_start
+                compute = max(tick_seconds - self.tick_rpc_seconds - self.tick_sleep_seconds, 0.0)
+                profile.ticks += 1
+                profile.compute_seconds += compute
+                profile.sleep_seconds += self.tick_sleep_seconds
+                histograms = profile.histograms
+                histograms["tick_seconds"].add(tick_seconds)
+                histograms["tick_rpc_seconds"].add(self.tick_rpc_seconds)
+                histograms["tick_compute_seconds"].add(compute)
+                histograms["tick_sleep_seconds"].add(self.tick_sleep_seconds)
+                histograms["tick_rpc_calls"].add(self.tick_calls)
+                self._reset_tick()
+                self.tick_start = now
+            return result
+        return timed_wait
+
+    def summary(self):
+        """ Totals and histograms per maneuver and phase, and totals over the whole flight"""
+        with self.lock:
+            phases = [dict(maneuver=maneuver, phase=phase, **profile.summary())
+                      for (maneuver, phase), profile in self.phases.items()]
+        totals = {name: sum(phase[name] for phase in phases)
+                  for name in ("ticks", "round_trips", "calls", "rpc_seconds", "compute_seconds", "sleep_seconds")}
+        return {"totals": totals, "phases": phases}
+
+    def write_json(self, path):
+        with open(path, "w") as file:
+            json.dump(self.summary(), file, indent=2)
+
+    def prometheus(self, prefix="guidance"):
+        """ The profile in the Prometheus text exposition format"""
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+        counters = (("rpc_round_trips_total", "round_trips", "Remote requests sent"),
+                    ("rpc_calls_total", "calls", "Remote procedure calls made"),
+                    ("rpc_seconds_total", "rpc_seconds", "Time spent waiting on remote calls"),
+                    ("compute_seconds_total", "compute_seconds", "Time spent neither in remote calls nor sleeping"),
+                    ("sleep_seconds_total", "sleep_seconds", "Time spent waiting for tick deadlines"),
+                    ("ticks_total", "ticks", "Control ticks"))
+        for name, field, help_text in counters:
+            metric(name, "counter", help_text)
+            for phase in summary["phases"]:
+                lines.append(f"{prefix}_{name}{_labels(phase)} {phase[field]}")
+        metric("procedure_calls_total", "counter", "Remote calls per procedure")
+        for phase in summary["phases"]:
+            for procedure, entry in phase["procedures"].items():
+                lines.append(f"{prefix}_procedure_calls_total{_labels(phase, procedure=procedure)} {entry['calls']}")
+        metric("procedure_seconds_total", "counter", "Time of the requests each procedure was sent in")
+        for phase in summary["phases"]:
+            for procedure, entry in phase["procedures"].items():
+                lines.append(f"{prefix}_procedure_seconds_total{_labels(phase, procedure=procedure)} "
+                             f"{entry['seconds']}")
+        for name, _, help_text in TICK_HISTOGRAMS:
+            metric(name, "histogram", help_text)
+            for phase in summary["phases"]:
+                histogram = phase["histograms"][name]
+                for bound, count in histogram["buckets"].items():
+                    lines.append(f"{prefix}_{name}_bucket{_labels(phase, le=bound)} {count}")
+                lines.append(f"{prefix}_{name}_sum{_labels(phase)} {histogram['sum']}")
+                lines.append(f"{prefix}_{name}_count{_labels(phase)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="guidance"):
+        # Written to a temporary file first, so a textfile collector never reads half a file
+        with open(path + ".tmp", "w") as file:
+            file.write(self.prometheus(prefix))
+        os.replace(path + ".tmp", path)
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+def _labels(phase, **extra):
+    labels = {"maneuver": phase["maneuver"] or "", "phase": phase["phase"] or ""}
+    labels.update(extra)
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+if __name__ == "__main__":
+    from air_craft import Vessel
+    from simulator import SimulatedConnection, SimulationTimeout, fly_mission
+
+    parser = argparse.ArgumentParser(description="Profile the simulated mission's control loop")
+    parser.add_argument("--json", default="profile.json")
+    parser.add_argument("--prometheus", default="profile.prom")
+    parser.add_argument("--time-limit", type=float, default=900, help="game seconds before the flight is stopped")
+    args = parser.parse_args()
+
+    connection = SimulatedConnection(time_limit=args.time_limit)
+    simulated_vessel = Vessel(connection, cruise_altitude=100, cruise_speed=80, time_step=0.005,
+                              cruise_acceleration=150, control_step=0.02, metrics_interval=None)
+    profiler = Profiler().attach(simulated_vessel, connection)
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            fly_mission(simulated_vessel)
+        except SimulationTimeout:
+            pass
+    profiler.detach()
+    profiler.write_json(args.json)
+    profiler.write_prometheus(args.prometheus)
+    for entry in profiler.summary()["phases"]:
+        print(f"{entry['maneuver'] or '-'} {entry['phase'] or ''}: {entry['ticks']} ticks, {entry['calls']} calls, "
+              f"rpc {entry['rpc_seconds']:.3f} s, compute {entry['compute_seconds']:.3f} s, "
+              f"sleep {entry['sleep_seconds']:.3f} s")
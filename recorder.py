@@ -0,0 +1,231 @@
+"""
+Flight data recorder
+--------------------
+FlightRecorder captures one record per telemetry snapshot the vessel reads, i.e. one per tick plus those read between
+maneuvers: the snapshot, the derivatives of every tracked quantity, the commanded controls, the maneuver and phase the
+vessel was in, the period the scheduler was set to for the tick, which varies with Vessel.adaptive_rate, and the lead
+the estimators predicted the snapshot's derivatives by (Vessel.command_latency). Two columns hold a value per tracked
+quantity, NaN where the tick did not control it:
+
+    targets     the rate the quantity was steered towards (Vessel.angular_control_from_position), per second
+    errors      the quantity less its setpoint (Vessel.tracking_errors), in the quantity's own unit
+
+Records are written into preallocated NumPy structured arrays of 'chunk_size' rows. A full chunk is handed to a
+background thread which appends it to '<path>.bin', so the control loop only waits on the disk when 'max_pending' chunks
+are already queued. '<path>.json' holds the record layout and the maneuver and phase names; the same thread rewrites it
+whenever a new name appears. If the thread fails, the next record() or close() raises RecorderError.
+FlightLog memory-maps the binary file, so a multi-hour log is read lazily rather than loaded into memory:
+
+    vessel = Vessel(conn, recorder=FlightRecorder("flight"))
+    ...
+    vessel.recorder.close()
+    log = FlightLog("flight")
+    log["mean_altitude"][-100:]
+"""
+
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+TELEMETRY_FIELDS = ("speed", "mean_altitude", "surface_altitude", "latitude", "longitude", "heading", "roll")
+CONTROL_FIELDS = ("throttle", "pitch", "roll", "gear", "brakes")
+
+
+def record_dtype(quantities, order):
+    return np.dtype([("tick", "u8"), ("ut", "f8"), ("dt", "f8"), ("period", "f8"), ("lead", "f8"), ("maneuver", "u1"),
+                     ("phase", "u1")] +
+                    [(name, "f8") for name in TELEMETRY_FIELDS] +
+                    [("velocity", "f8", (3,)),
+                     ("derivatives", "f8", (len(quantities), order + 1)),
+                     ("targets", "f8", (len(quantities),)),
+                     ("errors", "f8", (len(quantities),))] +
+                    [("control_" + name, "?" if name in ("gear", "brakes") else "f4") for name in CONTROL_FIELDS])
+
+
+class RecorderError(Exception):
+    """Raised on the control thread once the recorder's writer thread has failed; the failure is the cause"""
+
+
+class FlightRecorder:
+    def __init__(self, path, chunk_size=4096, max_pending=8):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.quantities = None
+        self.dtype = None
+        self.settings = {}
+        self.names = {"maneuvers": [None], "phases": [None]}
+        self.codes = {"maneuvers": {None: 0}, "phases": {None: 0}}
+        self.chunk = None
+        self.row = 0
+        self.count = 0
+        self.free = queue.Queue()
+        self.full = queue.Queue(max_pending)
+        self.writer = None
+        self.error = None
+
+    def _start(self, vessel):
+        # The layout is fixed by the quantities the vessel tracks when the first record is taken
+        self.quantities = tuple(vessel.derivatives)
+        self.order = max(buffer.order for buffer in vessel.derivatives.values())
+        self.dtype = record_dtype(self.quantities, self.order)
+        self.chunk = np.zeros(self.chunk_size, self.dtype)
+        self.nans = [float("nan")] * len(self.quantities)
+        # Guidance settings, so the flight can be replayed through an identically configured Vessel
+        adaptive_rate = vessel.adaptive_rate
+        self.settings = {"cruise_altitude": vessel.cruise_altitude, "cruise_speed": vessel.cruise_speed,
+                         "cruise_acceleration": vessel.cruise_acceleration, "time_step": vessel.t,
+                         "control_step": vessel.control_step, "derivative_smoothing": vessel.derivative_smoothing,
+                         "estimator_theta": vessel.estimator_theta,
+                         "command_latency": None if vessel.measure_latency else vessel.command_latency,
+                         "min_time_step": adaptive_rate.min_period if adaptive_rate is not None else None,
+                         "max_time_step": adaptive_rate.max_period if adaptive_rate is not None else None}
+        open(self.path + ".bin", "wb").close()
+        self.writer = threading.Thread(target=self._write_chunks, name="flight-recorder", daemon=True)
+        self.writer.start()
+        self._queue_header()
+
+    def _code(self, table, name):
+        codes = self.codes[table]
+        code = codes.get(name)
+        if code is None:
+            code = codes[name] = len(self.names[table])
+            self.names[table].append(name)
+            self._queue_header()
+        return code
+
+    def record(self, vessel):
+        """ Appends the vessel's current snapshot. Called from Vessel.record()"""
+        self._check()
+        if self.dtype is None:
+            self._start(vessel)
+        flight = vessel.flight
+        controls = vessel.controls.values
+        targets = list(self.nans)
+        errors = list(self.nans)
+        for i, quantity_name in enumerate(self.quantities):
+            if quantity_name in vessel.targets:
+                targets[i] = vessel.targets[quantity_name]
+            if quantity_name in vessel.tracking_errors:
+                errors[i] = vessel.tracking_errors[quantity_name]
+        derivatives = [vessel.derivatives[quantity_name].derivatives for quantity_name in self.quantities]
+        self.chunk[self.row] = (self.count, flight.ut, vessel.dt, vessel.scheduler.period, vessel.command_latency,
+                                self._code("maneuvers", vessel.maneuver), self._code("phases", vessel.phase),
+                                flight.speed, flight.mean_altitude, flight.surface_altitude, flight.latitude,
+                                flight.longitude, flight.heading, flight.roll, flight.velocity, derivatives, targets,
+                                errors, controls["throttle"], controls["pitch"], controls["roll"], controls["gear"],
+                                controls["brakes"])
+        self.row += 1
+        self.count += 1
+        if self.row == self.chunk_size:
+            self._hand_off()
+
+    def _check(self):
+        if self.error is not None:
+            raise RecorderError(f"Writing the flight log {self.path} failed") from self.error
+
+    def _put(self, item):
+        # Waits while 'max_pending' chunks are queued, unless the writer has stopped
+        while True:
+            self._check()
+            try:
+                self.full.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _hand_off(self):
+        self._put((self.chunk, self.row))
+        try:
+            self.chunk = self.free.get_nowait()
+        except queue.Empty:
+            # The writer is behind; allocate rather than make the control loop wait for it
+            self.chunk = np.zeros(self.chunk_size, self.dtype)
+        self.row = 0
+
+    def _write_chunks(self):
+        try:
+            with open(self.path + ".bin", "ab") as file:
+                while True:
+                    item = self.full.get()
+                    if item is None:
+                        break
+                    if isinstance(item, dict):
+                        self._write_header(item)
+                        continue
+                    chunk, rows = item
+                    file.write(chunk[:rows].tobytes())
+                    file.flush()
+                    self.free.put(chunk)
+        except Exception as e:
+            # Any failure ends the writer; the control thread raises it on its next record() or close()
+            self.error = e
+
+    def _queue_header(self):
+        # The names are copied, since the control loop keeps appending to them while the writer dumps the header
+        self._put({"dtype": [list(field) for field in self.dtype.descr], "quantities": list(self.quantities),
+                   "maneuvers": list(self.names["maneuvers"]), "phases": list(self.names["phases"]),
+                   "vessel": self.settings, "every_snapshot": True})
+
+    def _write_header(self, header):
+        with open(self.path + ".json", "w") as file:
+            json.dump(header, file)
+
+    def close(self):
+        """ Writes out the last partial chunk and waits for the writer to finish"""
+        writer, self.writer = self.writer, None
+        if writer is None:
+            return
+        if self.row:
+            self._put((self.chunk, self.row))
+            self.row = 0
+        self._put(None)
+        writer.join()
+        self._check()
+
+
+class FlightLog:
+    """ Read access to a recorded flight. Columns are memory-mapped views, i.e. only the rows used are read."""
+    def __init__(self, path):
+        with open(path + ".json") as file:
+            header = json.load(file)
+        self.dtype = np.dtype([tuple(field[:2]) + ((tuple(field[2]),) if len(field) > 2 else ())
+                               for field in header["dtype"]])
+        self.quantities = header["quantities"]
+        self.maneuvers = header["maneuvers"]
+        self.phases = header["phases"]
+        self.settings = header.get("vessel", {})
+        # Older logs hold a record per tick only, without the snapshots read between maneuvers
+        self.every_snapshot = header.get("every_snapshot", False)
+        if os.path.getsize(path + ".bin"):
+            self.records = np.memmap(path + ".bin", dtype=self.dtype, mode="r")
+        else:
+            self.records = np.zeros(0, self.dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, key):
+        return self.records[key]
+
+    def derivatives(self, quantity_name):
+        return self.records["derivatives"][:, self.quantities.index(quantity_name)]
+
+    def targets(self, quantity_name):
+        return self.records["targets"][:, self.quantities.index(quantity_name)]
+
+    def errors(self, quantity_name):
+        return self.records["errors"][:, self.quantities.index(quantity_name)]
+
+    def maneuver_names(self, codes):
+        return [self.maneuvers[code] for code in codes]
+
+    def phase_names(self, codes):
+        return [self.phases[code] for code in codes]
+
+    def chunks(self, size=65536):
+        """ Yields consecutive blocks of records, for passes over logs too long to process at once"""
+        for start in range(0, len(self.records), size):
+            yield self.records[start:start + size]
@@ -0,0 +1,252 @@
+"""
+Regression checks
+-----------------
+Guidance paths that must command the same controls, flown against the simulator and compared tick by tick. Each
+check prints what it compared and returns whether the controls agreed; the script exits with status 1 if any check
+fails, i.e. for a CI job:
+
+    python regression.py
+    python regression.py batch north
+
+    batch   A BatchVessel of one aircraft against Vessel flying simulator.fly_mission. The batch reads the snapshots
+            the Vessel read rather than its own physics: NumPy's trigonometry rounds differently from the math
+            module's, and within a few hundred ticks of the turn that rounding alone would fly the two apart.
+    north   Vessel.runway_alignment_correction, driven by the tables of approach.py, against the loop it replaced,
+            from approaches north of the runway that between them pass every landing stage and alignment phase. The
+            tables mirror the north side's loop to the south, so only north of the centre line must nothing differ.
+"""
+
+import argparse
+import contextlib
+import io
+import sys
+
+import numpy as np
+
+from air_craft import GUIDANCE_DEFAULTS, Vessel
+from batch import DONE, MANEUVERS, VESSEL_ARGUMENTS, BatchAircraft, BatchVessel
+from simulator import RUNWAY_ALTITUDE, Aircraft, SimulatedConnection, fly_mission
+from sweep import MISSION_SETTINGS
+
+FLIGHT_FIELDS = ("speed", "mean_altitude", "surface_altitude", "latitude", "longitude", "heading", "roll")
+CONTROLS = ("throttle", "pitch", "roll", "gear", "brakes")
+# Latitude north of the runway's centre line, longitude, altitude above the runway and speed of each approach checked
+NORTH_APPROACHES = ((0.005, -74.0, 100, 80), (0.002, -74.2, 100, 80), (0.001, -74.45, 40, 45),
+                    (0.0005, -74.3, 60, 60), (0.0003, -74.52, 30, 40))
+
+
+def tick_time(ut):
+    # Both paths add up the same physics steps, so game times agree to far better than this
+    return round(ut, 6)
+
+
+class TickLog:
+    """ Passed to the vessel in place of a FlightRecorder: keeps the snapshot and commanded controls of every game
+        time. A later record at the same time replaces the controls, so each time holds those written before the
+        game moved on"""
+    def __init__(self):
+        self.snapshots = {}
+        self.controls = {}
+
+    def record(self, vessel):
+        flight = vessel.flight
+        ut = tick_time(flight.ut)
+        self.snapshots[ut] = {name: getattr(flight, name) for name in FLIGHT_FIELDS}
+        self.controls[ut] = tuple(vessel.controls[name] for name in CONTROLS)
+
+    def close(self):
+        pass
+
+
+class RecordedBatch(BatchVessel):
+    """ BatchVessel whose telemetry is the snapshots of a TickLog at the batch's game time"""
+    def __init__(self, log, **parameters):
+        self.log = log
+        super().__init__(BatchAircraft(1), **parameters)
+
+    def update_telemetry(self):
+        snapshot = self.log.snapshots.get(tick_time(self.ut[0]))
+        if snapshot is None:
+            raise KeyError(f"The vessel took no snapshot at ut {self.ut[0]:.3f}")
+        self.flight = {name: np.array([value]) for name, value in snapshot.items()}
+        for quantity_name, buffer in self.derivatives.items():
+            buffer.update(self.ut, self.flight[quantity_name])
+
+
+def fly(log, settings, time_limit):
+    connection = SimulatedConnection(time_limit=time_limit)
+    vessel = Vessel(connection, metrics_interval=None, recorder=log, **settings)
+    with contextlib.redirect_stdout(io.StringIO()):
+        fly_mission(vessel)
+    # The snapshot that ended the mission was read after the last tick
+    vessel.record()
+    return vessel
+
+
+def check_batch(settings=MISSION_SETTINGS, time_limit=1800, tolerance=1e-9):
+    """ Compares the commands of a batch of one with those of Vessel on every tick of the mission"""
+    log = TickLog()
+    fly(log, settings, time_limit)
+    batch = RecordedBatch(log, time_step=settings["time_step"],
+                          **{name: value for name, value in settings.items() if name in VESSEL_ARGUMENTS})
+    ticks = 0
+    while batch.maneuver[0] != DONE:
+        ut = tick_time(batch.ut[0])
+        try:
+            batch.step()
+        except KeyError as e:
+            print(f"batch: still in {MANEUVERS[batch.maneuver[0]]} once the vessel has stopped ({e.args[0]})")
+            return False
+        commanded = log.controls.get(ut)
+        if commanded is None:
+            print(f"batch: tick {ticks} (ut {ut:.3f}) has no vessel tick at the same time")
+            return False
+        batched = tuple(float(getattr(batch, name)[0]) for name in CONTROLS)
+        differences = [abs(a - b) for a, b in zip(commanded, batched)]
+        if max(differences) > tolerance:
+            print(f"batch: tick {ticks} (ut {ut:.3f}, {MANEUVERS[batch.maneuver[0]]}) commands "
+                  f"{dict(zip(CONTROLS, batched))}, the vessel {dict(zip(CONTROLS, commanded))}")
+            return False
+        ticks += 1
+    print(f"batch: {ticks} ticks, every command within {tolerance:g} of the vessel's")
+    return True
+
+
+def north_side_loop(vessel, altitude_quantity="mean_altitude"):
+    """ runway_alignment_correction as it was before approach.py, north of the runway, with the flare held above the
+        runway. Like it, this changes the vessel's approach_speed, correction_angle and min_correction_roll"""
+    vessel.begin_maneuver("runway_alignment_correction")
+    vessel.set_control("gear", False)
+    vessel.warm_up(altitude_quantity, "roll")
+    flight = vessel.flight
+    initial_latitude = flight.latitude
+    correction_roll = vessel.correction_roll_gain * abs(vessel.runway_center - initial_latitude)
+    if flight.latitude < vessel.runway_end:
+        vessel.min_correction_roll = 1.5
+    if correction_roll > vessel.max_correction_roll:
+        correction_roll = vessel.max_correction_roll
+    elif correction_roll < vessel.min_correction_roll:
+        correction_roll = vessel.min_correction_roll
+    half_turn_di = vessel.half_turn_di
+    speed = vessel.cruise_speed
+    altitude = vessel.cruise_altitude
+    a_s = vessel.approach_pitch_sensitivity
+    s = vessel.approach_roll_sensitivity
+    while vessel.flight.latitude > vessel.runway_center:
+        flight = vessel.flight
+        if flight.longitude < vessel.runway_end + vessel.approach_offset:
+            speed = vessel.approach_speed
+            altitude = vessel.approach_altitude
+            vessel.correction_angle = 10
+        if flight.longitude < vessel.runway_end + vessel.landing_offset:
+            altitude = vessel.landing_altitude
+            vessel.approach_speed = 40
+            s = 0.75
+        if flight.longitude < vessel.runway_end and flight.speed > vessel.approach_speed:
+            altitude_quantity = "surface_altitude"
+            altitude = 35
+            speed = 20
+            a_s = 1.5
+            s = 0.5
+            vessel.set_control("gear", True)
+        if flight.longitude < vessel.runway_end and flight.speed < vessel.approach_speed:
+            # The old loop flared on the mean altitude unless it had decelerated first, i.e. towards 25 m above sea
+            # level rather than above the runway; the tables fixed that on both sides
+            altitude_quantity = "surface_altitude"
+            a_s = 1
+            vessel.set_control("gear", True)
+            speed = 27
+            s = 0.15
+            altitude = 25
+        if flight.surface_altitude < 2:
+            altitude = 1
+            vessel.set_control("brakes", True)
+            speed = 0
+            if flight.speed < 1.0:
+                break
+        target_climb_speed = vessel.get_quadratic_target_quantity_velocity(altitude_quantity, altitude,
+                                                                           vessel.max_target_speed)
+        vessel.angular_control_from_position(altitude_quantity, target_climb_speed, "pitch", vessel.control_step,
+                                             sensitivity=a_s)
+        vessel.control_quantity("speed", speed, vessel.cruise_acceleration, "throttle")
+        if flight.latitude > initial_latitude:
+            initial_latitude = flight.latitude
+        di = (vessel.runway_center - flight.latitude) / (vessel.runway_center - initial_latitude)
+        if flight.heading > vessel.runway_heading - vessel.correction_angle / 2 and di > 0.75:
+            target_roll = -correction_roll
+            half_turn_di = 1.0 - di
+        elif flight.heading < vessel.runway_heading - vessel.correction_angle / 2 and di > 0.75:
+            target_roll = 0
+        elif di > 8 * half_turn_di:
+            target_roll = 0
+        elif 8 * half_turn_di > di and flight.heading < vessel.runway_heading - vessel.correction_angle / 2:
+            target_roll = correction_roll
+        elif 8 * half_turn_di > di and flight.heading > vessel.runway_heading - vessel.correction_angle / 2:
+            target_roll = 0
+            if flight.roll < 1:
+                break
+        else:
+            target_roll = None
+        target_roll_speed = 0 if target_roll is None else vessel.get_symmetric_quadratic_target_quantity_velocity(
+            "roll", target_roll, vessel.max_target_speed / 4, anti_sensitivity=0.1)
+        vessel.angular_control_from_position("roll", target_roll_speed, "roll", vessel.control_step / 8,
+                                             sensitivity=s)
+        vessel.next_tick()
+    vessel.flush_controls()
+
+
+def fly_north_approach(approach, maneuver, settings):
+    """ Flies S-turns from 'approach' (a row of NORTH_APPROACHES) until the aircraft has crossed the centre line or
+        stopped, and returns the TickLog"""
+    latitude_offset, longitude, altitude, speed = approach
+    aircraft = Aircraft(latitude=GUIDANCE_DEFAULTS["runway_center"] + latitude_offset,
+                        longitude=longitude, heading=270)
+    aircraft.altitude = RUNWAY_ALTITUDE + altitude
+    aircraft.speed = speed
+    aircraft.on_ground = False
+    connection = SimulatedConnection(aircraft=aircraft)
+    connection.space_center.active_vessel.control.activate_next_stage()
+    log = TickLog()
+    vessel = Vessel(connection, metrics_interval=None, recorder=log, **settings)
+    with contextlib.redirect_stdout(io.StringIO()):
+        while vessel.update_telemetry().speed > 1.0 and vessel.flight.latitude > vessel.runway_center:
+            maneuver(vessel)
+    vessel.record()
+    return log
+
+
+def check_north(settings=MISSION_SETTINGS, tolerance=0.0):
+    """ Compares the commands of runway_alignment_correction with those of north_side_loop on every tick"""
+    ticks = 0
+    for approach in NORTH_APPROACHES:
+        log = fly_north_approach(approach, Vessel.runway_alignment_correction, settings)
+        reference = fly_north_approach(approach, north_side_loop, settings)
+        for ut, commanded in reference.controls.items():
+            controls = log.controls.get(ut)
+            if controls is None or max(abs(a - b) for a, b in zip(commanded, controls)) > tolerance:
+                print(f"north: approach {approach} at ut {ut:.3f} commands {controls}, the old loop "
+                      f"{dict(zip(CONTROLS, commanded))}")
+                return False
+        if len(log.controls) != len(reference.controls):
+            print(f"north: approach {approach} took {len(log.controls)} ticks, the old loop {len(reference.controls)}")
+            return False
+        ticks += len(log.controls)
+    print(f"north: {len(NORTH_APPROACHES)} approaches, {ticks} ticks, every command within {tolerance:g} of the old "
+          f"loop's")
+    return True
+
+
+CHECKS = {"batch": check_batch, "north": check_north}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare guidance paths that must command the same controls")
+    parser.add_argument("checks", nargs="*", help=f"checks to run, of {', '.join(CHECKS)}; all by default")
+    args = parser.parse_args()
+    unknown = set(args.checks) - set(CHECKS)
+    if unknown:
+        parser.error(f"unknown checks: {', '.join(sorted(unknown))}")
+
+    passed = [CHECKS[name]() for name in args.checks or CHECKS]
+    if not all(passed):
+        sys.exit(1)
@@ -0,0 +1,271 @@
+"""
+Flight replay
+-------------
+Feeds a recorded flight (see recorder.FlightRecorder) back through the Vessel guidance code with no connection and no
+sleeping. Every snapshot the vessel takes reads the next record, as the recorder stores every snapshot read in flight
+including those between maneuvers, and every tick takes the recorded time step and scheduled period (which varies in a
+flight recorded with Vessel.adaptive_rate) and the estimators' recorded lead. A change to a control law or to the branch
+logic of a maneuver therefore shows up as a difference in the commanded controls rather than as a different flight:
+
+    python replay.py flight
+    python replay.py flight --save commands.npy
+    python replay.py flight --baseline commands.npy
+    python replay.py flight --mission mission.json
+
+The flight is replayed through the mission it was flown with: simulator.fly_mission unless a mission file (see
+mission.py) is given.
+
+The replay is open-loop: the recorded telemetry is served whatever the replayed commands are, so the comparison is
+meaningful up to the first tick where the commands differ. Without a baseline the commands are compared against the
+ones recorded during the flight. The rate reported is control-law ticks per second of wall time, i.e. the compute cost
+of the guidance code alone.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from air_craft import Vessel
+from mission import flight_plan, load_mission
+from recorder import CONTROL_FIELDS, TELEMETRY_FIELDS, FlightLog
+from simulator import SimulatedControl, SimulatedReferenceFrame, SimulatedStream, _Orbit, fly_mission
+from telemetry import Snapshot
+
+
+class ReplayFinished(Exception):
+    """Raised once every recorded tick has been fed to the vessel"""
+
+
+class ReplayFlight:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return self._conn.frame[name]
+
+
+class ReplayVessel:
+    def __init__(self, conn, controls):
+        self.control = SimulatedControl()
+        for name, value in controls.items():
+            setattr(self.control, name, value)
+        self.orbit = _Orbit()
+        self.surface_reference_frame = SimulatedReferenceFrame()
+        self._flight = ReplayFlight(conn)
+
+    def flight(self, reference_frame=None):
+        return self._flight
+
+
+class ReplaySpaceCenter:
+    ReferenceFrame = SimulatedReferenceFrame
+
+    def __init__(self, conn, controls):
+        self._conn = conn
+        self.active_vessel = ReplayVessel(conn, controls)
+
+    @property
+    def ut(self):
+        return self._conn.frame["ut"]
+
+
+class ReplayConnection:
+    """
+    Stands in for the object returned by krpc.connect(), serving the records of a FlightLog one tick at a time. The
+    log is converted to plain Python values up front, so the replay measures the guidance code rather than NumPy
+    scalar access.
+    """
+    def __init__(self, log):
+        if not log.every_snapshot:
+            raise ValueError("The flight log holds only the snapshots read by ticks and cannot be replayed; "
+                             "record the flight again")
+        timing = ("ut", "dt", "period", "lead")
+        columns = [log[name].tolist() for name in TELEMETRY_FIELDS + timing]
+        velocities = [tuple(velocity) for velocity in log["velocity"].tolist()]
+        names = TELEMETRY_FIELDS + timing + ("velocity",)
+        self.frames = [dict(zip(names, values)) for values in zip(*columns, velocities)]
+        if not self.frames:
+            raise ReplayFinished("The flight log is empty")
+        self.index = 0
+        self.frame = self.frames[0]
+        controls = {name: log["control_" + name][0].item() for name in CONTROL_FIELDS}
+        self.space_center = ReplaySpaceCenter(self, controls)
+
+    def add_stream(self, func, *args):
+        return SimulatedStream(func, args)
+
+    def clock(self):
+        return self.frame["ut"]
+
+    def upcoming(self):
+        """ The record the vessel's next snapshot reads"""
+        if self.index + 1 == len(self.frames):
+            raise ReplayFinished(f"Replayed all {len(self.frames)} records")
+        return self.frames[self.index + 1]
+
+    def advance(self):
+        self.frame = self.upcoming()
+        self.index += 1
+
+    def close(self):
+        pass
+
+
+class ReplayTelemetry:
+    """ Takes the place of the vessel's Telemetry: every update() moves to the next record, and the vessel's estimators
+        predict the record's derivatives by the lead recorded with it"""
+    def __init__(self, conn, vessel):
+        self.conn = conn
+        self.vessel = vessel
+        self.snapshot = vessel.flight
+
+    def update(self):
+        self.conn.advance()
+        self.vessel.set_command_latency(self.conn.frame["lead"])
+        self.snapshot = Snapshot(self.conn.frame)
+        return self.snapshot
+
+    def close(self):
+        pass
+
+
+class ReplayScheduler:
+    """ Takes the place of the vessel's TickScheduler: wait() returns, instead of sleeping, the time step measured in
+        flight before the record the tick's snapshot reads next. The period is the one recorded for each tick."""
+    def __init__(self, conn, period):
+        self.conn = conn
+        self.period = conn.frame["period"]
+        self.ticks = 0
+        self.dt = period
+        self.last_tick = conn.clock()
+
+    def start(self):
+        self.last_tick = self.conn.clock()
+
+    def set_period(self, period):
+        # The recorded periods are replayed whatever period the vessel asks for
+        pass
+
+    def wait(self):
+        frame = self.conn.upcoming()
+        self.dt = frame["dt"]
+        self.period = frame["period"]
+        self.last_tick = frame["ut"]
+        self.ticks += 1
+        return self.dt
+
+    def stats(self):
+        return {"ticks": self.ticks}
+
+
+def command_dtype():
+    return np.dtype([("ut", "f8"), ("maneuver", "U32"), ("phase", "U16")] +
+                    [("control_" + name, "?" if name in ("gear", "brakes") else "f4") for name in CONTROL_FIELDS])
+
+
+class CommandStream:
+    """ Collects the commanded controls of every tick. Passed to the vessel in place of a FlightRecorder."""
+    def __init__(self):
+        self.rows = []
+
+    def record(self, vessel):
+        controls = vessel.controls.values
+        self.rows.append((vessel.flight.ut, vessel.maneuver or "", vessel.phase or "") +
+                         tuple(controls[name] for name in CONTROL_FIELDS))
+
+    def close(self):
+        pass
+
+    def array(self):
+        return np.array(self.rows, dtype=command_dtype())
+
+
+def recorded_commands(log):
+    """ The commands of a FlightLog, in the layout of CommandStream.array()"""
+    commands = np.zeros(len(log), dtype=command_dtype())
+    commands["ut"] = log["ut"]
+    commands["maneuver"] = [name or "" for name in log.maneuver_names(log["maneuver"])]
+    commands["phase"] = [name or "" for name in log.phase_names(log["phase"])]
+    for name in CONTROL_FIELDS:
+        commands["control_" + name] = log["control_" + name]
+    return commands
+
+
+def replay(log, mission=fly_mission, **vessel_kwargs):
+    """
+    Flies 'mission' (a function of the vessel, i.e. simulator.fly_mission or the result of mission.flight_plan())
+    against the recorded telemetry of 'log'. The vessel is configured with the settings stored in the log unless
+    overridden by 'vessel_kwargs'. Returns the commanded controls as an array and the replay's throughput.
+    """
+    conn = ReplayConnection(log)
+    settings = dict(log.settings)
+    # The recorded lead is replayed rather than measured
+    settings["command_latency"] = conn.frame["lead"]
+    settings.update(vessel_kwargs)
+    commands = CommandStream()
+    vessel = Vessel(conn, metrics_interval=None, recorder=commands, **settings)
+    vessel.scheduler = ReplayScheduler(conn, vessel.t)
+    vessel.telemetry = ReplayTelemetry(conn, vessel)
+    start = time.perf_counter()
+    try:
+        mission(vessel)
+    except ReplayFinished:
+        pass
+    seconds = time.perf_counter() - start
+    ticks = len(commands.rows)
+    return commands.array(), {"ticks": ticks, "seconds": seconds, "rate": ticks / seconds if seconds else 0.0}
+
+
+def compare(commands, baseline, tolerance=0.0):
+    """
+    Differences between two command streams, per control: the number of ticks that differ by more than 'tolerance',
+    the largest difference and the first tick that differs.
+    """
+    length = min(len(commands), len(baseline))
+    report = {"ticks": len(commands), "baseline_ticks": len(baseline), "controls": {}}
+    for name in CONTROL_FIELDS:
+        field = "control_" + name
+        difference = np.abs(commands[field][:length].astype("f8") - baseline[field][:length].astype("f8"))
+        differing = np.flatnonzero(difference > tolerance)
+        report["controls"][name] = {"differing": len(differing),
+                                    "max_difference": float(difference.max()) if length else 0.0,
+                                    "first": int(differing[0]) if len(differing) else None}
+    firsts = [control["first"] for control in report["controls"].values() if control["first"] is not None]
+    if firsts:
+        tick = min(firsts)
+        report["first_difference"] = {"tick": tick, "ut": float(baseline["ut"][tick]),
+                                      "maneuver": str(baseline["maneuver"][tick]),
+                                      "phase": str(baseline["phase"][tick])}
+    return report
+
+
+def format_report(report):
+    lines = [f"{report['ticks']} ticks replayed, {report['baseline_ticks']} in the baseline"]
+    for name, control in report["controls"].items():
+        lines.append(f"  {name}: {control['differing']} ticks differ, max difference {control['max_difference']:.6g}")
+    first = report.get("first_difference")
+    if first is None:
+        lines.append("Commands match the baseline")
+    else:
+        lines.append(f"First difference at tick {first['tick']} (ut {first['ut']:.3f}, {first['maneuver']}"
+                     f"{', ' + first['phase'] if first['phase'] else ''})")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded flight through the guidance code")
+    parser.add_argument("path", help="flight log path, without the .bin/.json extension")
+    parser.add_argument("--baseline", help="command stream saved by --save; defaults to the recorded commands")
+    parser.add_argument("--save", help="save the replayed command stream to this .npy file")
+    parser.add_argument("--tolerance", type=float, default=0.0)
+    parser.add_argument("--mission", help="mission file the flight was flown with; defaults to simulator.fly_mission")
+    args = parser.parse_args()
+
+    flight_log = FlightLog(args.path)
+    replayed, throughput = replay(flight_log, flight_plan(load_mission(args.mission)) if args.mission else fly_mission)
+    print(f"{throughput['ticks']} ticks in {throughput['seconds']:.3f} s, {throughput['rate']:.0f} ticks/s")
+    if args.save:
+        np.save(args.save, replayed)
+    baseline_commands = np.load(args.baseline) if args.baseline else recorded_commands(flight_log)
+    print(format_report(compare(replayed, baseline_commands, args.tolerance)))
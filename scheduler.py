@@ -0,0 +1,106 @@
+import time
+
+
+class TickScheduler:
+    """
+    Paces a control loop at a fixed rate. Tick n is due at an absolute deadline start + n * period, and wait() sleeps
+    only for whatever is left of the period after the tick's work, so RPC and compute time do not add up into drift.
+
+    When a tick overruns its deadline, the next tick starts immediately and any further deadlines that have already
+    passed are skipped, rather than running a burst of back-to-back ticks to catch up. Overruns, skipped deadlines,
+    jitter (how late each tick started relative to its deadline) and the achieved rate are recorded.
+
+    'clock' and 'sleep' default to the wall clock; an offline backend can pass its own game clock instead.
+    """
+    def __init__(self, period, clock=time.monotonic, sleep=time.sleep):
+        self.period = period
+        self.clock = clock
+        self.sleep = sleep
+        self.reset()
+
+    def reset(self):
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.elapsed = 0.0
+        self.dt = self.period
+        self.start()
+
+    def start(self):
+        """ Anchors deadlines to now. Called at the start of each maneuver, so time spent between maneuvers is not
+            counted as an overrun."""
+        now = self.clock()
+        self.last_tick = now
+        self.deadline = now + self.period
+
+    def set_period(self, period):
+        """ Changes the period from the next tick on; the pending deadline moves by the difference"""
+        self.deadline += period - self.period
+        self.period = period
+
+    def wait(self):
+        """ Sleeps until the next deadline and returns the measured time since the previous tick."""
+        now = self.clock()
+        if now < self.deadline:
+            self.sleep(self.deadline - now)
+            now = self.clock()
+        else:
+            self.overruns += 1
+            missed = int((now - self.deadline) // self.period)
+            self.skipped += missed
+            self.deadline += missed * self.period
+        jitter = now - self.deadline
+        self.jitter_total += abs(jitter)
+        self.jitter_max = max(self.jitter_max, abs(jitter))
+        self.deadline += self.period
+        self.dt = now - self.last_tick
+        self.elapsed += self.dt
+        self.last_tick = now
+        self.ticks += 1
+        return self.dt
+
+    @property
+    def rate(self):
+        # Achieved ticks per second over all ticks so far
+        return self.ticks / self.elapsed if self.elapsed else 0.0
+
+    def stats(self):
+        return {"ticks": self.ticks, "target_rate": 1 / self.period, "rate": self.rate, "overruns": self.overruns,
+                "skipped": self.skipped, "mean_jitter": self.jitter_total / self.ticks if self.ticks else 0.0,
+                "max_jitter": self.jitter_max}
+
+
+class AdaptiveRate:
+    """
+    Chooses a control period between 'min_period' and 'max_period' every tick from a demand between 0 and 1: 0 asks for
+    the longest period, 1 for the shortest, in between the period is interpolated geometrically. A rising demand takes
+    effect on the next tick; a falling one lengthens the period by at most 'slow_down' (a fraction) per tick, so the
+    loop does not go coarse on the first quiet tick after a disturbance. Keeps a count of ticks per chosen rate.
+    """
+    def __init__(self, min_period, max_period, slow_down=0.05):
+        if not 0 < min_period <= max_period:
+            raise ValueError("Expected 0 < min_period <= max_period")
+        self.min_period = min_period
+        self.max_period = max_period
+        self.slow_down = slow_down
+        self.period = min_period
+        self.ticks = 0
+        self.elapsed = 0.0
+        self.rates = {}
+
+    def update(self, demand):
+        """ The period of the next tick for 'demand'"""
+        demand = min(max(demand, 0.0), 1.0)
+        target = self.max_period * (self.min_period / self.max_period) ** demand
+        self.period = min(target, self.period * (1 + self.slow_down))
+        rate = round(1 / self.period)
+        self.rates[rate] = self.rates.get(rate, 0) + 1
+        self.ticks += 1
+        self.elapsed += self.period
+        return self.period
+
+    def stats(self):
+        return {"ticks": self.ticks, "mean_rate": self.ticks / self.elapsed if self.elapsed else 0.0,
+                "rates": dict(sorted(self.rates.items()))}
@@ -0,0 +1,119 @@
+"""
+Flight session
+--------------
+Session owns the connection to the game and the hybrid reference frame of the active vessel. Both are created on
+first use and shared by every maneuver flown in the session. krpc is imported only when the session connects, so
+importing this module (or air_craft) never touches the network:
+
+    session = Session(name="guidance")
+    vessel = session.vessel(cruise_altitude=100, cruise_speed=80)
+    session.run(Vessel.take_off)
+    session.run(Vessel.cruise, longitude_bound=-73.2)
+
+A maneuver run through the session survives a lost connection: the session reconnects with exponential backoff, moves
+the vessel onto the new connection and flies the maneuver again from wherever the aircraft now is. The maneuvers only
+act on the current telemetry, so flying one again continues it.
+"""
+
+import time
+
+from air_craft import Vessel
+
+
+class Session:
+    def __init__(self, name="guidance", address="127.0.0.1", rpc_port=50000, stream_port=50001, connect=None,
+                 max_attempts=8, backoff=0.5, max_backoff=30.0, sleep=time.sleep, emit=print):
+        self.name = name
+        self.address = address
+        self.rpc_port = rpc_port
+        self.stream_port = stream_port
+        # A function returning a connection, i.e. simulator.SimulatedConnection, in place of krpc.connect()
+        self.connect_function = connect
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.emit = emit
+        self._conn = None
+        self.ref_frame = None
+        self.errors = (OSError,)
+        self.vessels = []
+        self.reconnects = 0
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self.connect()
+        return self._conn
+
+    def connect(self):
+        if self.connect_function is not None:
+            conn = self.connect_function()
+        else:
+            import krpc
+            import krpc.error
+
+            # A lost server surfaces as a socket error or as krpc's own ConnectionError
+            self.errors = (OSError, krpc.error.ConnectionError)
+            conn = krpc.connect(name=self.name, address=self.address, rpc_port=self.rpc_port,
+                                stream_port=self.stream_port)
+        vessel = conn.space_center.active_vessel
+        self.ref_frame = conn.space_center.ReferenceFrame.create_hybrid(position=vessel.orbit.body.reference_frame,
+                                                                        rotation=vessel.surface_reference_frame)
+        self._conn = conn
+        return conn
+
+    def vessel(self, vessel_class=Vessel, **kwargs):
+        """ A Vessel (or subclass) on the session's connection and reference frame"""
+        vessel = vessel_class(self.conn, ref_frame=self.ref_frame, **kwargs)
+        self.vessels.append(vessel)
+        return vessel
+
+    def reconnect(self):
+        """ Connects again, waiting backoff, 2 * backoff, ... up to max_backoff seconds between attempts, and moves
+            every vessel of the session onto the new connection"""
+        self.close()
+        for attempt in range(self.max_attempts):
+            try:
+                conn = self.connect()
+                for vessel in self.vessels:
+                    vessel.reconnect(conn, self.ref_frame)
+                self.reconnects += 1
+                return conn
+            except self.errors as e:
+                self._conn = None
+                if attempt == self.max_attempts - 1:
+                    raise
+                delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+                self.emit(f"Reconnect attempt {attempt + 1} failed ({e!r}), retrying in {delay:.1f} s")
+                self.sleep(delay)
+
+    def run(self, maneuver, *args, vessel=None, **kwargs):
+        """
+        Calls maneuver(vessel, *args, **kwargs), i.e. session.run(Vessel.cruise, longitude_bound=-73.2), on the
+        session's vessel. If the connection is lost the session reconnects and calls it again.
+        """
+        if vessel is None:
+            vessel = self.vessels[-1]
+        while True:
+            try:
+                return maneuver(vessel, *args, **kwargs)
+            except self.errors as e:
+                self.emit(f"Connection lost during {getattr(maneuver, '__name__', maneuver)} ({e!r}), reconnecting")
+                self.reconnect()
+
+    def close(self):
+        """ Removes the telemetry streams of every vessel of the session and closes the connection"""
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        for vessel in self.vessels:
+            try:
+                vessel.telemetry.close()
+            except self.errors:
+                # The connection is already lost, and the server drops its streams with it
+                pass
+        try:
+            conn.close()
+        except self.errors:
+            pass
@@ -0,0 +1,349 @@
+"""
+Offline simulator
+----------------
+An in-process stand-in for a kRPC connection. It implements the part of the kRPC SpaceCenter API that the Vessel class
+uses (active_vessel, flight(ref), control, orbit.body.reference_frame, ReferenceFrame.create_hybrid, ut and streams)
+on top of a simple fixed-wing point-mass model with first-order attitude dynamics.
+
+Game time only advances when the client sleeps through the connection (conn.sleep), so a mission runs as fast as the
+guidance code can compute it rather than in real time:
+
+    conn = SimulatedConnection()
+    vessel = Vessel(conn)
+    vessel.take_off()
+"""
+
+import math
+import random
+import sys
+import time
+
+KERBIN_RADIUS = 600000.0
+KERBIN_GRAVITY = 9.81
+RUNWAY_ALTITUDE = 69.0
+# A touchdown is a landing when it is past the runway's end, sinks no faster than this many m/s and is within this many
+# degrees of latitude of the runway's centre line, see landing_status()
+MAX_SINK_RATE = 12.0
+MAX_LATITUDE_ERROR = 0.3
+
+
+class SimulationTimeout(Exception):
+    """Raised from SimulatedConnection.sleep once game time passes the connection's time limit"""
+
+
+class Aircraft:
+    """
+    Point-mass model of a light jet. Pitch input sets the commanded angle of attack, roll input sets the commanded roll
+    rate, throttle scales thrust once the engine stage has been activated. Coefficients are per unit mass, so forces
+    are expressed directly as accelerations.
+    """
+    def __init__(self, latitude=-0.0486, longitude=-74.72, heading=90.0, terrain_altitude=RUNWAY_ALTITUDE):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.terrain_altitude = terrain_altitude
+        self.altitude = terrain_altitude
+        self.speed = 0.0
+        self.flight_path_angle = 0.0
+        self.heading = math.radians(heading)
+        self.roll = 0.0
+        self.roll_rate = 0.0
+        self.angle_of_attack = 0.0
+        self.on_ground = True
+        self.touchdown = None
+
+        self.max_thrust = 12.0
+        self.lift_slope = 0.0312
+        self.zero_lift_drag = 0.0008
+        self.induced_drag = 0.012
+        self.gear_drag = 0.0002
+        self.incidence = math.radians(2)
+        self.max_angle_of_attack = math.radians(15)
+        self.angle_of_attack_lag = 0.3
+        self.max_roll_rate = math.radians(60)
+        self.roll_rate_lag = 0.2
+        self.rolling_friction = 0.3
+        self.brake_deceleration = 5.0
+
+    @property
+    def surface_altitude(self):
+        return self.altitude - self.terrain_altitude
+
+    @property
+    def velocity(self):
+        # Surface frame of the hybrid reference frame: x up, y north, z east
+        horizontal = self.speed * math.cos(self.flight_path_angle)
+        return (self.speed * math.sin(self.flight_path_angle), horizontal * math.cos(self.heading),
+                horizontal * math.sin(self.heading))
+
+    def step(self, dt, control, ut):
+        target_angle_of_attack = self.incidence + control.pitch * self.max_angle_of_attack
+        self.angle_of_attack += (target_angle_of_attack - self.angle_of_attack) * min(dt / self.angle_of_attack_lag, 1)
+
+        lift = self.lift_slope * self.speed ** 2 * self.angle_of_attack
+        drag = self.speed ** 2 * (self.zero_lift_drag + self.induced_drag * self.angle_of_attack ** 2 +
+                                  (self.gear_drag if control.gear else 0))
+        thrust = self.max_thrust * control.throttle if control.engine_active else 0
+        acceleration = thrust - drag - KERBIN_GRAVITY * math.sin(self.flight_path_angle)
+
+        if self.on_ground and lift > KERBIN_GRAVITY:
+            self.on_ground = False
+        if self.on_ground:
+            acceleration -= self.rolling_friction + (self.brake_deceleration if control.brakes else 0)
+            if self.speed <= 0 and acceleration < 0:
+                acceleration = 0
+            self.roll = self.roll_rate = 0.0
+        else:
+            target_roll_rate = control.roll * self.max_roll_rate
+            self.roll_rate += (target_roll_rate - self.roll_rate) * min(dt / self.roll_rate_lag, 1)
+            self.roll += self.roll_rate * dt
+            self.roll = (self.roll + math.pi) % (2 * math.pi) - math.pi
+            if self.speed > 1:
+                cos_path = math.cos(self.flight_path_angle)
+                self.flight_path_angle += (lift * math.cos(self.roll) - KERBIN_GRAVITY * cos_path) / self.speed * dt
+                self.heading += lift * math.sin(self.roll) / (self.speed * max(cos_path, 0.1)) * dt
+                self.heading %= 2 * math.pi
+
+        self.speed = max(self.speed + acceleration * dt, 0.0)
+        up, north, east = self.velocity
+        self.altitude += up * dt
+        self.latitude += math.degrees(north * dt / KERBIN_RADIUS)
+        self.longitude += math.degrees(east * dt / (KERBIN_RADIUS * math.cos(math.radians(self.latitude))))
+
+        if not self.on_ground and self.altitude <= self.terrain_altitude:
+            if self.touchdown is None:
+                self.touchdown = (ut, self.latitude, self.longitude, up)
+            self.altitude = self.terrain_altitude
+            self.flight_path_angle = 0.0
+            self.on_ground = True
+
+
+class SimulatedControl:
+    def __init__(self):
+        self._throttle = 0.0
+        self._pitch = 0.0
+        self._roll = 0.0
+        self.gear = True
+        self.brakes = True
+        self.engine_active = False
+
+    @property
+    def throttle(self):
+        return self._throttle
+
+    @throttle.setter
+    def throttle(self, value):
+        self._throttle = min(max(value, 0.0), 1.0)
+
+    @property
+    def pitch(self):
+        return self._pitch
+
+    @pitch.setter
+    def pitch(self, value):
+        self._pitch = min(max(value, -1.0), 1.0)
+
+    @property
+    def roll(self):
+        return self._roll
+
+    @roll.setter
+    def roll(self, value):
+        self._roll = min(max(value, -1.0), 1.0)
+
+    def activate_next_stage(self):
+        self.engine_active = True
+        return []
+
+
+class SimulatedFlight:
+    # Only the hybrid (body position, surface rotation) frame is modelled, so the reference frame is not consulted.
+    # Altitudes and roll carry a little measurement noise, like the physics jitter of the game; the controllers rely on
+    # it to see non-zero higher order derivatives, e.g. while rolling down the runway
+    def __init__(self, aircraft, noise):
+        self._aircraft = aircraft
+        self._noise = noise
+
+    @property
+    def speed(self):
+        return self._aircraft.speed
+
+    @property
+    def mean_altitude(self):
+        return self._aircraft.altitude + self._noise("mean_altitude")
+
+    @property
+    def surface_altitude(self):
+        return self._aircraft.surface_altitude + self._noise("surface_altitude")
+
+    @property
+    def latitude(self):
+        return self._aircraft.latitude
+
+    @property
+    def longitude(self):
+        return self._aircraft.longitude
+
+    @property
+    def heading(self):
+        return math.degrees(self._aircraft.heading)
+
+    @property
+    def pitch(self):
+        return math.degrees(self._aircraft.flight_path_angle + self._aircraft.angle_of_attack)
+
+    @property
+    def roll(self):
+        return math.degrees(self._aircraft.roll) + self._noise("roll")
+
+    @property
+    def velocity(self):
+        return self._aircraft.velocity
+
+
+class SimulatedReferenceFrame:
+    @staticmethod
+    def create_hybrid(position, rotation=None, velocity=None, angular_velocity=None):
+        return SimulatedReferenceFrame()
+
+
+class _Body:
+    def __init__(self):
+        self.reference_frame = SimulatedReferenceFrame()
+
+
+class _Orbit:
+    def __init__(self):
+        self.body = _Body()
+
+
+class SimulatedVessel:
+    def __init__(self, aircraft, noise):
+        self.aircraft = aircraft
+        self.noise = noise
+        self.control = SimulatedControl()
+        self.orbit = _Orbit()
+        self.surface_reference_frame = SimulatedReferenceFrame()
+
+    def flight(self, reference_frame=None):
+        return SimulatedFlight(self.aircraft, self.noise)
+
+
+class SimulatedSpaceCenter:
+    ReferenceFrame = SimulatedReferenceFrame
+
+    def __init__(self, aircraft, noise):
+        self.active_vessel = SimulatedVessel(aircraft, noise)
+        self.ut = 0.0
+
+
+class SimulatedStream:
+    def __init__(self, func, args):
+        self._func = func
+        self._args = args
+
+    def __call__(self):
+        return self._func(*self._args)
+
+    def remove(self):
+        pass
+
+
+class SimulatedConnection:
+    """
+    Stands in for the object returned by krpc.connect(). The aircraft is integrated in steps of at most
+    'physics_step' seconds whenever the client sleeps through sleep(). Measurement noise is drawn from a seeded
+    generator, so a run is reproducible. With a 'time_limit', sleeping past that game time raises SimulationTimeout,
+    which ends a mission that would otherwise never finish (i.e. the aircraft never lines up with the runway).
+    """
+    def __init__(self, aircraft=None, physics_step=0.02, sensor_noise=0.0001, seed=0, time_limit=None):
+        self.aircraft = aircraft if aircraft is not None else Aircraft()
+        self.time_limit = time_limit
+        self.random = random.Random(seed)
+        self.sensor_noise = sensor_noise
+        self.readings = {}
+        self.space_center = SimulatedSpaceCenter(self.aircraft, self.noise)
+        self.physics_step = physics_step
+
+    def noise(self, quantity_name):
+        # One reading per quantity and physics state: like a kRPC stream, reading again before time advances returns
+        # the same value
+        reading = self.readings.get(quantity_name)
+        if reading is None:
+            reading = self.readings[quantity_name] = self.random.gauss(0.0, self.sensor_noise) \
+                if self.sensor_noise else 0.0
+        return reading
+
+    def add_stream(self, func, *args):
+        return SimulatedStream(func, args)
+
+    def clock(self):
+        return self.space_center.ut
+
+    def sleep(self, seconds):
+        control = self.space_center.active_vessel.control
+        while seconds > 0:
+            dt = min(seconds, self.physics_step)
+            self.space_center.ut += dt
+            self.aircraft.step(dt, control, self.space_center.ut)
+            seconds -= dt
+        self.readings = {}
+        if self.time_limit is not None and self.space_center.ut > self.time_limit:
+            raise SimulationTimeout(f"Game time passed {self.time_limit} s")
+
+    def close(self):
+        pass
+
+
+def landing_status(vessel, touchdown):
+    """ "landed", or what makes 'touchdown' (game time, latitude, longitude and vertical speed) miss the vessel's
+        runway: "short" of its end, "crashed" above MAX_SINK_RATE or "off runway" beyond MAX_LATITUDE_ERROR"""
+    ut, latitude, longitude, vertical_speed = touchdown
+    if longitude > vessel.runway_end:
+        return "short"
+    if -vertical_speed > MAX_SINK_RATE:
+        return "crashed"
+    if abs(latitude - vessel.runway_center) > MAX_LATITUDE_ERROR:
+        return "off runway"
+    return "landed"
+
+
+def fly_mission(vessel):
+    """ The full mission: take-off, cruise away from the runway, turn back, align with the runway and land"""
+    vessel.take_off()
+    vessel.cruise(longitude_bound=-73.2)
+    # The roll loop overshoots the turn's bank angle by about as much again; from a 45 degree bank at 100 m/s the
+    # aircraft rolls past 80 degrees and carries on turning north, so the turn is flown at the approach speed
+    vessel.turn(heading_limit=270, turning_speed=80, roll_angle=30, offset=15)
+    while vessel.update_telemetry().speed > 1.0:
+        vessel.runway_alignment_correction()
+
+
+if __name__ == "__main__":
+    from air_craft import Vessel
+
+    connection = SimulatedConnection(time_limit=1800)
+    vessel = Vessel(connection, cruise_altitude=100, cruise_speed=80, time_step=0.005, cruise_acceleration=150,
+                    control_step=0.02)
+    start = time.perf_counter()
+    timed_out = False
+    try:
+        fly_mission(vessel)
+    except SimulationTimeout as e:
+        print(e)
+        timed_out = True
+    print(f"Simulated {connection.clock():.1f} s of flight in {time.perf_counter() - start:.1f} s, "
+          f"touchdown: {connection.aircraft.touchdown}")
+    print(f"Scheduler: {vessel.scheduler.stats()}")
+    if vessel.adaptive_rate is not None:
+        print(f"Control rate: {vessel.adaptive_rate.stats()}")
+    touchdown = connection.aircraft.touchdown
+    if timed_out:
+        status = "timeout"
+    elif touchdown is None:
+        status = "no touchdown"
+    else:
+        status = landing_status(vessel, touchdown)
+    print(f"Landing: {status}")
+    # A mission that does not land on the runway fails, i.e. for a script or CI job running it
+    if status != "landed":
+        sys.exit(1)
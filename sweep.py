@@ -0,0 +1,240 @@
+"""
+Gain sweep
+----------
+Flies the full simulated mission (take-off, cruise, turn, runway alignment and landing, see simulator.fly_mission)
+once per parameter set, spread over all cores with a process pool, and collects the outcome of every run into a
+results table.
+
+A parameter is either a Vessel constructor argument (i.e. control_step) or any Vessel attribute the guidance reads
+(i.e. max_target_speed, approach_offset, landing_offset, correction_roll_gain, half_turn_di,
+approach_pitch_sensitivity). The search space is a JSON object of parameter names; for a grid each name maps to a list
+of values, for random and Latin hypercube sampling to a [low, high] range:
+
+    python sweep.py space.json --method lhs --samples 64 --results sweep.csv
+
+A run ends as soon as the aircraft touches down during the approach, rolls past 'max_roll', drifts more than
+'max_latitude_error' degrees off the runway's latitude or runs out of game time. A touchdown is judged by
+simulator.landing_status(): "landed", or "short" of the runway's end, "crashed" sinking faster than MAX_SINK_RATE or
+"off runway". Every finished run is appended to the
+results file straight away, together with the seed and time limit it was flown with. Running the same command again
+skips the runs already in it for the same seed and time limit, so an interrupted sweep resumes where it stopped; runs
+that failed with an error are flown again.
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import json
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from air_craft import Vessel
+from simulator import (KERBIN_RADIUS, MAX_LATITUDE_ERROR, SimulatedConnection, SimulationTimeout, fly_mission,
+                       landing_status)
+
+MISSION_SETTINGS = {"cruise_altitude": 100, "cruise_speed": 80, "time_step": 0.005, "cruise_acceleration": 150,
+                    "control_step": 0.02}
+VESSEL_ARGUMENTS = ("cruise_altitude", "cruise_speed", "cruise_acceleration", "time_step", "control_step",
+                    "derivative_smoothing", "estimator_theta")
+KEY_FIELDS = ("parameters", "run")
+RESULT_FIELDS = ("status", "touchdown_error", "touchdown_longitude", "touchdown_vertical_speed", "peak_roll",
+                 "time_to_land", "wall_time")
+
+
+class RunStopped(Exception):
+    """Raised by MissionProbe to end a run whose outcome is known"""
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class MissionProbe:
+    """
+    Watches a run every tick, in place of a FlightRecorder. Keeps the peak roll magnitude and the touchdown, and
+    stops the run once the aircraft is on the ground during the approach or is beyond recovery.
+    """
+    def __init__(self, conn, max_roll=90, max_latitude_error=MAX_LATITUDE_ERROR):
+        self.conn = conn
+        self.max_roll = max_roll
+        self.max_latitude_error = max_latitude_error
+        self.peak_roll = 0.0
+        self.touchdown = None
+        self.vertical_speed = 0.0
+
+    def record(self, vessel):
+        flight = vessel.flight
+        roll = abs(flight.roll)
+        if roll > self.peak_roll:
+            self.peak_roll = roll
+        if vessel.maneuver == "runway_alignment_correction" and self.conn.aircraft.on_ground:
+            # On the ground the vertical speed reads zero; the sink rate is that of the last tick in the air
+            self.touchdown = (flight.ut, flight.latitude, flight.longitude, self.vertical_speed)
+            raise RunStopped("touchdown")
+        self.vertical_speed = flight.velocity[0]
+        if roll > self.max_roll:
+            raise RunStopped("rolled over")
+        if abs(flight.latitude - vessel.runway_center) > self.max_latitude_error:
+            raise RunStopped("off course")
+
+    def close(self):
+        pass
+
+
+def run_mission(parameters, settings=MISSION_SETTINGS, time_limit=900, seed=0, max_roll=90,
+                max_latitude_error=MAX_LATITUDE_ERROR):
+    """ Flies the mission once with 'parameters' applied and returns the run's row of the results table"""
+    conn = SimulatedConnection(seed=seed, time_limit=time_limit)
+    arguments = dict(settings)
+    arguments.update((name, value) for name, value in parameters.items() if name in VESSEL_ARGUMENTS)
+    probe = MissionProbe(conn, max_roll, max_latitude_error)
+    start = time.perf_counter()
+    # The maneuvers print their progress; a sweep only keeps the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            vessel = Vessel(conn, metrics_interval=None, recorder=probe, **arguments)
+            for name, value in parameters.items():
+                if name not in VESSEL_ARGUMENTS:
+                    if not hasattr(vessel, name):
+                        raise AttributeError(f"Vessel has no parameter {name!r}")
+                    setattr(vessel, name, value)
+            fly_mission(vessel)
+            status = "finished"
+        except RunStopped as e:
+            status = e.status
+        except SimulationTimeout:
+            status = "timeout"
+        except Exception as e:
+            status = f"error: {e!r}"
+    row = {"parameters": run_key(parameters), "status": status, "touchdown_error": None,
+           "touchdown_longitude": None, "touchdown_vertical_speed": None, "peak_roll": probe.peak_roll,
+           "time_to_land": None, "wall_time": time.perf_counter() - start}
+    if probe.touchdown is not None:
+        ut, latitude, longitude, vertical_speed = probe.touchdown
+        row["status"] = landing_status(vessel, probe.touchdown)
+        # Distance from the runway's centre line
+        row["touchdown_error"] = math.radians(abs(latitude - vessel.runway_center)) * KERBIN_RADIUS
+        row["touchdown_longitude"] = longitude
+        row["touchdown_vertical_speed"] = vertical_speed
+        row["time_to_land"] = ut
+    return row
+
+
+def grid(space):
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*space.values())]
+
+
+def random_samples(space, count, seed=0):
+    generator = random.Random(seed)
+    return [{name: generator.uniform(low, high) for name, (low, high) in space.items()} for _ in range(count)]
+
+
+def latin_hypercube(space, count, seed=0):
+    # Each parameter's range is cut into 'count' strata and every stratum is used by exactly one sample
+    generator = random.Random(seed)
+    columns = {}
+    for name, (low, high) in space.items():
+        strata = list(range(count))
+        generator.shuffle(strata)
+        columns[name] = [low + (high - low) * (stratum + generator.random()) / count for stratum in strata]
+    return [{name: column[i] for name, column in columns.items()} for i in range(count)]
+
+
+def run_key(parameters):
+    return json.dumps(parameters, sort_keys=True)
+
+
+def load_results(path):
+    """
+    Rows of a results file, keyed by their parameters and the run settings (seed, time limit) they were flown with.
+    Missing values are None and numbers are floats; a later row replaces an earlier one with the same key.
+    """
+    if not os.path.exists(path):
+        return {}
+    results = {}
+    with open(path, newline="") as file:
+        reader = csv.DictReader(file)
+        if reader.fieldnames is not None and tuple(reader.fieldnames) != KEY_FIELDS + RESULT_FIELDS:
+            raise ValueError(f"{path} has the columns of another version of the sweep, use a new results file")
+        for row in reader:
+            for field in RESULT_FIELDS[1:]:
+                row[field] = float(row[field]) if row[field] else None
+            results[row["parameters"], row["run"]] = row
+    return results
+
+
+def sweep(samples, results_path, workers=None, **run_kwargs):
+    """
+    Runs every parameter set of 'samples' not yet in 'results_path' with the same 'run_kwargs', or that ended in an
+    error, over a process pool and appends each result as it finishes. Returns the rows of all samples, in order.
+    """
+    run = run_key(run_kwargs)
+    results = load_results(results_path)
+    done = {key for key, row in results.items() if not row["status"].startswith("error")}
+    pending = list(dict.fromkeys(key for key in map(run_key, samples) if (key, run) not in done))
+    new_file = not os.path.exists(results_path)
+    with open(results_path, "a", newline="") as file:
+        writer = csv.DictWriter(file, KEY_FIELDS + RESULT_FIELDS)
+        if new_file:
+            writer.writeheader()
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(run_mission, json.loads(key), **run_kwargs) for key in pending]
+            try:
+                for future in as_completed(futures):
+                    row = future.result()
+                    row["run"] = run
+                    writer.writerow(row)
+                    file.flush()
+                    results[row["parameters"], run] = row
+            except KeyboardInterrupt:
+                executor.shutdown(cancel_futures=True)
+                raise
+    return [results[run_key(parameters), run] for parameters in samples]
+
+
+def format_table(rows, limit=20):
+    """ Landed runs first, closest to the centre line first, then the other touchdowns and then the runs that ended in
+        the air"""
+    def order(row):
+        return (row["status"] != "landed", row["touchdown_error"] is None, row["touchdown_error"] or 0.0)
+
+    def number(value, digits):
+        return "-" if value is None else f"{value:.{digits}f}"
+
+    lines = [f"{'status':<12}{'error m':>9}{'v/s':>8}{'peak roll':>11}{'land s':>9}  parameters"]
+    for row in sorted(rows, key=order)[:limit]:
+        lines.append(f"{row['status'][:12]:<12}{number(row['touchdown_error'], 1):>9}"
+                     f"{number(row['touchdown_vertical_speed'], 2):>8}{number(row['peak_roll'], 1):>11}"
+                     f"{number(row['time_to_land'], 1):>9}  {row['parameters']}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep guidance parameters over the simulated mission")
+    parser.add_argument("space", help="JSON file of parameter values (grid) or [low, high] ranges")
+    parser.add_argument("--method", choices=("grid", "random", "lhs"), default="grid")
+    parser.add_argument("--samples", type=int, default=32, help="number of random or Latin hypercube samples")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the sampling and of the simulator's noise")
+    parser.add_argument("--results", default="sweep.csv")
+    parser.add_argument("--workers", type=int, default=None, help="processes to use, all cores by default")
+    parser.add_argument("--time-limit", type=float, default=900, help="game seconds before a run is given up")
+    parser.add_argument("--top", type=int, default=20, help="rows of the table to print")
+    args = parser.parse_args()
+
+    with open(args.space) as space_file:
+        search_space = json.load(space_file)
+    if args.method == "grid":
+        parameter_sets = grid(search_space)
+    elif args.method == "random":
+        parameter_sets = random_samples(search_space, args.samples, args.seed)
+    else:
+        parameter_sets = latin_hypercube(search_space, args.samples, args.seed)
+    start_time = time.perf_counter()
+    table = sweep(parameter_sets, args.results, args.workers, time_limit=args.time_limit, seed=args.seed)
+    print(f"{len(parameter_sets)} runs in {time.perf_counter() - start_time:.1f} s")
+    print(format_table(table, args.top))
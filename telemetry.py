@@ -0,0 +1,60 @@
+class Snapshot:
+    """
+    Flight values captured at one instant. Attribute names match those of the kRPC Flight object, so helpers can keep
+    using getattr(snapshot, quantity_name) exactly as they did with vessel.flight(ref_frame).
+    """
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+    def __repr__(self):
+        return "Snapshot(" + ", ".join(f"{name}={value!r}" for name, value in self.__dict__.items()) + ")"
+
+
+class Telemetry:
+    """
+    Subscribes once to every flight quantity the guidance code reads and serves them as one snapshot per tick.
+
+    Each stream is registered with the server a single time. After that the server pushes new values to the client
+    and reading a stream is local, so taking a snapshot costs no round trips. When the connection supports stream
+    update callbacks, snapshots are assembled on the stream thread once a whole update message has been applied,
+    which keeps every value in a snapshot from the same server tick.
+    """
+    FIELDS = ("speed", "mean_altitude", "surface_altitude", "latitude", "longitude", "heading", "roll", "velocity")
+
+    def __init__(self, conn, vessel, ref_frame, fields=FIELDS):
+        self.conn = conn
+        flight = vessel.flight(ref_frame)
+        self.streams = {name: conn.add_stream(getattr, flight, name) for name in fields}
+        self.streams["ut"] = conn.add_stream(getattr, conn.space_center, "ut")
+        self.snapshot = None
+        self._latest = None
+        if hasattr(conn, "add_stream_update_callback"):
+            # A stream read for the first time starts and waits for its first update, which the stream thread
+            # delivers. The callback runs on that thread, so every stream must have started before it is added
+            for stream in self.streams.values():
+                stream.start()
+            conn.add_stream_update_callback(self._on_stream_update)
+        self.update()
+
+    def _read(self):
+        return Snapshot({name: stream() for name, stream in self.streams.items()})
+
+    def _on_stream_update(self):
+        # Called on the kRPC stream thread after an update message has been fully applied
+        self._latest = self._read()
+
+    def update(self):
+        """ Takes the snapshot for the current tick. Called once per tick; all helpers read from the result."""
+        latest = self._latest
+        self.snapshot = latest if latest is not None else self._read()
+        return self.snapshot
+
+    def close(self):
+        """ Removes the streams from the server. Closing again does nothing"""
+        if not self.streams:
+            return
+        if hasattr(self.conn, "remove_stream_update_callback"):
+            self.conn.remove_stream_update_callback(self._on_stream_update)
+        for stream in self.streams.values():
+            stream.remove()
+        self.streams = {}